@@ -3,6 +3,7 @@ import random
 import sys
 import time
 import warnings
+from functools import partial
 
 import dash
 import dash_bootstrap_components as dbc
@@ -10,21 +11,21 @@ from dash import dcc
 from dash import html
 import numpy as np
 import pandas as pd
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from flask import request
 from flask_caching import Cache
 
 from config import config as cfg
-from figures_utils import (
-	get_figure,
-)
-from utils import (
-	get_model_input_df,
-	get_pca_with_clusters,
-	get_geo_json_zips,
-	get_borough_zips,
-	get_borough_geo_zips,
-	get_arrests_outside_buffer,
-)
+from app_data import get_borough_dfs, load_app_data
+from callback_cache import CallbackCache, register_cache_stats_route
+from metrics import CALLBACK_SECONDS, FIGURE_REQUEST_SECONDS, LOAD_SECONDS, register_metrics_route, timed, timer
+from prediction import PredictionService, load_model, register_prediction_route
+from what_if import WhatIfEngine, register_what_if_route
+from figures_utils import get_figure_patch, get_raster_layer
+from hexbin import get_hexbin_layer, view_bounds
+from raster_tiles import get_tile_renderer, register_tile_route
+from serialization import register_compression, use_for_callbacks
+from utils import LazyValue, get_arrests_outside_buffer
 
 warnings.filterwarnings("ignore")
 
@@ -45,6 +46,14 @@ boroughs = [
 	"NYC"
 ]
 
+graph_types = [
+	"Market Value",
+	"Arrests outside 1000'",
+	"Neighborhood Cluster",
+	"Model Error",
+	"What-If"
+]
+
 colors = {"background": "#1F2630", "text": "#7FDBFF"}
 
 NOTES = """
@@ -72,18 +81,39 @@ t0 = time.time()
 """ ----------------------------------------------------------------------------
 Data Pre-processing
 ---------------------------------------------------------------------------- """
-summary_market_value = get_model_input_df()
-geo_zip_data = get_geo_json_zips()
-geo_zip_key_data = get_borough_geo_zips(geo_zip_data)
-zip_dict = get_borough_zips(geo_zip_key_data)
-arrest_data = get_arrests_outside_buffer()
-
-# ---------------------------------------------
-
 # initial values:
 initial_year = 2016
 initial_borough = "NYC"
 
+# Everything the first render needs comes from the prebuilt snapshot
+# (built here instead when the data or its code changed, and always by
+# python app.py --snapshot - see src/app_data.py)
+app_data = load_app_data(boroughs, graph_types, initial_year, rebuild="--snapshot" in sys.argv)
+summary_market_value = app_data["summary_market_value"]
+zip_dict = app_data["zip_dict"]
+# Base figures for every borough and graph type - only the highlight
+# of the selected zipcodes is added per request
+figure_cache = app_data["figure_cache"]
+borough_dfs = get_borough_dfs(summary_market_value, boroughs, initial_year)
+
+# Loaded on first use
+# Arrest counts (year, month, zip, law category) - kept out of the
+# snapshot, no callback uses them yet (the market values are 2016 only)
+arrest_data = LazyValue(get_arrests_outside_buffer, "arrest cube")
+# Point density layers (counts per hexagon, precomputed for every zoom)
+hexbin_layers = {
+	name: LazyValue(partial(get_hexbin_layer, name), f"{name} hexbin layer")
+	for name in cfg["hexbin layers"]
+}
+# Arrest density tiles (points projected once, tiles cached on disk)
+arrest_tiles = LazyValue(get_tile_renderer, "arrest tile renderer")
+prediction_service = LazyValue(PredictionService, "prediction service")
+# Facility count scenarios on the predictions of the initial year
+what_if_engine = LazyValue(
+	lambda: WhatIfEngine(load_model(), borough_dfs["NYC"]),
+	"what-if engine"
+)
+
 borough_filter = zip_dict[initial_borough]
 initial_zip = random.choice(borough_filter)
 #initial_geo_sector = [regional_geo_sector[initial_region][initial_sector]]
@@ -108,6 +138,11 @@ app = dash.Dash(__name__,
 
 
 server = app.server  # Needed for gunicorn
+use_for_callbacks()
+register_compression(server)
+register_prediction_route(server, prediction_service.get)
+register_what_if_route(server, what_if_engine.get)
+register_tile_route(server, arrest_tiles.get)
 cache = Cache(
 	server,
 	config={
@@ -118,6 +153,21 @@ cache = Cache(
 )
 app.config.suppress_callback_exceptions = True
 
+# Results of the callbacks, in process (bounded by bytes) and optionally
+# shared by the workers through the filesystem cache
+callback_cache = CallbackCache(
+	shared=cache if cfg["callback cache shared"] else None
+)
+register_cache_stats_route(server, callback_cache)
+
+
+def callback_cache_metrics():
+	return {f"callback_cache_{k}": v for k, v in callback_cache.stats().items()}
+
+
+# Prometheus text of the callback, figure and loading timings
+register_metrics_route(server, collectors=(callback_cache_metrics,))
+
 # --------------------------------------------------------#
 
 app.layout = html.Div(
@@ -228,7 +278,7 @@ app.layout = html.Div(
 							id="graph-type",
 							options=[
 								{"label": i, "value": i}
-								for i in ["Market Value", "Arrests outside 1000'", "Neighborhood Cluster"]
+								for i in graph_types
 							],
 							value="Market Value",
 							inline=True,
@@ -246,6 +296,97 @@ app.layout = html.Div(
 			style={"padding": "5px 0px 10px 20px"},
 			className="row",
 		),
+		# What-If controls (applied to the selected zipcodes) ----#
+		html.Div(
+			[
+				html.Div(
+					[
+						dcc.Dropdown(
+							id="whatif-feature",
+							options=[
+								{"label": f.title(), "value": f}
+								for f in app_data["what_if_features"]
+							],
+							placeholder="What-If: facility type",
+							clearable=True,
+							style={"color": "black"},
+						)
+					],
+					style={
+						"display": "inline-block",
+						"padding": "0px 5px 10px 15px",
+						"width": "40%",
+					},
+				),
+				html.Div(
+					[
+						dcc.Input(
+							id="whatif-delta",
+							type="number",
+							step=1,
+							value=0,
+							debounce=True,
+						)
+					],
+					style={
+						"display": "inline-block",
+						"padding": "0px 5px 10px 0px",
+						"width": "15%",
+					},
+				),
+				html.Div(
+					[
+						dcc.Dropdown(
+							id="hexbin-layer",
+							options=[
+								{"label": f"{name} density", "value": name}
+								for name in cfg["hexbin layers"]
+							],
+							placeholder="Point density layer",
+							clearable=True,
+							style={"color": "black"},
+						)
+					],
+					style={
+						"display": "inline-block",
+						"padding": "0px 5px 10px 0px",
+						"width": "20%",
+					},
+				),
+				html.Div(
+					[
+						dcc.Dropdown(
+							id="hexbin-category",
+							placeholder="All categories",
+							clearable=True,
+							style={"color": "black"},
+						)
+					],
+					style={
+						"display": "inline-block",
+						"padding": "0px 5px 10px 0px",
+						"width": "20%",
+					},
+				),
+				html.Div(
+					[
+						dcc.Checklist(
+							id="raster-layer-toggle",
+							options=[{"label": "Arrest heat map", "value": "arrests"}],
+							value=[],
+							inputStyle={"margin-right": "5px"},
+						)
+					],
+					style={
+						"display": "inline-block",
+						"padding": "0px 5px 10px 0px",
+						"width": "15%",
+					},
+				),
+			],
+			style={"padding": "0px 0px 10px 20px"},
+			className="row",
+		),
 		# App Container ------------------------------------------#
 		html.Div(
 			id="app-container",
@@ -272,6 +413,16 @@ app.layout = html.Div(
 									]
 								),
 								dcc.Graph(id="choropleth"),
+								# Base figure of the borough / graph type, with its
+								# geojson - the selection is highlighted in the browser
+								dcc.Store(id="base-figure"),
+								# Hexbin trace of the current view (density layer)
+								dcc.Store(id="hexbin-trace"),
+								# Last pan / zoom of the map (cleared with the borough)
+								dcc.Store(id="map-view"),
+								# Arrest density tile layer (drawn under the zipcodes)
+								dcc.Store(id="raster-layer"),
+								dcc.Store(id="top-n", data=cfg["topN"]),
 							],
 						),
 					],
@@ -355,9 +506,14 @@ app.layout = html.Div(
  Overview:
  region, year, graph-type, school -> choropleth-title
  region, year -> postcode options
- region, year, graph-type, postcode-value, school -> choropleth
+ region, graph-type, what-if -> base-figure (store)
+ base-figure, postcode-value, hexbin-trace, raster-layer -> choropleth (clientside)
+ hexbin-layer -> hexbin-category options
+ choropleth-relayoutData, region -> map-view (clientside)
+ hexbin-layer, hexbin-category, map-view, region-State -> hexbin-trace
+ raster-layer-toggle -> raster-layer
  postcode-value, property-type-checklist -> price-time-series
- choropleth-clickData, choropleth-selectedData, region, postcode-State -> postcode-value
+ choropleth-clickData, choropleth-selectedData, region, postcode-State -> postcode-value (clientside)
 ---------------------------------------------------------------------------- """
 
 
@@ -369,6 +525,7 @@ app.layout = html.Div(
 		Input("graph-type", "value"),
 	],
 )
+@timed(CALLBACK_SECONDS, callback="update_map_title")
 def update_map_title(borough, gtype):
 	if gtype == "Market Value":
 		return f"Avg market value for properties in a given borough {borough}, {initial_year}"
@@ -376,6 +533,14 @@ def update_map_title(borough, gtype):
 		return (
 			f"Shows the average number of FELONY arrests when predicting the market value in {borough}, {initial_year}"
 		)
+	elif gtype == "Model Error":
+		return (
+			f"Shows the average model error when predicting the market value in {borough}, {initial_year}"
+		)
+	elif gtype == "What-If":
+		return (
+			f"Predicted market value after changing the facilities of the selected zipcodes in {borough}, {initial_year}"
+		)
 	else:
 		return f"The given cluster breakdown for the different zipcodes in the borough {borough}, {initial_year}"
 
@@ -387,6 +552,7 @@ def update_map_title(borough, gtype):
 		Input("borough", "value"),
 	]
 )
+@timed(CALLBACK_SECONDS, callback="update_region_postcode")
 def update_region_postcode(borough):
 	return [
 		{"label": s, "value": s}
@@ -394,55 +560,154 @@ def update_region_postcode(borough):
 	]
 
 
-# Update choropleth-graph with year, region, graph-type update & sectors
+def get_choropleth(borough, gtype, full, whatif_feature, whatif_delta, zips):
+	# Only the What-If scenarios are memoized - the other figures are
+	# already in the snapshot
+	if gtype == "What-If" and whatif_feature and whatif_delta:
+		return get_whatif_choropleth(borough, full, whatif_feature, whatif_delta, zips)
+
+	base_figure = figure_cache[(borough, gtype)]
+	if full:
+		return base_figure
+
+	with timer(FIGURE_REQUEST_SECONDS, stage="patch"):
+		return get_figure_patch(base_figure)
+
+
+@callback_cache.memoize()
+def get_whatif_choropleth(borough, full, whatif_feature, whatif_delta, zips):
+	engine = what_if_engine.get()
+	scenario = {
+		z: {whatif_feature: whatif_delta}
+		for z in zips or []
+		if z in engine.zip_index
+	}
+	with timer(FIGURE_REQUEST_SECONDS, stage="what_if"):
+		figure = engine.figure(figure_cache[(borough, "What-If")], scenario)
+
+	if full:
+		return figure
+
+	with timer(FIGURE_REQUEST_SECONDS, stage="patch"):
+		return get_figure_patch(figure)
+
+
+# Update the base figure with region, graph-type & what-if update
+# The what-if change applies to the zipcodes selected when it is set
 @app.callback(
-	Output("choropleth", "figure"),
+	Output("base-figure", "data"),
 	[
 		Input("borough", "value"),
 		Input("graph-type", "value"),
+		Input("whatif-feature", "value"),
+		Input("whatif-delta", "value"),
+	],
+	[
+		State("zipcode", "value"),
+	],
+)
+@timed(CALLBACK_SECONDS, callback="update_Choropleth")
+def update_Choropleth(borough, gtype, whatif_feature=None, whatif_delta=None, zips=None):
+	# Graph options: "Market Value", "Arrests outside 1000'", "Neighborhood Cluster", "Model Error", "What-If"
+	# The whole figure (with its geojson) is only sent when the borough
+	# changes, otherwise only the values and colors of the trace
+	full = dash.ctx.triggered_id in (None, "borough")
+
+	return get_choropleth(borough, gtype, full, whatif_feature, whatif_delta, zips)
+
+
+# Highlight the selected zipcodes on the base figure (in the browser)
+app.clientside_callback(
+	ClientsideFunction(namespace="map", function_name="highlight"),
+	Output("choropleth", "figure"),
+	[
+		Input("base-figure", "data"),
 		Input("zipcode", "value"),
+		Input("hexbin-trace", "data"),
+		Input("raster-layer", "data"),
 	],
-)  # @cache.memoize(timeout=cfg['timeout'])
-def update_Choropleth(borough, gtype, zips):
-	# Graph type selection------------------------------#
-	# Graph options: "Market Value", "Arrests outside 1000'", "Neighborhood Cluster"
-	if gtype in ["Market Value", "Neighborhood Cluster", "Arrests outside 1000'"]:
-		df = summary_market_value.loc[
-			(summary_market_value['year'] == initial_year) &
-			(summary_market_value['borough'] == borough if borough != 'NYC' else True)
-		]
-	else:
-		# Option to switch datasets if pick a different choice
-		pass
-
-	# For high-lighting mechanism ----------------------#
-	changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
-	geo_sectors = dict()
-
-	# If we are still looking at the same borough,
-	# Update our list and zipcodes to highlight
-	# Use our geojson by zip to get a filtered list ready by our filter
-	if "borough" not in changed_id:
-		for k in geo_zip_data.keys():
-			if k != "features":
-				geo_sectors[k] = geo_zip_data[k]
-			else:
-				geo_sectors[k] = [
-					geo_zip_key_data[z]
-					for z in zips
-				]
-
-	# Updating figure ----------------------------------#
-	fig = get_figure(
-		df,
-		geo_zip_data,
-		borough,
-		gtype,
-		initial_year, # placeholder if we want to change years later
-		geo_sectors
-	)
-
-	return fig
+)
+
+
+# Turn the arrest density tiles on / off
+@app.callback(
+	Output("raster-layer", "data"),
+	[
+		Input("raster-layer-toggle", "value"),
+	],
+)
+@timed(CALLBACK_SECONDS, callback="update_raster_layer")
+def update_raster_layer(toggle):
+	if not toggle:
+		return None
+
+	# The map fetches the tiles itself, it needs an absolute url
+	url = request.host_url.rstrip("/") + app.get_relative_path("/tiles/arrests/{z}/{x}/{y}.png")
+
+	return get_raster_layer(url)
+
+
+# Update the hexbin category options with the layer
+@app.callback(
+	[
+		Output("hexbin-category", "options"),
+		Output("hexbin-category", "value"),
+	],
+	[
+		Input("hexbin-layer", "value"),
+	],
+)
+@timed(CALLBACK_SECONDS, callback="update_hexbin_categories")
+def update_hexbin_categories(layer):
+	if not layer:
+		return [], None
+	try:
+		categories = hexbin_layers[layer].get().categories
+	except FileNotFoundError as e:
+		logging.warning(e)
+		return [], None
+
+	return [{"label": c, "value": c} for c in categories], None
+
+
+# Keep the map view (pan / zoom) - the map goes back to the borough's
+# view without a new relayoutData, so the borough change clears it
+app.clientside_callback(
+	ClientsideFunction(namespace="map", function_name="update_map_view"),
+	Output("map-view", "data"),
+	[
+		Input("choropleth", "relayoutData"),
+		Input("borough", "value"),
+	],
+)
+
+
+# Update the hexbin layer with the map view, layer & category
+@app.callback(
+	Output("hexbin-trace", "data"),
+	[
+		Input("hexbin-layer", "value"),
+		Input("hexbin-category", "value"),
+		Input("map-view", "data"),
+	],
+	[
+		State("borough", "value"),
+	],
+)
+@timed(CALLBACK_SECONDS, callback="update_hexbin")
+def update_hexbin(layer, category, relayout_data, borough):
+	if not layer:
+		return None
+
+	try:
+		hexbin_layer = hexbin_layers[layer].get()
+	except FileNotFoundError as e:
+		logging.warning(e)
+		return None
+
+	zoom, bounds = view_bounds(relayout_data, borough)
+
+	return hexbin_layer.trace(zoom, bounds, category, title=f"{layer} ({category or 'all'})")
 
 
 # # Update price-time-series with postcode updates and graph-type
@@ -488,43 +753,25 @@ def update_Choropleth(borough, gtype, zips):
 
 
 # Update postcode dropdown values with clickData, selectedData and region
-@app.callback(
+# (in the browser - see assets/clientside.js)
+app.clientside_callback(
+	ClientsideFunction(namespace="map", function_name="update_zipcode_dropdown"),
 	Output("zipcode", "value"),
 	[
 		Input("choropleth", "clickData"),
 		Input("choropleth", "selectedData"),
 		Input("borough", "value"),
 		State("zipcode", "value"),
-		State("choropleth", "clickData"),
+		State("top-n", "data"),
 	],
 )
-def update_zipcode_dropdown(
-	clickData, selectedData, borough, zipcodes, clickData_state
-):
-	# Logic for initialisation or when Schoold sre selected
-	if dash.callback_context.triggered[0]["value"] is None:
-		return zipcodes
-
-	changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
-
-	# --------------------------------------------#
-	if "borough" in changed_id:
-		zipcodes = []
-	elif "selectedData" in changed_id:
-		zipcodes = [D["location"] for D in selectedData["points"][: cfg["topN"]]]
-	elif clickData is not None and "location" in clickData["points"][0]:
-		z = clickData["points"][0]["location"]
-		if z in zipcodes:
-			zipcodes.remove(z)
-		elif len(zipcodes) < cfg["topN"]:
-			zipcodes.append(z)
-	return zipcodes
 
 
 # ----------------------------------------------------#
 
 app.css.append_css({"external_url": "https://codepen.io/chriddyp/pen/bWLwgP.css"})
 
+LOAD_SECONDS.set(time.time() - t0, component="data preparation")
 logging.info(f"Data Preparation completed in {time.time() - t0:.1f} seconds")
 
 # ------------------------------------------------------------------------------#
@@ -533,17 +780,22 @@ logging.info(f"Data Preparation completed in {time.time() - t0:.1f} seconds")
 if __name__ == "__main__":
 	logging.info(sys.version)
 
+	# python app.py --snapshot: only prepare the data snapshot (deploy step)
+	if "--snapshot" in sys.argv:
+		sys.exit(0)
+
 	# If running locally in Anaconda env:app
 	if "conda-forge" in sys.version:
-		app.run_server(debug=True)
+		app.run(debug=True)
 
 	# If running on AWS/Pythonanywhere production
 	else:
-		app.run_server(port=8050, host="0.0.0.0", debug=True)
+		app.run(port=8050, host="0.0.0.0", debug=True)
 
 """ ----------------------------------------------------------------------------
 Terminal cmd to run:
-gunicorn app:server -b 0.0.0.0:8050
+python app.py --snapshot  (once per deploy, so the workers only map the data)
+gunicorn app:server -b 0.0.0.0:8050 -w 4
 or
 python app.py
 ---------------------------------------------------------------------------- """
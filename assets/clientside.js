@@ -0,0 +1,98 @@
+/*
+ Client-side callbacks of app.py
+
+ The zipcode selection and its highlight on the map are handled in the
+ browser: the base figure (with the geojson of the borough) is kept in
+ the "base-figure" dcc.Store, so selecting zipcodes needs no request to
+ the server.
+*/
+// Points of the hexbin layer have "row:column" locations
+const isZipcode = location => /^\d{5}$/.test(location);
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        // clickData, selectedData, borough -> zipcode dropdown value
+        // (same rules as the former server callback)
+        update_zipcode_dropdown: function (clickData, selectedData, borough, zipcodes, topN) {
+            const triggered = dash_clientside.callback_context.triggered;
+            if (!triggered.length || triggered[0].value === null || triggered[0].value === undefined) {
+                return zipcodes;
+            }
+
+            const changedId = triggered[0].prop_id;
+            zipcodes = (zipcodes || []).slice();
+
+            if (changedId.includes("borough")) {
+                zipcodes = [];
+            } else if (changedId.includes("selectedData")) {
+                zipcodes = selectedData.points
+                    .map(p => p.location)
+                    .filter(isZipcode)
+                    .slice(0, topN);
+            } else if (clickData !== null && isZipcode(clickData.points[0].location)) {
+                const z = clickData.points[0].location;
+                const i = zipcodes.indexOf(z);
+                if (i >= 0) {
+                    zipcodes.splice(i, 1);
+                } else if (zipcodes.length < topN) {
+                    zipcodes.push(z);
+                }
+            }
+            return zipcodes;
+        },
+
+        // relayoutData, borough -> map view (the map.* keys of the last
+        // pan / zoom). Cleared when the borough changes: the map goes
+        // back to the borough's view without a new relayoutData
+        update_map_view: function (relayoutData, borough) {
+            const triggered = dash_clientside.callback_context.triggered;
+            if (triggered.some(t => t.prop_id.startsWith("borough."))) {
+                return null;
+            }
+            if (!relayoutData || !Object.keys(relayoutData).some(k => k.startsWith("map."))) {
+                return dash_clientside.no_update;
+            }
+            return relayoutData;
+        },
+
+        // base figure, zipcodes, hexbin layer, raster layer -> choropleth
+        // The highlight is a copy of the base trace restricted to the
+        // features of the selected zipcodes (aqua outline). The hexbin
+        // trace of the current view is drawn on top when a layer is on,
+        // the arrest density tiles under the zipcodes
+        highlight: function (baseFigure, zipcodes, hexbin, rasterLayer) {
+            if (!baseFigure) {
+                return dash_clientside.no_update;
+            }
+
+            const base = baseFigure.data[0];
+            const data = [base];
+            if (zipcodes && zipcodes.length) {
+                const selected = new Set(zipcodes);
+                data.push(Object.assign({}, base, {
+                    geojson: {
+                        type: "FeatureCollection",
+                        features: base.geojson.features.filter(
+                            f => selected.has(f.properties.ZCTA5CE10)
+                        ),
+                    },
+                    marker: {opacity: 1.0, line: {width: 3, color: "aqua"}},
+                }));
+            }
+            if (hexbin) {
+                data.push(hexbin);
+            }
+
+            // Keep the user's pan / zoom until the borough (center) changes
+            const center = baseFigure.layout.map.center;
+            const layout = Object.assign({}, baseFigure.layout, {
+                uirevision: `${center.lat},${center.lon}`,
+                map: Object.assign({}, baseFigure.layout.map, {
+                    layers: rasterLayer ? [rasterLayer] : [],
+                }),
+            });
+
+            return {data: data, layout: layout};
+        },
+    },
+});
@@ -0,0 +1,271 @@
+"""
+Data structures the app needs for its first render, and their snapshot
+
+Building them means parsing the zipcode geojson and the model input,
+scoring the model and rendering every base figure. The first process to
+start after the data changed (or `python app.py --snapshot` in a deploy
+step) does it once and writes a single binary snapshot; the app workers
+then only map that file in memory:
+
+    [8 bytes: header length][header json][pickle][array buffers]
+
+(the pickle and every buffer start on a 64 byte boundary)
+
+The pickle (protocol 5) keeps the numpy arrays and the encoded geojson
+(serialization.JSONFragment) out of band, so they are read straight from
+the memory-mapped file without being copied. The file is mapped read-only,
+so gunicorn workers share its pages: adding a worker adds almost no
+memory for the data. The header
+holds a fingerprint of the source files, of the code that builds the
+data and of the app settings - a snapshot that does not match (or that
+cannot be read) is ignored and the data is rebuilt.
+"""
+import glob
+import hashlib
+import importlib.util
+import json
+import logging
+import mmap
+import os
+import pickle
+
+from config import config as cfg
+from figures_utils import get_figure_cache
+from metrics import FIGURE_BUILD_SECONDS, timer
+from utils import (
+    get_model_input_df,
+    get_geo_json_zips,
+    get_borough_zips,
+    get_borough_geo_zips,
+    get_borough_geo_json,
+    log_time,
+)
+
+SNAPSHOT_VERSION = 6
+_ALIGNMENT = 64
+
+# Modules that build the data - the snapshot holds their pickled output
+# (figures, stores), so a change to their code invalidates it. config
+# holds the figure settings (plotly config, geo tolerances, colors)
+SNAPSHOT_MODULES = [
+    'app_data',
+    'config',
+    'figures_utils',
+    'prediction',
+    'serialization',
+    'utils',
+    'what_if',
+    'process.process_geometry',
+    'process.zip_adjacency',
+]
+
+
+def snapshot_sources() -> list:
+    """
+    Files the app data is built from
+    """
+    return sorted(
+        [
+            'data/model_inputs/model_input.csv',
+            'data/raw/ny_new_york_zip_codes_geo.min.json',
+            'data/raw/zip_borough.csv',
+            'data/processed/zip_adjacency.npz',
+            cfg['model_file'],
+        ]
+        + glob.glob(os.path.join(cfg['geo_dir'], '*.json'))
+    )
+
+
+def code_hash(modules: list = SNAPSHOT_MODULES) -> str:
+    """
+    Hash of the source of the modules (read from their files, so the
+    model code is not imported by workers that only map the snapshot)
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(importlib.util.find_spec(module).origin, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def snapshot_fingerprint(**settings) -> str:
+    """
+    Hash of the size and modification time of the sources, of the code
+    that builds the data and of the settings it is built with
+    """
+    sources = dict()
+    for file_loc in snapshot_sources():
+        if os.path.isfile(file_loc):
+            stat = os.stat(file_loc)
+            sources[file_loc] = [stat.st_size, stat.st_mtime_ns]
+
+    description = {
+        'version': SNAPSHOT_VERSION,
+        'sources': sources,
+        'code': code_hash(),
+        'settings': settings,
+    }
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def _align(offset: int) -> int:
+    return offset + (-offset % _ALIGNMENT)
+
+
+def write_snapshot(data: dict, file_loc: str, fingerprint: str):
+    """
+    Writes the snapshot atomically (several workers may build it at once)
+    """
+    buffers = []
+    payload = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+
+    # Offsets are relative to the start of the (aligned) data section
+    offsets = []
+    offset = len(payload)
+    for raw in raws:
+        offset = _align(offset)
+        offsets.append([offset, raw.nbytes])
+        offset += raw.nbytes
+
+    header = json.dumps({
+        'fingerprint': fingerprint,
+        'pickle_length': len(payload),
+        'buffers': offsets,
+    }).encode()
+    data_start = _align(8 + len(header))
+
+    os.makedirs(os.path.dirname(file_loc) or '.', exist_ok=True)
+    tmp_loc = f"{file_loc}.{os.getpid()}.tmp"
+    with open(tmp_loc, 'wb') as file:
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+        file.write(b'\0' * (data_start - file.tell()))
+        file.write(payload)
+        for raw, (offset, _) in zip(raws, offsets):
+            file.write(b'\0' * (data_start + offset - file.tell()))
+            file.write(raw)
+    os.replace(tmp_loc, file_loc)
+
+
+def read_snapshot(file_loc: str, fingerprint: str) -> dict | None:
+    """
+    Maps the snapshot in memory and unpickles it (arrays are read-only
+    views of the file). None when missing, built from other sources or
+    unreadable (truncated, corrupt)
+    """
+    if not os.path.isfile(file_loc) or os.path.getsize(file_loc) < 8:
+        return None
+
+    with open(file_loc, 'rb') as file:
+        snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        view = memoryview(snapshot)
+        header_length = int.from_bytes(view[:8], 'little')
+        header = json.loads(bytes(view[8:8 + header_length]))
+        if header['fingerprint'] != fingerprint:
+            logging.info(f"{file_loc} is out of date")
+            return None
+
+        data = view[_align(8 + header_length):]
+        buffers = [data[offset:offset + length] for offset, length in header['buffers']]
+        if any(len(buffer) != length for buffer, (_, length) in zip(buffers, header['buffers'])):
+            raise ValueError("truncated buffers")
+
+        return pickle.loads(data[:header['pickle_length']], buffers=buffers)
+
+    except (ValueError, KeyError, TypeError, EOFError, pickle.UnpicklingError) as e:
+        logging.warning(f"{file_loc} is unreadable ({type(e).__name__}), rebuilding it")
+        return None
+
+
+def build_app_data(
+        boroughs: list,
+        graph_types: list,
+        initial_year: int
+) -> dict:
+    """
+    Builds the data for the first render, logging the time of each component
+    """
+    # The model is only unpickled here, app workers reading a snapshot
+    # never import it for the first render
+    from prediction import PredictionService
+    from what_if import FIXED_FEATURES
+
+    with log_time("model input and predictions"):
+        prediction_service = PredictionService()
+        summary_market_value = get_model_input_df(prediction_service=prediction_service)
+
+    with log_time("geojson"):
+        geo_zip_data = get_geo_json_zips()
+        geo_zip_key_data = get_borough_geo_zips(geo_zip_data)
+        zip_dict = get_borough_zips(geo_zip_key_data)
+        borough_geo_data = get_borough_geo_json(geo_zip_data, zip_dict)
+
+    with log_time("base figures"):
+        with timer(FIGURE_BUILD_SECONDS, stage="filter"):
+            borough_dfs = get_borough_dfs(summary_market_value, boroughs, initial_year)
+        figure_cache = get_figure_cache(
+            borough_dfs,
+            borough_geo_data,
+            graph_types,
+            initial_year
+        )
+
+    return {
+        'summary_market_value': summary_market_value,
+        'zip_dict': zip_dict,
+        'figure_cache': figure_cache,
+        'what_if_features': [f for f in prediction_service.features if f not in FIXED_FEATURES],
+    }
+
+
+def get_borough_dfs(summary_market_value, boroughs: list, year: int) -> dict:
+    """
+    {borough: {column: array}} of a year (views of the store)
+    """
+    return {
+        borough: summary_market_value.get(year, borough)
+        for borough in boroughs
+    }
+
+
+def load_app_data(
+        boroughs: list,
+        graph_types: list,
+        initial_year: int,
+        file_loc: str = cfg['snapshot file'],
+        rebuild: bool = False
+) -> dict:
+    """
+    Loads the snapshot when it matches the sources, otherwise builds the
+    data and writes the snapshot for the next workers
+
+    rebuild: build and write the snapshot even when it is up to date
+    """
+    fingerprint = snapshot_fingerprint(
+        boroughs=boroughs,
+        graph_types=graph_types,
+        initial_year=initial_year
+    )
+
+    data = None
+    if not rebuild:
+        with log_time("snapshot"):
+            data = read_snapshot(file_loc, fingerprint)
+
+    if data is None:
+        data = build_app_data(boroughs, graph_types, initial_year)
+        # The build may write cached sources (e.g. the zip adjacency)
+        fingerprint = snapshot_fingerprint(
+            boroughs=boroughs,
+            graph_types=graph_types,
+            initial_year=initial_year
+        )
+        with log_time("snapshot written"):
+            write_snapshot(data, file_loc, fingerprint)
+
+    return data
+
@@ -0,0 +1,187 @@
+"""
+Dense cube of arrest counts with dimensions (year, month, zip, law category)
+
+The axes are integer coded:
+  - year: consecutive years years[0]..years[-1], so a range of years is a slice
+  - month: 0 when the source only has yearly counts, 1-12 otherwise
+  - zip: position in `zips` (see zip_index)
+  - law: position in LAW_CATEGORIES
+
+Both processed export schemas are normalized when ingested:
+  - wide: arrest_year, zip, F, I, M, V
+  - long: ARREST_YEAR, zip, LAW_CAT_CD, count (optionally ARREST_MONTH)
+"""
+import glob
+import logging
+
+import numpy as np
+import pandas as pd
+
+from config import config as cfg
+
+LAW_CATEGORIES = list(cfg["arrest_types"])  # F, M, V, I
+N_MONTHS = 13  # 0 = month unknown, 1-12
+
+# Codes used for "Other" in the source data
+LAW_CATEGORY_ALIASES = {'9': 'I'}
+
+
+class ArrestCube:
+    """
+    Arrest counts as an int32 array of shape (years, 13 months, zips, laws)
+    """
+
+    def __init__(
+            self,
+            counts: np.ndarray,
+            years: np.ndarray,
+            zips: np.ndarray
+    ):
+        self.counts = counts
+        self.years = years
+        self.zips = zips
+        self.laws = np.array(LAW_CATEGORIES)
+        self.zip_index = {z: i for i, z in enumerate(zips)}
+        self.law_index = {law: i for i, law in enumerate(LAW_CATEGORIES)}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "ArrestCube":
+        """
+        Builds the cube from normalized counts
+        (columns year, month, zip, law_cat_cd, count - see normalize_arrest_counts)
+        """
+        years = np.arange(df['year'].min(), df['year'].max() + 1)
+        zips = np.array(sorted(df['zip'].unique()))
+
+        year_code = (df['year'] - years[0]).to_numpy()
+        zip_code = np.searchsorted(zips, df['zip'].to_numpy())
+        law_code = df['law_cat_cd'].map({law: i for i, law in enumerate(LAW_CATEGORIES)}).to_numpy()
+
+        counts = np.zeros((len(years), N_MONTHS, len(zips), len(LAW_CATEGORIES)), dtype=np.int32)
+        np.add.at(
+            counts,
+            (year_code, df['month'].to_numpy(), zip_code, law_code),
+            df['count'].to_numpy()
+        )
+
+        return cls(counts, years, zips)
+
+    def save(self, file_loc: str):
+        np.savez(file_loc, counts=self.counts, years=self.years, zips=self.zips)
+
+    @classmethod
+    def load(cls, file_loc: str) -> "ArrestCube":
+        with np.load(file_loc) as cube:
+            return cls(cube['counts'], cube['years'], cube['zips'])
+
+    def _year_slice(self, start_year: int | None, end_year: int | None) -> slice:
+        start = 0 if start_year is None else max(start_year - self.years[0], 0)
+        stop = len(self.years) if end_year is None else max(end_year - self.years[0] + 1, 0)
+        return slice(start, stop)
+
+    def slice(
+            self,
+            start_year: int | None = None,
+            end_year: int | None = None,
+            zips: list | None = None,
+            laws: list | None = None,
+            months: list | None = None
+    ) -> np.ndarray:
+        """
+        Counts for a range of years (inclusive) and optional sets of
+        zipcodes, law categories and months
+
+        output:
+          - array of shape (years, months, zips, laws) - a view when only the
+            years are restricted. Zipcodes missing from the cube are skipped
+        """
+        counts = self.counts[self._year_slice(start_year, end_year)]
+        if months is not None:
+            counts = counts[:, months]
+        if zips is not None:
+            counts = counts[:, :, [self.zip_index[z] for z in zips if z in self.zip_index]]
+        if laws is not None:
+            counts = counts[..., [self.law_index[law] for law in laws]]
+
+        return counts
+
+    def totals_by_zip(
+            self,
+            start_year: int | None = None,
+            end_year: int | None = None,
+            laws: list | None = None
+    ) -> pd.DataFrame:
+        """
+        Arrests per zipcode (rows) and law category (columns) summed over
+        a range of years, in the layout of the wide export
+        """
+        counts = self.slice(start_year, end_year, laws=laws).sum(axis=(0, 1))
+        columns = self.laws if laws is None else laws
+
+        return pd.DataFrame(counts, index=pd.Index(self.zips, name='zip'), columns=columns)
+
+
+def normalize_arrest_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normalizes a processed arrest export (wide or long schema) to the
+    columns year, month, zip, law_cat_cd, count
+    """
+    df = df.rename(columns={h: h.lower() for h in df.columns})
+    df = df.drop(columns=[h for h in df.columns if h.startswith('unnamed')])
+
+    if 'law_cat_cd' not in df.columns:
+        # Wide: one column per law category
+        laws = [h for h in df.columns if h.upper() in LAW_CATEGORIES or h in LAW_CATEGORY_ALIASES]
+        df = df.melt(
+            id_vars=[h for h in df.columns if h not in laws],
+            value_vars=laws,
+            var_name='law_cat_cd',
+            value_name='count'
+        )
+
+    law = df['law_cat_cd'].astype(str).str.upper().replace(LAW_CATEGORY_ALIASES)
+    month = 0
+    if 'arrest_month' in df.columns:
+        month = pd.PeriodIndex(df['arrest_month'].astype(str), freq='M').month
+
+    normalized = pd.DataFrame({
+        'year': df['arrest_year'].astype(str).str[:4].astype(int),
+        'month': month,
+        'zip': df['zip'].astype(float).astype(int).astype(str),
+        'law_cat_cd': law.where(law.isin(LAW_CATEGORIES), 'I'),
+        'count': df['count'].fillna(0).astype(np.int64),
+    })
+
+    return (normalized
+            .groupby(['year', 'month', 'zip', 'law_cat_cd'], as_index=False)['count']
+            .sum()
+            )
+
+
+def build_arrest_cube(file_locs: list) -> ArrestCube:
+    """
+    Builds the cube from several processed exports
+
+    Each year is taken from the first file that has it, so overlapping
+    exports are not counted twice
+    """
+    frames = []
+    seen_years = set()
+    for file_loc in file_locs:
+        df = normalize_arrest_counts(pd.read_csv(file_loc))
+        overlap = seen_years & set(df['year'])
+        if overlap:
+            logging.info(f"{file_loc}: years {sorted(overlap)} already loaded, skipped")
+            df = df.loc[~df['year'].isin(overlap)]
+        seen_years |= set(df['year'])
+        frames.append(df)
+
+    return ArrestCube.from_frame(pd.concat(frames, ignore_index=True))
+
+
+if __name__ == "__main__":
+    cube = build_arrest_cube(
+        sorted(glob.glob("data/processed/arrests_outside_buffer_by_zip_*.csv"))
+    )
+    cube.save("data/processed/arrest_cube.npz")
+    print(f"Arrest cube {cube.counts.shape} for {cube.years[0]}-{cube.years[-1]}")
@@ -0,0 +1,168 @@
+"""
+Memoization of the Dash callbacks
+
+flask_caching's memoize keys on the raw arguments, so it misses whenever
+the zipcode list comes in another order, and it cannot see what triggered
+the callback (dash.callback_context) although the output depends on it.
+Here the callback computes a normalized key itself - e.g. borough, graph
+type, trigger kind and the sorted zipcodes - and the results are kept in
+an in-process LRU bounded by their (estimated) encoded size. A shared
+store (the flask_caching filesystem cache) can back it, so gunicorn
+workers on the same host reuse each other's results.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import jsonify
+
+from config import config as cfg
+from serialization import encoded_size
+
+
+def normalize(value):
+    """
+    Hashable form of a callback argument - lists and sets of values (e.g.
+    zipcodes) are sorted, so their order does not matter
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(sorted((normalize(v) for v in value), key=repr))
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+    return value
+
+
+class CallbackCache:
+    """
+    LRU of callback results bounded by bytes
+
+      - max_bytes: total encoded size of the results kept
+      - shared: optional flask_caching.Cache used on local misses
+      - hits, shared_hits, misses, evictions: counters (see stats)
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = cfg['callback cache bytes'],
+            shared=None,
+            timeout: int = cfg['timeout']
+    ):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.timeout = timeout
+        self._entries = OrderedDict()  # key: (value, size)
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _shared_key(key) -> str:
+        return 'callback:' + hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        (True, value) when cached, (False, None) otherwise
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+
+        if self.shared is not None:
+            value = self.shared.get(self._shared_key(key))
+            if value is not None:
+                self._put(key, value)
+                with self._lock:
+                    self.shared_hits += 1
+                return True, value
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _put(self, key, value):
+        # The encoded size is what the result costs in a response, and an
+        # upper bound of its memory (the geojson fragments are shared).
+        # It is estimated - Dash encodes the response itself
+        size = encoded_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def set(self, key, value):
+        self._put(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(self._shared_key(key), value, timeout=self.timeout)
+            except Exception:
+                logging.exception("Could not write to the shared callback cache")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def memoize(self, key_func=None):
+        """
+        Decorator - key_func(*args, **kwargs) gives the key of a call
+        (by default the normalized arguments). The function name is part
+        of the key
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                parts = key_func(*args, **kwargs) if key_func is not None else (args, kwargs)
+                key = (func.__qualname__, normalize(parts))
+
+                found, value = self.get(key)
+                if found:
+                    return value
+
+                value = func(*args, **kwargs)
+                self.set(key, value)
+                return value
+
+            return wrapper
+
+        return decorator
+
+
+def register_cache_stats_route(
+        server,
+        callback_cache: CallbackCache,
+        route: str = '/api/callback-cache'
+):
+    """
+    Adds an endpoint returning the counters of the callback cache
+    """
+    def cache_stats():
+        return jsonify(callback_cache.stats())
+
+    server.add_url_rule(route, 'callback_cache_stats', cache_stats, methods=['GET'])
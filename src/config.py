@@ -23,9 +23,19 @@ config = {
 
     "topN": 50,
 
+    # Supervised model (src/prediction.py)
+    "model_file": "model/supervised_model.pkl",
+    "prediction cache size": 1_000_000,  # feature rows kept in memory
+    "predict max rows": 100_000,  # per request to /api/predict
+    "what-if max scenarios": 10_000,  # per request to /api/what-if
+
     "timeout": 5 * 60,  # used as part of flask_caching
     "cache threshold": 10_000,  # Corresponds to ~350 MB max
 
+    # Callback results (src/callback_cache.py)
+    "callback cache bytes": 64 * 1024 ** 2,  # encoded size kept per worker
+    "callback cache shared": False,  # also use the filesystem cache (shared by the workers)
+
     "cluster_colors": {"Cluster 1": "#3588d1", 
                        "Cluster 2": "#96da31",
                        "Cluster 3": "#4b3596",
@@ -45,6 +55,7 @@ config = {
     },
 
     "boroughs_lookup": {
+        'Staten': 'Staten Island',
         'Staten Island': 'Staten Island',
         'Bronx': 'Bronx',
         'Queens': 'Queens',
@@ -52,6 +63,52 @@ config = {
         'Brooklyn': 'Brooklyn'
     },
 
+    # Prepared borough geojson (src/process/process_geometry.py)
+    # tolerances are in degrees - the figure picks the coarsest one that
+    # stays under half a pixel at the borough's zoom
+    "geo_dir": "data/processed/geo",
+    "geo_tolerances": [0.0, 0.0001, 0.0005, 0.001],
+    "geo_precision": 5,  # decimals kept on coordinates (~1 m)
+
+    # Prebuilt app data (src/app_data.py)
+    "snapshot file": "data/processed/app_snapshot.bin",
+
+    # Point density layers of the map (src/hexbin.py)
+    "hexbin zooms": [9, 14],  # one precomputed grid per zoom level
+    "hexbin pixels": 24,  # width of a hexagon on screen
+    "hexbin viewport": [1200, 700],  # map size (px) assumed before it is moved
+    "hexbin layers": {
+        "Arrests": {
+            "sources": ["data/processed/arrests_outside_buffer_[0-9]*.csv"],
+            "category": "law_cat_cd",
+            "aliases": {"F": "Felony", "M": "Misdemeanor", "V": "Violation", "I": "Other", "9": "Other"},
+            "file": "data/processed/hexbin_arrests.npz",
+        },
+        "Facilities": {
+            "sources": ["data/raw/public_fac.csv"],
+            "category": "facgroup",
+            "file": "data/processed/hexbin_facilities.npz",
+        },
+    },
+
+    # Arrest density heat map, as PNG tiles (src/raster_tiles.py)
+    "raster tiles": {
+        "sources": [  # first available
+            "data/raw/NYPD_Arrests_Data__Historic.csv",
+            "data/processed/arrests_outside_buffer_[0-9]*.csv",
+        ],
+        "points dir": "data/processed/arrest_points",
+        "tile dir": "data/processed/tiles/arrests",
+        "base zoom": 12,  # points sorted by tile at this zoom
+        "zooms": [9, 16],  # zooms the tiles are served for
+        "opacity": 0.7,
+    },
+
+    # Compression of the callback responses (src/serialization.py)
+    "compress min size": 1_400,  # bytes, ~ one network packet
+    "gzip level": 6,
+    "brotli quality": 5,
+
     "plotly_config": {
         "Staten Island": {
             "center": [40.579, -74.151],
@@ -3,4 +3,5 @@ nyc_ARREST = "https://data.cityofnewyork.us/resource/uip8-fykc.json"
 nyc_PUMA = "https://data.cityofnewyork.us/resource/pikk-p9nv.json"
 nyc_DOG = "https://data.cityofnewyork.us/resource/rsgh-akpg.json"  # 29k rows
 nyc_RNOPV = "https://data.cityofnewyork.us/resource/8vgb-zm6e.json" # 27.3k rows
-nyc_HIST_ARREST = "https://data.cityofnewyork.us/resource/8h9b-rp9u.json" #!! 5.7 MM
\ No newline at end of file
+nyc_HIST_ARREST = "https://data.cityofnewyork.us/resource/8h9b-rp9u.json" #!! 5.7 MM
+nyc_FACILITIES = "https://data.cityofnewyork.us/resource/ji82-xba5.json"  # 35.4k rows
@@ -1,14 +1,23 @@
+import time
+
 import pandas as pd
 import numpy as np
 import plotly.graph_objs as go
-import plotly.express as px
+from dash import Patch
 
-from plotly.subplots import make_subplots
 from config import config as cfg
+from metrics import FIGURE_BUILD_SECONDS, timer
+from serialization import JSONFragment
 
+# Attributes of the choropleth trace that depend on the graph type - the
+# geojson, the locations and the layout only depend on the borough
+GTYPE_TRACE_KEYS = ("z", "text", "zmin", "zmax", "colorscale", "colorbar")
 
 
 def get_scattergeo(df):
+    # plotly.express is slow to import and only used here
+    import plotly.express as px
+
     fig = go.Figure()
     fig.add_trace(
         px.scatter_map(
@@ -26,6 +35,49 @@ def get_scattergeo(df):
     return fig
 
 
+def pick_geo_json(
+    geo_payloads,
+    borough
+):
+    """
+    Picks the prepared geojson of the borough with the coarsest
+    simplification that stays under half a pixel at the borough's zoom
+
+    geo_payloads: {borough: {tolerance: FeatureCollection}}
+    """
+    # Degrees covered by one pixel on 512px map tiles
+    degrees_per_pixel = 360 / (512 * 2 ** cfg["plotly_config"][borough]["zoom"])
+    tolerances = [
+        t for t in geo_payloads[borough]
+        if t <= degrees_per_pixel / 2
+    ]
+
+    return geo_payloads[borough][max(tolerances)]
+
+
+def get_raster_layer(
+    url_template: str,
+    opacity: float = cfg["raster tiles"]["opacity"],
+    zooms: list = cfg["raster tiles"]["zooms"]
+) -> dict:
+    """
+    Map layer of image tiles, e.g. the arrest density served by
+    raster_tiles.register_tile_route (set as layout.map.layers by the
+    clientside highlight, so the cached base figures are not rebuilt)
+
+    url_template: absolute url with {z}/{x}/{y}
+    zooms: zoom levels the tiles exist for (hidden outside)
+    """
+    return {
+        "sourcetype": "raster",
+        "source": [url_template],
+        "below": "traces",
+        "opacity": opacity,
+        "minzoom": zooms[0],
+        "maxzoom": zooms[1] + 1,
+    }
+
+
 def get_Choropleth(
     df,
     geo_data,
@@ -61,22 +113,28 @@ def get_Choropleth(
 
 
 def get_figure(
-        df,
+        df: dict,
         geo_data,
         borough,
         gtype,
         year,
         geo_sectors
 ):
-    """ref: https://plotly.com/python/builtin-colorscales/"""
+    """
+    df: {column: array} of the zipcodes to show (see utils.ModelInputStore)
+
+    ref: https://plotly.com/python/builtin-colorscales/
+    """
     config = {"doubleClickDelay": 1000}  # set a high delay to make this easier
 
     _cfg = cfg["plotly_config"][borough]
 
+    # Color scale and values of the graph type
+    start = time.perf_counter()
     arg = dict()
     if gtype == "Market Value":
-        arg["min_value"] = np.percentile(np.array(df.revised_market_value), 5)
-        arg["max_value"] = np.percentile(np.array(df.revised_market_value), _cfg["maxp"])
+        arg["min_value"] = np.percentile(np.array(df["revised_market_value"]), 5)
+        arg["max_value"] = np.percentile(np.array(df["revised_market_value"]), _cfg["maxp"])
         arg["z_vec"] = df["revised_market_value"]
         arg["text_vec"] = df["revised_market_value"] #TODO: Revise
         arg["colorscale"] = "YlOrRd"
@@ -89,14 +147,38 @@ def get_figure(
         _colors = dict(list(cfg['cluster_colors'].items())[:max_clusters])
 
         # Visualize
-        arg["min_value"] = np.percentile(np.array(df.Cluster), 5)
-        arg["max_value"] = np.percentile(np.array(df.Cluster), 95)
+        arg["min_value"] = np.percentile(np.array(df["Cluster"]), 5)
+        arg["max_value"] = np.percentile(np.array(df["Cluster"]), 95)
         arg["z_vec"] = df["Cluster"].astype(str)
-        arg["text_vec"] = df[["cluster_name"]] #TODO: Revise
+        arg["text_vec"] = df["cluster_name"] #TODO: Revise
         arg["colorscale"] = 'Plasma'
         arg['viz_type'] = 'categorical'
         arg["title"] = "Public Facility Grouping"
 
+    elif gtype == "Model Error":
+        # Symmetric range so no error is white
+        error = np.array(df["model_error"], dtype=float)
+        max_error = np.nanpercentile(np.abs(error), _cfg["maxp"]) if np.isfinite(error).any() else 1
+        arg["min_value"] = -max_error
+        arg["max_value"] = max_error
+        arg["z_vec"] = df["model_error"]
+        arg["text_vec"] = df["model_error"]
+        arg["colorscale"] = "RdBu_r"
+        arg['viz_type'] = 'continuous'
+        arg["title"] = "Predicted - Revised Market Value ($)"
+
+    elif gtype == "What-If":
+        # Predicted values - scenarios replace the values of the changed
+        # zipcodes (see what_if.WhatIfEngine.figure)
+        predicted = np.array(df["predicted_market_value"], dtype=float)
+        arg["min_value"] = np.nanpercentile(predicted, 5)
+        arg["max_value"] = np.nanpercentile(predicted, _cfg["maxp"])
+        arg["z_vec"] = predicted
+        arg["text_vec"] = [f"{z}: {p:,.0f}" for z, p in zip(df["zip"], predicted)]
+        arg["colorscale"] = "YlOrRd"
+        arg['viz_type'] = 'continuous'
+        arg["title"] = "Predicted Market Value ($)"
+
     else:
         arg["min_value"] = np.percentile(np.array(df["felony_arrest_count"]), 10)
         arg["max_value"] = np.percentile(np.array(df["felony_arrest_count"]), 90)
@@ -106,8 +188,11 @@ def get_figure(
         arg['viz_type'] = 'continuous'
         arg["title"] = "Count of Arrests 1000' Away from Public Facility"
 
+    FIGURE_BUILD_SECONDS.observe(time.perf_counter() - start, stage="scale")
+
     # ----------------------------------------- #
     # Main Choropleth:
+    start = time.perf_counter()
     fig = get_Choropleth(
         df,
         geo_data,
@@ -153,5 +238,63 @@ def get_figure(
             marker_line_color="aqua",
             fig=fig,
         )
+    FIGURE_BUILD_SECONDS.observe(time.perf_counter() - start, stage="trace")
+
+    return fig
+
+
+def get_figure_cache(
+        borough_dfs: dict,
+        geo_payloads: dict,
+        gtypes: list,
+        year
+) -> dict:
+    """
+    Builds the base figure (no highlighted zipcodes) for every
+    borough x graph type combination once
+
+    inputs:
+      - borough_dfs: {borough: {column: array} of that borough}
+      - geo_payloads: prepared geojson per borough and tolerance
+        (see utils.get_borough_geo_json)
+      - gtypes: list of graph types offered in the app
+
+    output:
+      - {(borough, gtype): figure as a plain dictionary}
+
+    The geojson is attached after the figure is built so plotly does not
+    validate it for every figure. It is encoded once per borough
+    (serialization.JSONFragment) and shared by all its figures
+    """
+    figure_cache = dict()
+    for borough, df in borough_dfs.items():
+        with timer(FIGURE_BUILD_SECONDS, stage="serialize"):
+            geo_data = JSONFragment(pick_geo_json(geo_payloads, borough))
+        for gtype in gtypes:
+            fig = get_figure(df, None, borough, gtype, year, None)
+            with timer(FIGURE_BUILD_SECONDS, stage="serialize"):
+                fig = fig.to_dict()
+            fig["data"][0]["geojson"] = geo_data
+            figure_cache[(borough, gtype)] = fig
+
+    return figure_cache
+
+
+def get_figure_patch(
+        figure: dict,
+        keys: tuple = GTYPE_TRACE_KEYS
+) -> Patch:
+    """
+    Partial update turning the figure of another graph type (or scenario)
+    of the same borough into `figure`
+
+    Only the trace attributes in `keys` are sent to the browser, not the
+    geojson and the locations
+    """
+    patch = Patch()
+    trace = figure["data"][0]
+    for key in keys:
+        if key in trace:
+            patch["data"][0][key] = trace[key]
 
-    return fig
\ No newline at end of file
+    return patch
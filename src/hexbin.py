@@ -0,0 +1,364 @@
+"""
+Hexagonal binning of point data (arrests, public facilities) for the map
+
+Plotting the points themselves would send every arrest to the browser.
+Instead the points are counted in a grid of pointy-top hexagons whose
+size on screen is constant ("hexbin pixels"), so there is one grid per
+map zoom level. The counts of every zoom level are precomputed as dense
+arrays (rows x columns x category) in offset coordinates: the hexagons
+in view are a rectangular slice of the array, so a pan or a zoom costs
+an array slice and the geojson of the non-empty hexagons in view.
+
+Coordinates are planar around NYC: x = (lon - lon0) * cos(lat0),
+y = lat - lat0 (the distortion over the city is negligible).
+
+    python src/hexbin.py  # writes the layers in "hexbin layers"
+"""
+import glob
+import logging
+
+import numpy as np
+import pandas as pd
+
+from config import config as cfg
+
+SQRT3 = np.sqrt(3)
+# Origin of the planar coordinates (south-west of NYC)
+ORIGIN = (-74.27, 40.48)
+# Vertices of a pointy-top hexagon of circumradius 1
+_CORNERS = np.array([
+    [np.cos(np.radians(30 + 60 * i)), np.sin(np.radians(30 + 60 * i))]
+    for i in range(7)
+])
+
+
+def degrees_per_pixel(zoom: float) -> float:
+    # 512px map tiles, as figures_utils.pick_geo_json
+    return 360 / (512 * 2 ** zoom)
+
+
+class HexBinLayer:
+    """
+    Counts of points per hexagon and category, for every zoom level
+
+      - zooms: integer zoom levels with a grid
+      - categories: names of the breakdown (e.g. law_cat_cd)
+      - counts: {zoom: uint32 array (rows, columns, categories)}
+      - hex_pixels: width of a hexagon on screen
+    """
+
+    def __init__(
+            self,
+            zooms: np.ndarray,
+            categories: np.ndarray,
+            counts: dict,
+            hex_pixels: float = cfg['hexbin pixels'],
+            origin: tuple = ORIGIN
+    ):
+        self.zooms = np.asarray(zooms)
+        self.categories = np.asarray(categories)
+        self.counts = counts
+        self.hex_pixels = hex_pixels
+        self.origin = origin
+        self.cos_lat = np.cos(np.radians(origin[1]))
+
+    def hex_size(self, zoom: int) -> float:
+        """
+        Circumradius of the hexagons of a zoom level (planar degrees)
+        """
+        return self.hex_pixels * degrees_per_pixel(zoom) * self.cos_lat / SQRT3
+
+    def _planar(self, longitude, latitude) -> tuple:
+        x = (np.asarray(longitude, dtype=float) - self.origin[0]) * self.cos_lat
+        y = np.asarray(latitude, dtype=float) - self.origin[1]
+        return x, y
+
+    def _offset_coords(self, x: np.ndarray, y: np.ndarray, size: float) -> tuple:
+        """
+        (row, column) of the hexagon containing each planar point
+        """
+        # Fractional axial coordinates, rounded in cube coordinates
+        q = (SQRT3 / 3 * x - y / 3) / size
+        r = (2 / 3 * y) / size
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+
+        row = rr.astype(np.int64)
+        column = rq.astype(np.int64) + (row - (row & 1)) // 2
+
+        return row, column
+
+    def _centers(self, row: np.ndarray, column: np.ndarray, size: float) -> tuple:
+        q = column - (row - (row & 1)) // 2
+        x = size * (SQRT3 * q + SQRT3 / 2 * row)
+        y = size * 1.5 * row
+        return x, y
+
+    @classmethod
+    def from_points(
+            cls,
+            longitude,
+            latitude,
+            category=None,
+            zooms: list = cfg['hexbin zooms'],
+            hex_pixels: float = cfg['hexbin pixels']
+    ) -> "HexBinLayer":
+        """
+        Counts the points at every zoom level
+
+        category: label of each point for the breakdown (optional)
+        """
+        longitude = np.asarray(longitude, dtype=float)
+        latitude = np.asarray(latitude, dtype=float)
+        keep = np.isfinite(longitude) & np.isfinite(latitude)
+        if category is None:
+            codes, categories = np.zeros(len(longitude), dtype=np.int64), np.array(['all'])
+        else:
+            codes, categories = pd.factorize(pd.Series(category).fillna('unknown'), sort=True)
+            categories = np.asarray(categories, dtype=str)
+
+        layer = cls(np.arange(zooms[0], zooms[1] + 1), categories, dict(), hex_pixels)
+        x, y = layer._planar(longitude[keep], latitude[keep])
+        codes = codes[keep]
+        # The grid starts at the origin, points west / south of it are dropped
+        inside = (x >= 0) & (y >= 0)
+        x, y, codes = x[inside], y[inside], codes[inside]
+        if (~inside).any():
+            logging.warning(f"{(~inside).sum()} points outside the hexbin grid")
+
+        n_categories = len(categories)
+        for zoom in layer.zooms:
+            row, column = layer._offset_coords(x, y, layer.hex_size(zoom))
+            n_rows, n_columns = row.max(initial=0) + 2, column.max(initial=0) + 2
+            # Rounding can give -1 on the origin's edges
+            row, column = row + 1, column + 1
+            flat = (row * n_columns + column) * n_categories + codes
+            layer.counts[int(zoom)] = np.bincount(
+                flat, minlength=n_rows * n_columns * n_categories
+            ).astype(np.uint32).reshape(n_rows, n_columns, n_categories)
+
+        return layer
+
+    def save(self, file_loc: str):
+        np.savez(
+            file_loc,
+            zooms=self.zooms,
+            categories=self.categories,
+            hex_pixels=self.hex_pixels,
+            origin=np.array(self.origin),
+            **{f"counts_{zoom}": counts for zoom, counts in self.counts.items()}
+        )
+
+    @classmethod
+    def load(cls, file_loc: str) -> "HexBinLayer":
+        with np.load(file_loc) as layer:
+            return cls(
+                layer['zooms'],
+                layer['categories'],
+                {int(zoom): layer[f"counts_{zoom}"] for zoom in layer['zooms']},
+                float(layer['hex_pixels']),
+                tuple(layer['origin'])
+            )
+
+    def resolution(self, zoom: float) -> int:
+        """
+        Zoom level of the grid used for a map zoom
+        """
+        return int(np.clip(np.floor(zoom), self.zooms[0], self.zooms[-1]))
+
+    def query(
+            self,
+            zoom: float,
+            bounds: tuple
+    ) -> tuple:
+        """
+        Non-empty hexagons in a view
+
+        bounds: (west, south, east, north) in lon/lat
+        output: zoom level of the grid, rows, columns, counts (n, categories)
+        """
+        level = self.resolution(zoom)
+        counts = self.counts[level]
+        size = self.hex_size(level)
+
+        west, south = self._planar(bounds[0], bounds[1])
+        east, north = self._planar(bounds[2], bounds[3])
+        # One hexagon of margin, rows are 1.5 size apart and columns sqrt(3) size
+        row_0 = int(np.clip(np.floor(south / (1.5 * size)), 0, counts.shape[0]))
+        row_1 = int(np.clip(np.ceil(north / (1.5 * size)) + 2, 0, counts.shape[0]))
+        column_0 = int(np.clip(np.floor(west / (SQRT3 * size)), 0, counts.shape[1]))
+        column_1 = int(np.clip(np.ceil(east / (SQRT3 * size)) + 2, 0, counts.shape[1]))
+
+        view = counts[row_0:row_1, column_0:column_1]
+        row, column = np.nonzero(view.sum(axis=2))
+
+        return level, row + row_0, column + column_0, view[row, column]
+
+    def geojson(self, level: int, row: np.ndarray, column: np.ndarray) -> dict:
+        """
+        Polygons of hexagons, with their "row:column" as id
+        """
+        size = self.hex_size(level)
+        # Counts are stored one row and one column after the grid origin
+        x, y = self._centers(row - 1, column - 1, size)
+        lon = (x[:, None] + size * _CORNERS[None, :, 0]) / self.cos_lat + self.origin[0]
+        lat = y[:, None] + size * _CORNERS[None, :, 1] + self.origin[1]
+        rings = np.stack([lon, lat], axis=2).round(5).tolist()
+
+        return {
+            'type': 'FeatureCollection',
+            'features': [
+                {
+                    'type': 'Feature',
+                    'id': f"{r}:{c}",
+                    'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+                }
+                for r, c, ring in zip(row.tolist(), column.tolist(), rings)
+            ]
+        }
+
+    def trace(
+            self,
+            zoom: float,
+            bounds: tuple,
+            category: str | None = None,
+            title: str = "Count"
+    ) -> dict | None:
+        """
+        Choroplethmap trace (plain dictionary) of the hexagons in a view
+
+        category: color by the count of one category (all otherwise) - the
+        hover text always shows the breakdown
+        """
+        level, row, column, counts = self.query(zoom, bounds)
+        if not len(row):
+            return None
+
+        if category is not None and category in self.categories:
+            z = counts[:, list(self.categories).index(category)]
+        else:
+            z = counts.sum(axis=1)
+
+        if len(self.categories) > 1:
+            text = [
+                "<br>".join(f"{name}: {n:,}" for name, n in zip(self.categories, cell) if n)
+                for cell in counts.tolist()
+            ]
+        else:
+            text = [f"{n:,}" for n in z.tolist()]
+
+        return {
+            'type': 'choroplethmap',
+            'geojson': self.geojson(level, row, column),
+            'locations': [f"{r}:{c}" for r, c in zip(row.tolist(), column.tolist())],
+            'z': z,
+            'zmin': 0,
+            'zmax': float(np.percentile(z, 99)) if len(z) else 1,
+            'text': text,
+            'hoverinfo': 'text',
+            'colorscale': 'Viridis',
+            'marker': {'opacity': 0.6, 'line': {'width': 0}},
+            'colorbar': {'title': {'text': title}, 'x': 0},
+            'name': 'hexbin',
+        }
+
+
+""" ---------------------------------------------------------------
+LAYERS
+-------------------------------------------------------------------"""
+
+def source_files(patterns: list) -> list:
+    """
+    Existing files matching the patterns ('mirror:<endpoint name>' as is)
+    """
+    return sorted(
+        f for pattern in patterns
+        for f in (glob.glob(pattern) or ([pattern] if pattern.startswith('mirror:') else []))
+    )
+
+
+def read_points(file_loc: str, category_column: str | None = None) -> pd.DataFrame:
+    """
+    latitude, longitude and the category column of a point dataset
+    (csv file, any case, or 'mirror:<endpoint name>')
+    """
+    from process.dataset_mirror import MIRROR_PREFIX, read_source
+
+    columns = ['latitude', 'longitude'] + ([category_column] if category_column else [])
+    if file_loc.startswith(MIRROR_PREFIX):
+        df = read_source(file_loc, columns=columns)
+    else:
+        df = pd.read_csv(file_loc, usecols=lambda c: c.lower() in columns)
+    df.columns = [c.lower() for c in df.columns]
+    for col in ['latitude', 'longitude']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    return df
+
+
+def build_layer(name: str) -> HexBinLayer:
+    """
+    Counts the points of a layer of "hexbin layers" (all its source files)
+    """
+    settings = cfg['hexbin layers'][name]
+    files = source_files(settings['sources'])
+    if not files:
+        raise FileNotFoundError(f"No source for the {name} hexbin layer: {settings['sources']}")
+
+    df = pd.concat([read_points(f, settings['category']) for f in files], ignore_index=True)
+    category = df[settings['category']]
+    category = category.where(category.isna(), category.astype(str)).replace(settings.get('aliases', dict()))
+
+    return HexBinLayer.from_points(df['longitude'], df['latitude'], category)
+
+
+def get_hexbin_layer(name: str) -> HexBinLayer:
+    """
+    Loads the precomputed layer, building (and saving) it when missing
+    """
+    file_loc = cfg['hexbin layers'][name]['file']
+    try:
+        return HexBinLayer.load(file_loc)
+    except FileNotFoundError:
+        layer = build_layer(name)
+        layer.save(file_loc)
+        return layer
+
+
+def view_bounds(relayout_data: dict | None, borough: str) -> tuple:
+    """
+    (zoom, (west, south, east, north)) of the map from its relayoutData,
+    the borough's initial view when the map was not moved
+    """
+    relayout_data = relayout_data or dict()
+    _cfg = cfg["plotly_config"][borough]
+    zoom = relayout_data.get('map.zoom', _cfg['zoom'])
+
+    derived = relayout_data.get('map._derived', dict()).get('coordinates')
+    if derived:
+        lon, lat = np.array(derived).T
+        return zoom, (lon.min(), lat.min(), lon.max(), lat.max())
+
+    center = relayout_data.get('map.center', {'lat': _cfg['center'][0], 'lon': _cfg['center'][1]})
+    width, height = cfg['hexbin viewport']
+    half_lon = width / 2 * degrees_per_pixel(zoom)
+    half_lat = height / 2 * degrees_per_pixel(zoom) * np.cos(np.radians(center['lat']))
+
+    return zoom, (center['lon'] - half_lon, center['lat'] - half_lat,
+                  center['lon'] + half_lon, center['lat'] + half_lat)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for name, settings in cfg['hexbin layers'].items():
+        layer = build_layer(name)
+        layer.save(settings['file'])
+        logging.info(
+            f"{name}: {len(layer.categories)} categories, "
+            f"{sum(c.nbytes for c in layer.counts.values()) / 1e6:.1f} MB -> {settings['file']}"
+        )
@@ -0,0 +1,178 @@
+"""
+Timing instrumentation of the app, exposed in the Prometheus text format
+
+    with timer(FIGURE_BUILD_SECONDS, stage="trace"): ...
+
+    @timed(CALLBACK_SECONDS, callback="update_map_title")
+    def update_map_title(...): ...
+
+Recording a value is a perf_counter call, a bisect in the bucket bounds
+and an increment under a lock, so it stays on in production. Each gunicorn
+worker keeps its own values - /metrics shows the worker that answers.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response
+
+# Seconds - from a cache hit to a full figure build
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def _label_text(labels: tuple) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+
+def _braces(label_text: str) -> str:
+    return f"{{{label_text}}}" if label_text else ""
+
+
+class Histogram:
+    """
+    Cumulative histogram of observations, one series per label set
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._series = dict()  # labels: [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # a count per bucket and above the last one, count, sum
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+
+        for key, values in sorted(series.items()):
+            labels = _label_text(key)
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-2]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{_braces(labels)} {values[-1]}")
+            lines.append(f"{self.name}_count{_braces(labels)} {values[-2]}")
+
+        return lines
+
+
+class Gauge:
+    """
+    Last value set, one series per label set
+    """
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._series = dict()
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._series[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            series = dict(self._series)
+
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_braces(_label_text(key))} {value}")
+
+        return lines
+
+
+CALLBACK_SECONDS = Histogram("dash_callback_seconds", "Time spent in each server callback")
+# Base figures are built once (startup or snapshot build), requests only
+# patch them or apply a what-if scenario
+FIGURE_BUILD_SECONDS = Histogram(
+    "figure_build_seconds",
+    "Time of the base figure build stages (filter, scale, trace, serialize)"
+)
+FIGURE_REQUEST_SECONDS = Histogram(
+    "figure_request_seconds",
+    "Time of the figure work of a request (what_if, patch)"
+)
+RESPONSE_ENCODE_SECONDS = Histogram("dash_response_encode_seconds", "Time to encode a callback response")
+TILE_SECONDS = Histogram("arrest_tile_seconds", "Time to serve a density tile (cache hit or miss)")
+LOAD_SECONDS = Gauge("app_load_seconds", "Time to load each data component at startup or on first use")
+
+
+@contextmanager
+def timer(histogram: Histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator recording the duration of every call
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def render(collectors: tuple = ()) -> str:
+    """
+    Prometheus text of all the metrics
+
+    collectors: functions returning {name: value}, written as gauges
+    (e.g. the counters of the callback cache)
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+
+    for collect in collectors:
+        for name, value in collect().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def register_metrics_route(
+        server,
+        collectors: tuple = (),
+        route: str = '/metrics'
+):
+    """
+    Adds the Prometheus scrape endpoint to the Flask server
+    """
+    def metrics():
+        return Response(render(collectors), mimetype="text/plain; version=0.0.4")
+
+    server.add_url_rule(route, 'metrics', metrics, methods=['GET'])
@@ -0,0 +1,190 @@
+"""
+Batch predictions of the supervised model (model/supervised_model.pkl)
+
+The pipeline (StandardScaler + HuberRegressor) is loaded once per process.
+Predictions are made for a whole frame of feature rows in one call to
+`predict` and cached by a hash of the feature row, so a row already seen
+(e.g. by the app at startup) is never scored again.
+"""
+import logging
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+from flask import jsonify, request
+
+from config import config as cfg
+
+_models = dict()
+_models_lock = threading.Lock()
+
+
+def load_model(file_loc: str = cfg['model_file']):
+    """
+    Returns the fitted pipeline, unpickled the first time only
+    """
+    with _models_lock:
+        if file_loc not in _models:
+            with open(file_loc, 'rb') as file:
+                _models[file_loc] = pickle.load(file)
+            logging.info(f"Model loaded from {file_loc}")
+
+    return _models[file_loc]
+
+
+def add_neighbor_average(
+        df: pd.DataFrame,
+        zip_adjacency=None
+) -> pd.DataFrame:
+    """
+    Adds the `neighbor_average` feature: the mean revised market value of
+    the adjacent zipcodes, over all the rows of df (every year, and rows
+    without a year), as when the model was trained
+    """
+    if zip_adjacency is None:
+        # geopandas is only needed to build the graph, not to serve
+        from process.zip_adjacency import get_zip_adjacency
+        zip_adjacency = get_zip_adjacency()
+
+    lag = zip_adjacency.spatial_lag(df, ['revised_market_value'])
+    df = df.copy()
+    df['neighbor_average'] = lag['revised_market_value_neighbor_average']
+
+    return df
+
+
+class PredictionService:
+    """
+    Scores feature rows with the supervised model
+
+      - features: feature columns expected by the model, in order
+      - predict(df): one vectorized predict for the rows not cached yet
+    """
+
+    def __init__(
+            self,
+            model_file: str = cfg['model_file'],
+            cache_size: int = cfg['prediction cache size']
+    ):
+        self.model = load_model(model_file)
+        self.features = list(self.model.feature_names_in_)
+        self.cache_size = cache_size
+        self._cache = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def row_keys(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Hash of each feature row (uint64) - independent of the index and of
+        any column that is not a feature
+        """
+        features = df[self.features].astype(float)
+        return pd.util.hash_pandas_object(features, index=False).to_numpy()
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Predictions for every row of df (NaN for rows with a missing feature)
+
+        df: dataframe with (at least) the feature columns
+        """
+        missing = [col for col in self.features if col not in df.columns]
+        if missing:
+            raise KeyError(f"Missing features: {missing}")
+
+        features = df[self.features].astype(float)
+        complete = features.notna().all(axis=1).to_numpy()
+        keys = self.row_keys(features)
+
+        predictions = np.full(len(df), np.nan)
+        with self._lock:
+            cached = [self._cache.get(key) for key in keys]
+            known = np.array([p is not None for p in cached], dtype=bool)
+            todo = complete & ~known
+            self.hits += int(known.sum())
+            self.misses += int(todo.sum())
+        if known.any():
+            predictions[known] = [p for p in cached if p is not None]
+
+        if not todo.any():
+            return predictions
+
+        # Score each distinct row once
+        todo_keys, first, inverse = np.unique(keys[todo], return_index=True, return_inverse=True)
+        scored = self.model.predict(features.loc[todo].iloc[first])
+        predictions[todo] = scored[inverse]
+
+        with self._lock:
+            if len(self._cache) + len(todo_keys) > self.cache_size:
+                self._cache.clear()
+            self._cache.update(zip(todo_keys.tolist(), scored.tolist()))
+
+        return predictions
+
+    def score_model_input(
+            self,
+            df: pd.DataFrame,
+            zip_adjacency=None
+    ) -> pd.DataFrame:
+        """
+        Adds neighbor_average, predicted_market_value and model_error
+        (predicted - revised market value) to the model input
+        """
+        df = add_neighbor_average(df, zip_adjacency)
+        df['predicted_market_value'] = self.predict(df)
+        df['model_error'] = df['predicted_market_value'] - df['revised_market_value']
+
+        return df
+
+
+def register_prediction_route(
+        server,
+        get_service,
+        route: str = '/api/predict'
+):
+    """
+    Adds the bulk prediction endpoint to the Flask server
+
+    POST a json body in one of the pandas layouts:
+      - {"columns": [...], "data": [[...], ...]} (split, the most compact)
+      - [{"feature": value, ...}, ...] (records)
+    Response: {"predictions": [...]} in the order of the rows (null when
+    a row has a missing feature)
+
+    get_service: returns the PredictionService (called per request, so
+    the model can be loaded on first use)
+    """
+    max_rows = cfg['predict max rows']
+
+    def predict():
+        payload = request.get_json(force=True, silent=True)
+        if isinstance(payload, dict) and 'columns' in payload and 'data' in payload:
+            rows = payload['data']
+        elif isinstance(payload, list):
+            rows = payload
+        else:
+            rows = None
+        if not isinstance(rows, list):
+            return jsonify(error="Expected a json body in the split or records layout"), 400
+
+        # Checked before the frame is built
+        if len(rows) > max_rows:
+            return jsonify(error=f"At most {max_rows} rows per request"), 413
+
+        if rows is payload:
+            df = pd.DataFrame.from_records(rows)
+        else:
+            df = pd.DataFrame(rows, columns=payload['columns'])
+
+        try:
+            predictions = get_service().predict(df)
+        except (KeyError, ValueError) as e:
+            return jsonify(error=str(e.args[0])), 400
+
+        return jsonify(predictions=[
+            None if np.isnan(p) else p
+            for p in predictions.tolist()
+        ])
+
+    server.add_url_rule(route, 'predict', predict, methods=['POST'])
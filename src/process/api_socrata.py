@@ -1,4 +1,15 @@
+import io
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 from sodapy import Socrata
 
 # Initialize our client
@@ -27,3 +38,180 @@ def nyc_api_read(url: str, limit: int=5000):
 
     return df
 
+
+""" ---------------------------------------------------------------
+BULK DOWNLOAD
+-------------------------------------------------------------------"""
+
+# Responses worth retrying (rate limited / server side errors)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_thread_local = threading.local()
+
+
+def _session(app_token: str | None) -> requests.Session:
+    """
+    One requests session per download thread
+    """
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = requests.Session()
+        if app_token:
+            _thread_local.session.headers['X-App-Token'] = app_token
+    return _thread_local.session
+
+
+def _get(
+        url: str,
+        params: dict,
+        app_token: str | None,
+        retries: int,
+        backoff: float,
+        timeout: float
+) -> requests.Response:
+    """
+    GET with retries and exponential backoff on connection errors,
+    timeouts and RETRY_STATUS responses
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = _session(app_token).get(url, params=params, timeout=timeout)
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                return response
+            error = f"HTTP {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = str(e)
+
+        if attempt < retries:
+            wait = backoff * 2 ** attempt
+            logging.warning(f"{url} {params} failed ({error}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+    raise requests.HTTPError(f"{url} {params} failed after {retries + 1} attempts: {error}")
+
+
+def soda_count(
+        url: str,
+        where: str | None = None,
+        app_token: str | None = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 100
+) -> int:
+    """
+    Number of rows of a SODA endpoint (optionally matching `where`)
+    """
+    params = {'$select': 'count(*) as count'}
+    if where:
+        params['$where'] = where
+    response = _get(url, params, app_token, retries, backoff, timeout)
+
+    return int(response.json()[0]['count'])
+
+
+def _read_page(
+        csv_url: str,
+        params: dict,
+        app_token: str | None,
+        retries: int,
+        backoff: float,
+        timeout: float
+) -> pa.Table:
+    """
+    Downloads one page as CSV and returns it as a table of strings, with
+    empty values as nulls (SODA returns every column of the dataset in its
+    CSV pages)
+    """
+    response = _get(csv_url, params, app_token, retries, backoff, timeout)
+    df = pd.read_csv(io.BytesIO(response.content), dtype=str)
+    schema = pa.schema([(col, pa.string()) for col in df.columns])
+
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def nyc_api_bulk_read(
+        url: str,
+        output_loc: str,
+        page_size: int = 50_000,
+        max_workers: int = 4,
+        order: str = ':id',
+        where: str | None = None,
+        select: str | None = None,
+        app_token: str | None = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 100
+) -> int:
+    """
+    Downloads a full SODA dataset into a parquet file
+
+    Pages of `page_size` rows are requested concurrently (at most
+    `max_workers` at a time) with `$order` so the paging is stable, and
+    written to the parquet file in order as they arrive - one row group per
+    page - instead of being collected in memory.
+
+    inputs:
+      - url: SODA endpoint (see data_endpoints.py)
+      - output_loc: parquet file to write
+      - order: $order used for stable paging (':id' is the row identifier)
+      - where, select: optional $where / $select of the query
+      - app_token: Socrata application token (raises the rate limits)
+
+    output:
+      - Number of rows written
+
+    All columns are written as strings, as returned by the CSV pages,
+    with empty values as nulls
+    """
+    csv_url = url.rsplit('.', 1)[0] + '.csv'
+    n_rows = soda_count(url, where, app_token, retries, backoff, timeout)
+
+    def page_params(offset):
+        params = {'$limit': page_size, '$offset': offset, '$order': order}
+        if where:
+            params['$where'] = where
+        if select:
+            params['$select'] = select
+        return params
+
+    offsets = deque(range(0, n_rows, page_size))
+    writer = None
+    n_written = 0
+    # Written next to the output and renamed once complete, so a failed
+    # download never leaves a partial file that looks valid
+    tmp_loc = f"{output_loc}.{os.getpid()}.tmp"
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # Keep a bounded window of pages in flight and write them in order
+        window = deque()
+        while offsets or window:
+            while offsets and len(window) < 2 * max_workers:
+                window.append(executor.submit(
+                    _read_page, csv_url, page_params(offsets.popleft()),
+                    app_token, retries, backoff, timeout
+                ))
+
+            page = window.popleft().result()
+            if writer is None:
+                schema = page.schema
+                writer = pq.ParquetWriter(tmp_loc, schema)
+            writer.write_table(page.select(schema.names))
+            n_written += page.num_rows
+
+        if writer is None:
+            pq.write_table(pa.table({}), tmp_loc)
+        else:
+            writer.close()
+            writer = None
+        os.replace(tmp_loc, output_loc)
+
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_loc):
+            os.remove(tmp_loc)
+
+    logging.info(f"{url}: {n_written} of {n_rows} rows written to {output_loc}")
+
+    return n_written
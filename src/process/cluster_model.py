@@ -0,0 +1,221 @@
+"""
+Persisted facility clustering (scaler stats, PCA components, centroids)
+
+The model fitted by pca_facilities.main is saved so zipcodes whose
+facilities changed can be assigned to a cluster without refitting the
+scaler, the PCA and KMeans. Cluster ids are kept stable between runs:
+after a full refit the new clusters are matched to the previous ones by
+the zipcodes they share (Hungarian matching), so the `cluster_colors` in
+config.py keep meaning the same thing.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+CLUSTER_MODEL_FILE = "data/processed/cluster_model.npz"
+
+
+class ClusterModel:
+    """
+    Maps facility counts per zipcode to a cluster
+
+      - columns: facility groups, in the order of the features
+      - scale_mean, scale_std: StandardScaler statistics
+      - pca_mean, components: PCA of the scaled counts
+      - centroids: KMeans centroids in the PCA space
+      - counts: number of zipcodes behind each centroid (for mini-batch updates)
+      - zips, labels: last known cluster of each zipcode
+    """
+
+    def __init__(
+            self,
+            columns: np.ndarray,
+            scale_mean: np.ndarray,
+            scale_std: np.ndarray,
+            pca_mean: np.ndarray,
+            components: np.ndarray,
+            centroids: np.ndarray,
+            counts: np.ndarray,
+            zips: np.ndarray,
+            labels: np.ndarray
+    ):
+        self.columns = columns
+        self.scale_mean = scale_mean
+        self.scale_std = scale_std
+        self.pca_mean = pca_mean
+        self.components = components
+        self.centroids = centroids
+        self.counts = counts
+        self.zips = zips
+        self.labels = labels
+
+    @classmethod
+    def from_fit(
+            cls,
+            df_counts: pd.DataFrame,
+            pca_loadings: pd.DataFrame,
+            pca_composition: np.ndarray,
+            labels: np.ndarray,
+            zips
+    ) -> "ClusterModel":
+        """
+        Builds the model from the outputs of a full fit
+        (pca_facilities.process_scale_df / process_pca_scaled / KMeans)
+
+        inputs:
+          - df_counts: facility counts that were scaled (one column per group)
+          - pca_loadings: components as (features x n_pca)
+          - pca_composition: projection the clustering was fitted on
+          - labels: cluster of each row
+        """
+        values = df_counts.to_numpy(dtype=float)
+        scale_std = values.std(axis=0)
+        scale_std[scale_std == 0] = 1  # as StandardScaler
+        scale_mean = values.mean(axis=0)
+        scaled = (values - scale_mean) / scale_std
+
+        labels = np.asarray(labels)
+        n_clusters = labels.max() + 1
+        counts = np.bincount(labels, minlength=n_clusters)
+        centroids = np.zeros((n_clusters, pca_composition.shape[1]))
+        np.add.at(centroids, labels, pca_composition)
+        centroids /= np.maximum(counts, 1)[:, None]
+
+        return cls(
+            columns=df_counts.columns.to_numpy(dtype=str),
+            scale_mean=scale_mean,
+            scale_std=scale_std,
+            pca_mean=scaled.mean(axis=0),
+            components=pca_loadings.to_numpy(dtype=float).T,
+            centroids=centroids,
+            counts=counts,
+            zips=np.asarray(zips, dtype=str),
+            labels=labels,
+        )
+
+    def save(self, file_loc: str = CLUSTER_MODEL_FILE):
+        np.savez(file_loc, **vars(self))
+
+    @classmethod
+    def load(cls, file_loc: str = CLUSTER_MODEL_FILE) -> "ClusterModel":
+        with np.load(file_loc) as model:
+            return cls(**{key: model[key] for key in model.files})
+
+    def transform(self, df_counts: pd.DataFrame) -> np.ndarray:
+        """
+        Projects facility counts in the PCA space of the model
+        Facility groups unknown to the model are ignored, missing ones are 0
+        """
+        unknown = set(df_counts.columns) - set(self.columns)
+        if unknown:
+            logging.warning(f"Facility groups not in the cluster model, ignored: {sorted(unknown)}")
+
+        values = df_counts.reindex(columns=self.columns, fill_value=0).to_numpy(dtype=float)
+        scaled = (values - self.scale_mean) / self.scale_std
+
+        return (scaled - self.pca_mean) @ self.components.T
+
+    def predict(self, df_counts: pd.DataFrame) -> np.ndarray:
+        """
+        Cluster of each row: the nearest centroid
+        """
+        projection = self.transform(df_counts)
+        distance = ((projection[:, None, :] - self.centroids[None, :, :]) ** 2).sum(axis=2)
+        # Ids left unused by stable_labels have no centroid
+        distance[:, self.counts == 0] = np.inf
+
+        return distance.argmin(axis=1)
+
+    def partial_fit(
+            self,
+            df_counts: pd.DataFrame,
+            df_previous: pd.DataFrame | None = None
+    ) -> np.ndarray:
+        """
+        Assigns the rows and moves each centroid towards its new members
+        (mini-batch KMeans update: running mean of the members)
+
+        df_counts: facility counts indexed by zipcode
+        df_previous: counts the model last saw for zipcodes already in it
+          (indexed by zipcode) - they are removed from the mean of their
+          previous cluster first, so a changed zipcode is counted once
+        """
+        if df_previous is not None:
+            self._remove(df_previous)
+
+        projection = self.transform(df_counts)
+        labels = self.predict(df_counts)
+
+        for cluster in np.unique(labels):
+            members = projection[labels == cluster]
+            self.counts[cluster] += len(members)
+            self.centroids[cluster] += (
+                (members - self.centroids[cluster]).sum(axis=0) / self.counts[cluster]
+            )
+
+        return labels
+
+    def _remove(self, df_previous: pd.DataFrame):
+        """
+        Takes zipcodes out of the running mean of their last cluster
+        """
+        known = pd.Series(self.labels, index=self.zips)
+        zips = df_previous.index.astype(str)
+        df_previous = df_previous.loc[zips.isin(known.index)]
+        projection = self.transform(df_previous)
+        labels = known.loc[zips[zips.isin(known.index)]].to_numpy()
+
+        for cluster in np.unique(labels):
+            members = projection[labels == cluster]
+            remaining = self.counts[cluster] - len(members)
+            if remaining > 0:
+                self.centroids[cluster] -= (
+                    (members - self.centroids[cluster]).sum(axis=0) / remaining
+                )
+            self.counts[cluster] = max(remaining, 0)
+
+    def set_labels(self, zips, labels):
+        """
+        Records the cluster of new or changed zipcodes
+        """
+        known = pd.Series(self.labels, index=self.zips)
+        known = pd.concat([known.drop(np.asarray(zips, dtype=str), errors='ignore'),
+                           pd.Series(np.asarray(labels), index=np.asarray(zips, dtype=str))])
+        self.zips = known.index.to_numpy(dtype=str)
+        self.labels = known.to_numpy()
+
+
+def stable_labels(
+        previous_zips,
+        previous_labels,
+        zips,
+        labels
+) -> np.ndarray:
+    """
+    Renumbers the clusters of a new fit so each one keeps the id of the
+    previous cluster it shares the most zipcodes with
+
+    The matching maximizes the total number of shared zipcodes (Hungarian
+    algorithm). Clusters with no previous match get the unused ids
+    """
+    labels = np.asarray(labels)
+    previous = pd.Series(np.asarray(previous_labels), index=np.asarray(previous_zips, dtype=str))
+    previous = previous.reindex(np.asarray(zips, dtype=str)).to_numpy()
+
+    n_new = labels.max() + 1
+    n_old = int(np.nanmax(previous)) + 1 if np.isfinite(previous.astype(float)).any() else 0
+    overlap = np.zeros((n_new, max(n_old, 1)))
+    shared = ~pd.isna(previous)
+    np.add.at(overlap, (labels[shared], previous[shared].astype(int)), 1)
+
+    new_ids, old_ids = linear_sum_assignment(-overlap)
+    mapping = dict(zip(new_ids, old_ids))
+
+    free_ids = iter(sorted(set(range(max(n_new, n_old))) - set(old_ids)))
+    for cluster in range(n_new):
+        if cluster not in mapping:
+            mapping[cluster] = next(free_ids)
+
+    return np.array([mapping[label] for label in labels])
@@ -0,0 +1,256 @@
+"""
+Local mirror of the NYC Open Data datasets in `data_endpoints.py`
+
+Each dataset is stored as hive-partitioned parquet, one partition per sync:
+    data/mirror/<endpoint name>/sync=00001/part.parquet
+    data/mirror/<endpoint name>/_state.json
+
+The state keeps the high-water mark of the dataset (the largest value
+already mirrored of its watermark column), so a sync only downloads rows
+above it. Rows that changed upstream come back in a later partition and
+replace the earlier version when read (same :id).
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import data_endpoints
+from process.api_socrata import nyc_api_bulk_read
+
+MIRROR_DIR = "data/mirror"
+
+# Watermark of each dataset (`:updated_at` unless listed):
+#   - column: SODA column compared against the high-water mark
+#   - type: 'text' values are quoted in the $where clause
+MIRROR_WATERMARKS = {
+    'nyc_ARREST': {'column': 'arrest_key', 'type': 'number'},
+    'nyc_HIST_ARREST': {'column': 'arrest_key', 'type': 'number'},
+}
+DEFAULT_WATERMARK = {'column': ':updated_at', 'type': 'text'}
+
+# Prefix used by downstream readers to load a mirrored dataset
+# e.g. read_source('mirror:nyc_FACILITIES')
+MIRROR_PREFIX = "mirror:"
+
+
+def _state_file(name: str, mirror_dir: str) -> str:
+    return os.path.join(mirror_dir, name, '_state.json')
+
+
+def read_state(name: str, mirror_dir: str = MIRROR_DIR) -> dict:
+    """
+    Sync state of a mirrored dataset (empty if never synced)
+    """
+    state_file = _state_file(name, mirror_dir)
+    if not os.path.isfile(state_file):
+        return dict()
+    with open(state_file) as file:
+        return json.load(file)
+
+
+def sync_mirror(
+        name: str,
+        mirror_dir: str = MIRROR_DIR,
+        **bulk_read_kwargs
+) -> int:
+    """
+    Brings the local mirror of a dataset up to date
+
+    inputs:
+      - name: endpoint name in data_endpoints.py (e.g. 'nyc_RNOPV')
+      - bulk_read_kwargs: passed to nyc_api_bulk_read
+        (page_size, max_workers, app_token, ...)
+
+    output:
+      - Number of new or changed rows downloaded
+    """
+    url = getattr(data_endpoints, name)
+    watermark = MIRROR_WATERMARKS.get(name, DEFAULT_WATERMARK)
+    column = watermark['column']
+    state = read_state(name, mirror_dir)
+
+    where = None
+    if state.get('high_water_mark') is not None:
+        value = state['high_water_mark']
+        if watermark['type'] == 'text':
+            value = f"'{value}'"
+        where = f"{column} > {value}"
+
+    sync_id = state.get('syncs', 0) + 1
+    partition_dir = os.path.join(mirror_dir, name, f"sync={sync_id:05d}")
+    os.makedirs(partition_dir, exist_ok=True)
+    part_file = os.path.join(partition_dir, 'part.parquet')
+
+    n_rows = nyc_api_bulk_read(
+        url,
+        part_file,
+        order=f"{column}, :id",
+        where=where,
+        # System fields (:id, :updated_at) are only returned when selected
+        select=':*, *',
+        **bulk_read_kwargs
+    )
+
+    if n_rows == 0:
+        shutil.rmtree(partition_dir)
+        logging.info(f"{name}: mirror already up to date")
+        return 0
+
+    values = pq.read_table(part_file, columns=[column]).column(column)
+    if watermark['type'] == 'number':
+        values = pc.cast(values, 'float64')
+    high_water_mark = pc.max(values).as_py()
+    if watermark['type'] == 'number' and float(high_water_mark).is_integer():
+        high_water_mark = int(high_water_mark)
+
+    state.update({
+        'url': url,
+        'watermark': column,
+        'high_water_mark': high_water_mark,
+        'syncs': sync_id,
+    })
+    with open(_state_file(name, mirror_dir), 'w') as file:
+        json.dump(state, file, indent=2)
+
+    logging.info(f"{name}: {n_rows} rows mirrored, high-water mark {high_water_mark}")
+
+    return n_rows
+
+
+def _mirror_dataset(name: str, mirror_dir: str) -> ds.Dataset:
+    return ds.dataset(
+        os.path.join(mirror_dir, name),
+        format='parquet',
+        partitioning='hive',
+        exclude_invalid_files=True,
+    )
+
+
+def read_mirror(
+        name: str,
+        columns: list | None = None,
+        filters: list | None = None,
+        mirror_dir: str = MIRROR_DIR
+) -> pd.DataFrame:
+    """
+    Reads a mirrored dataset, only loading the requested columns and the
+    row groups that can match the filters
+
+    inputs:
+      - columns: columns to read (all when None)
+      - filters: pyarrow/parquet style filters, e.g.
+        [('law_cat_cd', '=', 'F')] or [[('a', '=', '1')], [('b', 'in', ['2', '3'])]]
+
+    Values are strings (as downloaded) - convert the columns you need
+    """
+    dataset = _mirror_dataset(name, mirror_dir)
+    expression = pq.filters_to_expression(filters) if filters else None
+
+    # The latest version of a row replaces the previous ones
+    dedupe = ':id' in dataset.schema.names
+    read_columns = columns
+    if columns is not None and dedupe:
+        read_columns = list(dict.fromkeys(columns + [':id', 'sync']))
+
+    df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+
+    if dedupe and len(df):
+        # Compare with the latest sync of each row over the whole dataset,
+        # so an older version matching the filters is not kept when the
+        # latest version does not match
+        latest_sync = (dataset.to_table(columns=[':id', 'sync'])
+                       .to_pandas()
+                       .groupby(':id')['sync']
+                       .max())
+        df = df.loc[df['sync'].to_numpy() == latest_sync.reindex(df[':id']).to_numpy()]
+
+    if columns is not None:
+        df = df[columns]
+
+    return df.reset_index(drop=True)
+
+
+def iter_mirror_batches(
+        name: str,
+        columns: list | None = None,
+        filters: list | None = None,
+        batch_size: int = 250_000,
+        mirror_dir: str = MIRROR_DIR
+):
+    """
+    Streams a mirrored dataset as dataframes of at most `batch_size` rows
+    (for append-only datasets such as the arrests - rows are not deduplicated)
+    """
+    dataset = _mirror_dataset(name, mirror_dir)
+    expression = pq.filters_to_expression(filters) if filters else None
+
+    for batch in dataset.to_batches(
+        columns=columns,
+        filter=expression,
+        batch_size=batch_size
+    ):
+        yield batch.to_pandas()
+
+
+def _filter_df(df: pd.DataFrame, filters: list) -> pd.DataFrame:
+    """
+    Applies parquet style filters to a dataframe read from csv
+    """
+    operators = {
+        '=': lambda c, v: c == v,
+        '==': lambda c, v: c == v,
+        '!=': lambda c, v: c != v,
+        '<': lambda c, v: c < v,
+        '<=': lambda c, v: c <= v,
+        '>': lambda c, v: c > v,
+        '>=': lambda c, v: c >= v,
+        'in': lambda c, v: c.isin(v),
+        'not in': lambda c, v: ~c.isin(v),
+    }
+    # A flat list is a single AND group
+    groups = filters if isinstance(filters[0], list) else [filters]
+
+    mask = pd.Series(False, index=df.index)
+    for group in groups:
+        group_mask = pd.Series(True, index=df.index)
+        for col, op, value in group:
+            group_mask &= operators[op](df[col], value)
+        mask |= group_mask
+
+    return df.loc[mask]
+
+
+def read_source(
+        file_loc: str,
+        columns: list | None = None,
+        filters: list | None = None
+) -> pd.DataFrame:
+    """
+    Reads a raw dataset either from a csv file or from the local mirror
+    ('mirror:<endpoint name>')
+
+    The mirror pushes the column selection and filters down to parquet,
+    csv files are filtered after being read
+    """
+    if file_loc.startswith(MIRROR_PREFIX):
+        return read_mirror(file_loc[len(MIRROR_PREFIX):], columns, filters)
+
+    df = pd.read_csv(file_loc, usecols=columns)
+    if filters:
+        df = _filter_df(df, filters)
+
+    return df
+
+
+if __name__ == "__main__":
+    # python src/process/dataset_mirror.py nyc_RNOPV nyc_FACILITIES ...
+    logging.basicConfig(level=logging.INFO)
+    for name in sys.argv[1:]:
+        sync_mirror(name)
@@ -0,0 +1,146 @@
+"""
+Classifies arrests as inside/outside the buffer around public facilities
+
+Instead of buffering every facility and testing containment against the
+union of the buffers (one union per distance), the distance of every
+arrest to its nearest public facility is computed once with a KD-tree
+in EPSG:2263 (NY Long Island, feet). An arrest is outside the buffer of
+distance d exactly when that distance is >= d, so the counts for a whole
+list of distances come from the same pass.
+"""
+
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+from process.dataset_mirror import read_source
+from process.process_arrests import ZIP_FILE, assign_zips, read_zip_tree
+
+
+BUFFER_DISTANCES_FT = [250, 500, 750, 1000, 1500, 2000]
+
+_to_nyc_feet = Transformer.from_crs("EPSG:4326", "EPSG:2263", always_xy=True)
+
+
+def project_nyc_feet(
+        longitude: np.ndarray,
+        latitude: np.ndarray
+) -> np.ndarray:
+    """
+    Projects lon/lat to EPSG:2263, returned as an (n, 2) array of x/y in feet
+    """
+    x, y = _to_nyc_feet.transform(
+        np.asarray(longitude, dtype=float),
+        np.asarray(latitude, dtype=float)
+    )
+    return np.column_stack([x, y])
+
+
+def nearest_facility_distance(
+        arrest_xy: np.ndarray,
+        facility_xy: np.ndarray
+) -> np.ndarray:
+    """
+    Distance (feet) of each arrest to its nearest facility
+    """
+    facility_tree = cKDTree(facility_xy)
+    distance, _ = facility_tree.query(arrest_xy, k=1, workers=-1)
+
+    return distance
+
+
+def count_outside_buffer(
+        arrests: pd.DataFrame,
+        facilities: pd.DataFrame,
+        buffer_distances: list = BUFFER_DISTANCES_FT,
+        zip_file: str = ZIP_FILE
+) -> pd.DataFrame:
+    """
+    Counts the arrests outside the buffer around the facilities, for every
+    buffer distance, per year, zipcode and law category
+
+    inputs:
+      - arrests: lower case columns arrest_date, law_cat_cd, latitude, longitude
+      - facilities: lower case columns latitude, longitude
+      - buffer_distances: buffer distances in feet
+
+    output:
+      - Dataframe with columns buffer_ft, arrest_year, zip, law_cat_cd, count
+    """
+    arrests = arrests.dropna(subset=['latitude', 'longitude'])
+    facilities = facilities.dropna(subset=['latitude', 'longitude'])
+    buffer_distances = np.sort(np.asarray(buffer_distances))
+
+    zip_tree, zip_labels = read_zip_tree(zip_file)
+    zip_position = assign_zips(arrests['longitude'], arrests['latitude'], zip_tree)
+    in_zip = zip_position >= 0
+    arrests = arrests.loc[in_zip]
+
+    distance = nearest_facility_distance(
+        project_nyc_feet(arrests['longitude'], arrests['latitude']),
+        project_nyc_feet(facilities['longitude'], facilities['latitude'])
+    )
+
+    # Number of buffers each arrest is outside of: it is outside the
+    # buffers buffer_distances[:n_outside]
+    n_outside = np.searchsorted(buffer_distances, distance, side='right')
+
+    counts = (pd.DataFrame({
+        'arrest_year': pd.to_datetime(arrests['arrest_date']).dt.to_period('Y').array,
+        'zip': zip_labels[zip_position[in_zip]],
+        'law_cat_cd': arrests['law_cat_cd'].to_numpy(),
+        'n_outside': n_outside,
+    })
+        .groupby(['arrest_year', 'zip', 'law_cat_cd', 'n_outside'])
+        .size()
+        .unstack('n_outside', fill_value=0)
+        .reindex(columns=range(len(buffer_distances) + 1), fill_value=0)
+    )
+
+    # Arrests outside buffer i are those with n_outside > i
+    outside = counts.loc[:, ::-1].cumsum(axis=1).loc[:, ::-1]
+    outside = outside.iloc[:, 1:]
+    outside.columns = pd.Index(buffer_distances, name='buffer_ft')
+
+    arrests_outside = (outside
+                       .stack()
+                       .rename('count')
+                       .reset_index()
+                       )
+    arrests_outside = arrests_outside.loc[arrests_outside['count'] > 0]
+
+    return arrests_outside[['buffer_ft', 'arrest_year', 'zip', 'law_cat_cd', 'count']]
+
+
+def main(
+        arrests_file: str,
+        facilities_file: str = "data/raw/public_fac.csv",
+        output_loc: str = "data/processed/arrests_outside_buffer_sweep.csv",
+        buffer_distances: list = BUFFER_DISTANCES_FT
+) -> pd.DataFrame:
+    """
+    Reads the arrests and the public facilities (csv files or
+    'mirror:<endpoint>') and writes the counts for every buffer distance
+    """
+    arrests = read_source(arrests_file)
+    arrests.columns = [h.lower() for h in arrests.columns]
+    for col in ['latitude', 'longitude']:
+        arrests[col] = pd.to_numeric(arrests[col], errors='coerce')
+
+    facilities = read_source(
+        facilities_file,
+        columns=['optype', 'latitude', 'longitude'],
+        filters=[('optype', '=', 'Public')]
+    )
+    for col in ['latitude', 'longitude']:
+        facilities[col] = pd.to_numeric(facilities[col], errors='coerce')
+
+    arrests_outside = count_outside_buffer(arrests, facilities, buffer_distances)
+    arrests_outside.to_csv(output_loc, index=False)
+
+    return arrests_outside
+
+
+if __name__ == "__main__":
+    main("data/raw/NYPD_Arrests_Data__Historic.csv")
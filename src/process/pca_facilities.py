@@ -1,16 +1,31 @@
+import logging
+import os
+import sys
+import time
+
 import pandas as pd
 import numpy as np
+from joblib import Parallel, delayed
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
 
 from constants import RAND_STATE
+from process.cluster_model import CLUSTER_MODEL_FILE, ClusterModel, stable_labels
+from process.dataset_mirror import read_source
 
 
 def data_read(
         public_facilities: str = "data/raw/public_fac.csv",
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
-    df_facilities = pd.read_csv(public_facilities)
+    """
+    public_facilities: csv file or the local mirror ('mirror:nyc_FACILITIES')
+    """
+    df_facilities = read_source(
+        public_facilities,
+        columns=['zipcode', 'facgroup']
+    )
 
     return df_facilities
 
@@ -93,7 +108,6 @@ def process_kmeans_scaled(
         n_clusters=clusters,
         random_state=RAND_STATE,
         n_init=10)
-    kmeans.fit(df)
 
     cluster = kmeans.fit_predict(df)
 
@@ -148,11 +162,69 @@ def pca_explanation(
     return pca_loadings
 
 
+def _evaluate_cell(
+        pca_composition: np.ndarray,
+        n_pca: int,
+        k_cluster: int
+) -> dict:
+    """
+    Fits KMeans on the first n_pca components and scores the clustering
+    """
+    start = time.perf_counter()
+    kmeans = KMeans(
+        n_clusters=k_cluster,
+        random_state=RAND_STATE,
+        n_init=10)
+    labels = kmeans.fit_predict(pca_composition[:, :n_pca])
+    fit_seconds = time.perf_counter() - start
+
+    return {
+        'n_pca': n_pca,
+        'k': k_cluster,
+        'inertia': kmeans.inertia_,
+        'silhouette': silhouette_score(pca_composition[:, :n_pca], labels),
+        'fit_seconds': fit_seconds,
+        'labels': labels,
+    }
+
+
+def model_selection(
+        pca_composition: np.ndarray,
+        n_pca_grid: list,
+        k_grid: list,
+        n_jobs: int = -1
+) -> pd.DataFrame:
+    """
+    Evaluates KMeans for every (n_pca, k) of the grid in parallel
+
+    The components of a PCA are nested, so the projection on the largest
+    n_pca of the grid is computed once and each cell uses its first n_pca
+    columns. The projection is shared read-only with the workers
+    (memory mapped by joblib)
+
+    output:
+      - Dataframe with one row per cell: n_pca, k, inertia, silhouette,
+        fit_seconds and labels (the cluster of each zipcode)
+    """
+    cells = Parallel(n_jobs=n_jobs)(
+        delayed(_evaluate_cell)(pca_composition, n_pca, k_cluster)
+        for n_pca in n_pca_grid
+        for k_cluster in k_grid
+    )
+
+    return pd.DataFrame(cells)
+
+
 def main(
         facility_location: str,
         exclude_columns_to_scale: list = [],
         n_pca: int = 15,
-        k_cluster: int = 5
+        k_cluster: int = 5,
+        n_pca_grid: list | None = None,
+        k_grid: list | None = None,
+        n_jobs: int = -1,
+        model_loc: str | None = None,
+        variance_cutoff: float = 0.8
 ):
     """
     Builds all the pieces together to return a cluster of columns based on
@@ -161,6 +233,19 @@ def main(
     The assumption is we will scale our dataframe based on all columns
     - This will be all facilities and the property values
     - If there are any columns to exclude, provide that as a list
+
+    Model selection: when n_pca_grid and k_grid are given, n_pca and
+    k_cluster are ignored and chosen in two steps
+      - n_pca: the smallest of n_pca_grid whose components explain at
+        least variance_cutoff of the variance (the largest if none does)
+      - k: the best silhouette among k_grid, on those n_pca components
+    Silhouettes are only compared within one PCA space - they are not
+    comparable across numbers of components. The report of the k grid
+    is the fourth output (None without a grid)
+
+    model_loc: when given, the fitted model is saved there (see
+    process/cluster_model.py) and the cluster ids are matched to those of
+    the model previously saved there, so they stay stable between runs
     """
     df_facility = data_read(
         facility_location)
@@ -169,6 +254,10 @@ def main(
         df_facility, exclude_columns=exclude_columns_to_scale)
 
     scale_cols = df_scaled.columns.to_list()
+    selection = None
+    if n_pca_grid and k_grid:
+        n_pca = max(n_pca_grid)
+
     # Apply PCA
     pca_composition, pca_loadings = process_pca_scaled(
         df_scaled,
@@ -176,12 +265,48 @@ def main(
         n_pca=n_pca
     )
 
-    # Apply KMeans clustering on pca data
-    kmeans_cluster = process_kmeans_scaled(
-        pca_composition,
-        cols_to_cluster=scale_cols,
-        clusters=k_cluster
-    )
+    if n_pca_grid and k_grid:
+        # Share of the variance explained by the first i+1 components
+        explained = np.cumsum(
+            pca_composition.var(axis=0, ddof=1)
+            / df_scaled[scale_cols].var(axis=0, ddof=1).sum()
+        )
+        n_pca = next(
+            (n for n in sorted(n_pca_grid) if explained[n - 1] >= variance_cutoff),
+            max(n_pca_grid)
+        )
+        selection = model_selection(pca_composition, [n_pca], k_grid, n_jobs)
+        selection['explained_variance'] = explained[n_pca - 1]
+        best = selection.loc[selection['silhouette'].idxmax()]
+        print(f'Selected n_pca={n_pca} ({explained[n_pca - 1]:.1%} of the variance), '
+              f'k={best["k"]} (silhouette {best["silhouette"]:.3f}, '
+              f'{selection["fit_seconds"].sum():.1f}s of fits)')
+
+        pca_composition = pca_composition[:, :n_pca]
+        pca_loadings = pca_loadings.iloc[:, :n_pca]
+        kmeans_cluster = best['labels']
+    else:
+        # Apply KMeans clustering on pca data
+        kmeans_cluster = process_kmeans_scaled(
+            pca_composition,
+            cols_to_cluster=scale_cols,
+            clusters=k_cluster
+        )
+    if model_loc is not None:
+        if os.path.isfile(model_loc):
+            previous = ClusterModel.load(model_loc)
+            kmeans_cluster = stable_labels(
+                previous.zips, previous.labels,
+                df_facility['zip'], kmeans_cluster
+            )
+        ClusterModel.from_fit(
+            df_facility[scale_cols],
+            pca_loadings,
+            pca_composition,
+            kmeans_cluster,
+            df_facility['zip']
+        ).save(model_loc)
+
     print(f'Cluster shape: {kmeans_cluster.shape}')
     print(f'Scaled Dataframe shape: {df_scaled.shape}')
     print(f'PCA composition shape: {pca_composition.shape}')
@@ -195,28 +320,114 @@ def main(
     df_facility['cluster'] = pd.Series(pca_composed_df['cluster'].values, index=df_facility.index)
     # Merge PCA, clusters, and zip code as our training df
     # Output the PCA decomposition as
+    if selection is not None:
+        selection = selection.drop(columns='labels')
+
     return (pca_composed_df,
             pca_loadings,
-            df_facility)
+            df_facility,
+            selection)
+
+
+def update_clusters(
+        facility_location: str,
+        model_loc: str = CLUSTER_MODEL_FILE,
+        facility_clustered_loc: str = 'data/processed/facility_clustered.csv',
+        pca_clustered_loc: str = 'data/processed/pca_with_clusters.csv',
+        mini_batch: bool = False
+):
+    """
+    Incremental mode: only the zipcodes that are new or whose facility
+    counts changed since the last run are projected and assigned to the
+    nearest centroid of the saved model (no refit). With mini_batch, the
+    centroids are also moved towards their new members
+
+    output:
+      - the outputs of main (pca_composed_df, df_facility) with the rows
+        of the changed zipcodes updated
+      - list of the zipcodes that were (re)assigned
+    """
+    model = ClusterModel.load(model_loc)
+    df_facility = process_facility(data_read(facility_location))
+
+    previous = pd.read_csv(facility_clustered_loc, dtype={'zip': str})
+    previous = previous.set_index('zip')
+    count_cols = [col for col in df_facility.columns if col != 'zip']
+
+    current = df_facility.set_index('zip')[count_cols]
+    before = previous.reindex(index=current.index, columns=count_cols).fillna(0)
+    changed = ~current.index.isin(previous.index) | (current != before).any(axis=1).to_numpy()
+    changed_zips = current.index[changed].to_list()
+    logging.info(f"{len(changed_zips)} new or changed zipcodes")
+
+    pca_composed_df = pd.read_csv(pca_clustered_loc, dtype={'zip': str})
+    pca_composed_df = pca_composed_df.drop(columns=[c for c in pca_composed_df.columns if c.startswith('Unnamed')])
+    pca_composed_df = pca_composed_df.set_index('zip')
+    pc_cols = [f'PC{i+1}' for i in range(model.components.shape[0])]
+
+    if changed_zips:
+        changed_counts = current.loc[changed_zips]
+        if mini_batch:
+            changed_before = previous.loc[previous.index.isin(changed_zips)]
+            labels = model.partial_fit(changed_counts, changed_before.reindex(columns=count_cols).fillna(0))
+        else:
+            labels = model.predict(changed_counts)
+        model.set_labels(changed_zips, labels)
+        model.save(model_loc)
+
+        changed_pca = pd.DataFrame(model.transform(changed_counts), index=changed_zips, columns=pc_cols)
+        changed_pca['cluster'] = labels
+        pca_composed_df = pd.concat([pca_composed_df.drop(changed_zips, errors='ignore'), changed_pca])
+
+    # Zipcodes without any facility anymore are dropped
+    pca_composed_df = pca_composed_df.reindex(current.index)
+    pca_composed_df.index.name = 'zip'
+    pca_composed_df = pca_composed_df.reset_index()[pc_cols + ['cluster', 'zip']]
+
+    df_facility['cluster'] = pca_composed_df['cluster'].to_numpy()
+
+    return pca_composed_df, df_facility, changed_zips
 
 
 if __name__ == "__main__":
-    pca_composed_df, pca_loadings, df_facility = main(
-        facility_location="data/raw/public_fac.csv",
-        n_pca=15,
-        k_cluster=5,
-        exclude_columns_to_scale=['zip']
-    )
+    # python src/process/pca_facilities.py [--select | --incremental [--mini-batch]]
+    if "--incremental" in sys.argv:
+        pca_composed_df, df_facility, _ = update_clusters(
+            facility_location="data/raw/public_fac.csv",
+            mini_batch="--mini-batch" in sys.argv
+        )
+        pca_loadings = None
+    elif "--select" in sys.argv:
+        pca_composed_df, pca_loadings, df_facility, selection = main(
+            facility_location="data/raw/public_fac.csv",
+            n_pca_grid=[2, 3, 5, 8, 10, 15, 20],
+            k_grid=list(range(2, 11)),
+            exclude_columns_to_scale=['zip'],
+            model_loc=CLUSTER_MODEL_FILE
+        )
+        selection.to_csv(
+            'data/processed/cluster_selection.csv',
+            index=False
+            )
+    else:
+        pca_composed_df, pca_loadings, df_facility, _ = main(
+            facility_location="data/raw/public_fac.csv",
+            n_pca=15,
+            k_cluster=5,
+            exclude_columns_to_scale=['zip'],
+            model_loc=CLUSTER_MODEL_FILE
+        )
 
     # Write to processed:
     pca_composed_df.to_csv(
         'data/processed/pca_with_clusters.csv',
         index=False
         )
-    pca_loadings.to_csv(
-        'data/processed/pca_loadings.csv',
-        index=False
-        )
+    if pca_loadings is not None:
+        pca_loadings.to_csv(
+            'data/processed/pca_loadings.csv',
+            index=False
+            )
     df_facility.to_csv(
         'data/processed/facility_clustered.csv',
         index=False
@@ -0,0 +1,336 @@
+"""
+Runs the processing stages as a DAG, skipping the stages that are current
+
+Each stage declares the files it reads and writes. Its fingerprint is a
+hash of the contents of its inputs, its parameters and the source of the
+modules that implement it. A stage runs only when its fingerprint changed
+since its last successful run or one of its outputs is missing or was
+modified, so a rebuild after one input changed only re-runs the stages
+downstream of that input. Stages whose inputs are ready run in parallel
+(e.g. the facilities and the arrests branches).
+
+    python src/process/pipeline.py [--dry-run] [--force]
+
+State: data/processed/_pipeline_state.json
+"""
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+PIPELINE_STATE_FILE = "data/processed/_pipeline_state.json"
+
+
+class Stage:
+    """
+    A step of the pipeline
+
+      - name: unique name of the stage
+      - func: top level function called as func(inputs, outputs, **params)
+      - inputs, outputs: file locations
+      - params: parameters passed to func (part of the fingerprint)
+      - modules: modules implementing the stage (their source is part of
+        the fingerprint)
+    """
+
+    def __init__(
+            self,
+            name: str,
+            func,
+            inputs: list,
+            outputs: list,
+            params: dict | None = None,
+            modules: list | None = None
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or dict()
+        self.modules = modules or []
+
+    def code_hash(self) -> str:
+        digest = hashlib.sha256(inspect.getsource(self.func).encode())
+        for module in self.modules:
+            digest.update(inspect.getsource(importlib.import_module(module)).encode())
+        return digest.hexdigest()
+
+
+""" ---------------------------------------------------------------
+STAGES
+-------------------------------------------------------------------"""
+
+def run_pca_facilities(inputs: list, outputs: list, n_pca: int, k_cluster: int):
+    from process.pca_facilities import main
+
+    pca_composed_df, pca_loadings, df_facility, _ = main(
+        facility_location=inputs[0],
+        n_pca=n_pca,
+        k_cluster=k_cluster,
+        exclude_columns_to_scale=['zip'],
+        model_loc=outputs[3]
+    )
+    pca_composed_df.to_csv(outputs[0], index=False)
+    pca_loadings.to_csv(outputs[1], index=False)
+    df_facility.to_csv(outputs[2], index=False)
+
+
+def run_zips_with_clusters(inputs: list, outputs: list):
+    from process.process_features import process_zips_with_clusters
+
+    process_zips_with_clusters(inputs[0], inputs[1]).to_csv(outputs[0])
+
+
+def run_process_arrests(inputs: list, outputs: list, chunksize: int):
+    from process.process_arrests import process_arrests_streaming
+
+    process_arrests_streaming(inputs[0], outputs[0], chunksize=chunksize, zip_file=inputs[1])
+
+
+def run_process_features(inputs: list, outputs: list):
+    from process.process_features import main
+
+    df_model_features = main(
+        facility_file=inputs[0],
+        arrest_file=inputs[1],
+        zip_borough_file=inputs[2]
+    )
+    df_model_features = df_model_features.drop(columns=['Unnamed: 0'], errors='ignore')
+    df_model_features.to_csv(outputs[0], index=False)
+
+
+STAGES = [
+    Stage(
+        'pca_facilities',
+        run_pca_facilities,
+        inputs=['data/raw/public_fac.csv'],
+        outputs=[
+            'data/processed/pca_with_clusters.csv',
+            'data/processed/pca_loadings.csv',
+            'data/processed/facility_clustered.csv',
+            # process.cluster_model.CLUSTER_MODEL_FILE - also read by the
+            # stage itself, to keep the cluster ids of the previous run
+            'data/processed/cluster_model.npz',
+        ],
+        params={'n_pca': 15, 'k_cluster': 5},
+        modules=['process.pca_facilities', 'process.cluster_model']
+    ),
+    Stage(
+        'zips_with_clusters',
+        run_zips_with_clusters,
+        inputs=[
+            'data/processed/facility_clustered.csv',
+            'data/raw/prop_values.csv',
+        ],
+        outputs=['data/processed/zips_with_clusters.csv'],
+        modules=['process.process_features']
+    ),
+    Stage(
+        'process_arrests',
+        run_process_arrests,
+        inputs=[
+            'data/processed/arrests_outside_buffer_2016.csv',
+            'data/raw/ny_new_york_zip_codes_geo.min.json',
+        ],
+        outputs=['data/processed/arrests_outside_buffer_by_zip_2016.csv'],
+        params={'chunksize': 250_000},
+        modules=['process.process_arrests']
+    ),
+    Stage(
+        'process_features',
+        run_process_features,
+        inputs=[
+            'data/processed/zips_with_clusters.csv',
+            'data/processed/arrests_outside_buffer_by_zip_2016.csv',
+            'data/raw/zip_borough.csv',
+        ],
+        outputs=['data/model_inputs/model_input.csv'],
+        modules=['process.process_features', 'arrest_cube']
+    ),
+]
+
+
+""" ---------------------------------------------------------------
+RUNNER
+-------------------------------------------------------------------"""
+
+def _read_state(state_file: str) -> dict:
+    if not os.path.isfile(state_file):
+        return {'stages': dict(), 'files': dict()}
+    with open(state_file) as file:
+        return json.load(file)
+
+
+def _write_state(state: dict, state_file: str):
+    os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+    with open(state_file + '.tmp', 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def file_hash(file_loc: str, state: dict) -> str | None:
+    """
+    sha256 of a file's contents (None if missing)
+
+    Hashes are remembered by (size, modification time), so unchanged
+    files - in particular the large raw extracts - are not read again
+    """
+    if not os.path.isfile(file_loc):
+        return None
+
+    stat = os.stat(file_loc)
+    key = [stat.st_size, stat.st_mtime_ns]
+    known = state['files'].get(file_loc)
+    if known is not None and known['key'] == key:
+        return known['sha256']
+
+    digest = hashlib.sha256()
+    with open(file_loc, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    state['files'][file_loc] = {'key': key, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def fingerprint(stage: Stage, state: dict) -> str:
+    """
+    Hash of the stage's input contents, parameters and code
+    """
+    description = {
+        'inputs': {f: file_hash(f, state) for f in stage.inputs},
+        'params': stage.params,
+        'code': stage.code_hash(),
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def is_current(stage: Stage, state: dict) -> bool:
+    """
+    A stage is current when it last ran with the same fingerprint and its
+    outputs are still the ones it wrote
+    """
+    last_run = state['stages'].get(stage.name)
+    if last_run is None or last_run['fingerprint'] != fingerprint(stage, state):
+        return False
+
+    return all(
+        file_hash(f, state) == last_run['outputs'].get(f)
+        for f in stage.outputs
+    )
+
+
+def upstream_stages(stages: list) -> dict:
+    """
+    {stage name: names of the stages producing its inputs}
+    """
+    producers = {f: stage.name for stage in stages for f in stage.outputs}
+
+    return {
+        stage.name: {producers[f] for f in stage.inputs if f in producers}
+        for stage in stages
+    }
+
+
+def _run_stage(stage: Stage) -> float:
+    start = time.perf_counter()
+    stage.func(stage.inputs, stage.outputs, **stage.params)
+    return time.perf_counter() - start
+
+
+def run_pipeline(
+        stages: list = STAGES,
+        state_file: str = PIPELINE_STATE_FILE,
+        max_workers: int | None = None,
+        force: bool = False,
+        dry_run: bool = False
+) -> dict:
+    """
+    Runs the stages in dependency order, independent stages in parallel
+    processes
+
+    A stage is checked when all the stages it depends on are done, so its
+    fingerprint covers the outputs they just wrote
+
+    output:
+      - {stage name: 'skipped' | 'ran' | 'would run' | 'failed'}
+    """
+    state = _read_state(state_file)
+    upstream = upstream_stages(stages)
+    by_name = {stage.name: stage for stage in stages}
+
+    status = dict()
+    running = dict()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while len(status) < len(stages):
+            for name, stage in by_name.items():
+                if name in status or name in running.values():
+                    continue
+                if any(status.get(u) not in ('skipped', 'ran', 'would run') for u in upstream[name]):
+                    if any(status.get(u) == 'failed' for u in upstream[name]):
+                        status[name] = 'failed'
+                        logging.error(f"{name}: not run, an upstream stage failed")
+                    continue
+
+                # In a dry run the upstream outputs are not rebuilt, so
+                # a stage after one that would run would run too
+                stale = any(status[u] == 'would run' for u in upstream[name])
+                if not force and not stale and is_current(stage, state):
+                    status[name] = 'skipped'
+                    logging.info(f"{name}: up to date")
+                elif dry_run:
+                    status[name] = 'would run'
+                    logging.info(f"{name}: would run")
+                else:
+                    logging.info(f"{name}: running")
+                    running[executor.submit(_run_stage, stage)] = name
+
+            if not running:
+                if len(status) < len(stages) and not any(
+                    all(u in status for u in upstream[name])
+                    for name in by_name if name not in status
+                ):
+                    raise ValueError("The stages have a circular dependency")
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                stage = by_name[name]
+                try:
+                    seconds = future.result()
+                except Exception:
+                    status[name] = 'failed'
+                    logging.exception(f"{name}: failed")
+                    continue
+
+                status[name] = 'ran'
+                state['stages'][name] = {
+                    'fingerprint': fingerprint(stage, state),
+                    'outputs': {f: file_hash(f, state) for f in stage.outputs},
+                    'seconds': round(seconds, 3),
+                }
+                _write_state(state, state_file)
+                logging.info(f"{name}: done in {seconds:.1f}s")
+
+    _write_state(state, state_file)
+
+    return status
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    status = run_pipeline(
+        force="--force" in sys.argv,
+        dry_run="--dry-run" in sys.argv
+    )
+    print(pd.Series(status, name='status').to_string())
+    if 'failed' in status.values():
+        sys.exit(1)
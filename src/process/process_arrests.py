@@ -1,50 +1,117 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+import shapely
 
-def process_arrests(file_loc: str, output_loc: str, source: str=['url', 'api']):
+from process.dataset_mirror import MIRROR_PREFIX, iter_mirror_batches, read_source
+
+ZIP_FILE = "data/raw/ny_new_york_zip_codes_geo.min.json"
+
+# Only the columns needed to count arrests by zipcode are read
+# (the text columns such as Lon_Lat and the WKT geometry are skipped)
+ARREST_DTYPES = {
+    'arrest_date': 'str',
+    'law_cat_cd': 'str',
+    'latitude': 'float64',
+    'longitude': 'float64',
+}
+
+
+def read_zip_tree(
+        file_loc: str = ZIP_FILE
+) -> tuple[shapely.STRtree, np.ndarray]:
     """
-    If downloaded - all columns are in all CAPS
-    If from API source - all columns are in lower case
+    Reads the zipcode polygons and builds a spatial index on them
 
-    Location:
-        data/processed/arrests_outside_buffer.csv
+    outputs:
+      - STRtree of the zipcode polygons
+      - Zipcode (ZCTA5CE10) of each polygon, in the order of the tree
     """
+    zips = gpd.read_file(file_loc)
+    zip_tree = shapely.STRtree(zips.geometry.values)
 
-    arrests = pd.read_csv(file_loc)
-    zips = gpd.read_file("data/raw/ny_new_york_zip_codes_geo.min.json")
+    return zip_tree, zips['ZCTA5CE10'].to_numpy()
 
-    if source == 'url':
-        arrests.columns = [h.lower() for h in arrests.columns]
 
-    # Convert some columns
-    arrests['arrest_date'] = pd.to_datetime(arrests['arrest_date'])
-    arrests['arrest_month'] = arrests['arrest_date'].dt.to_period('M') # Period for grouping
-    arrests['arrest_year'] = arrests['arrest_date'].dt.to_period('Y')
+def assign_zips(
+        longitude: np.ndarray,
+        latitude: np.ndarray,
+        zip_tree: shapely.STRtree,
+) -> np.ndarray:
+    """
+    Finds the zipcode polygon of every point in one bulk query
 
-    # Shapely information is lost from ipynb to csv
-    # Restore information and store 'geometry' point value 
-    arrests['geometry'] = arrests.apply(
-        lambda x: Point(
-            x['longitude'],
-            x['latitude']
-        ), axis=1
+    inputs:
+      - longitude, latitude: coordinates of the points
+      - zip_tree: STRtree of the zipcode polygons (see read_zip_tree)
+
+    output:
+      - Position of the zipcode polygon in the tree for each point,
+        -1 when the point is not in any zipcode (or has no coordinates)
+    """
+    points = shapely.points(
+        np.asarray(longitude, dtype=float),
+        np.asarray(latitude, dtype=float)
+    )
+    point_idx, zip_idx = zip_tree.query(points, predicate='intersects')
+
+    # A point on a shared border touches both zipcodes - keep the first
+    # so it is only counted once
+    first = np.unique(point_idx, return_index=True)[1]
+    zip_position = np.full(len(points), -1, dtype=np.int64)
+    zip_position[point_idx[first]] = zip_idx[first]
+
+    return zip_position
+
+
+def count_arrests_by_zip(
+        arrests: pd.DataFrame,
+        zip_tree: shapely.STRtree,
+        zip_labels: np.ndarray
+) -> pd.DataFrame:
+    """
+    Counts the arrests per year, zipcode, and law category
+
+    inputs:
+      - arrests: arrests with lower case columns
+        (arrest_date, law_cat_cd, latitude, longitude)
+      - zip_tree, zip_labels: see read_zip_tree
+
+    output:
+      - Dataframe with columns arrest_year, zip, law_cat_cd, count
+    """
+    zip_position = assign_zips(
+        pd.to_numeric(arrests['longitude'], errors='coerce').to_numpy(),
+        pd.to_numeric(arrests['latitude'], errors='coerce').to_numpy(),
+        zip_tree
     )
+    in_zip = zip_position >= 0
 
-    # Join our data via the geometry in zips
-    arrests_gdf = gpd.GeoDataFrame(arrests, geometry='geometry')
-    arrests_in_zips = gpd.sjoin(arrests_gdf, zips, how='inner')
+    arrests_in_zips = pd.DataFrame({
+        'arrest_year': pd.to_datetime(arrests['arrest_date']).dt.to_period('Y').array[in_zip],
+        'zip': zip_labels[zip_position[in_zip]],
+        'law_cat_cd': arrests['law_cat_cd'].to_numpy()[in_zip],
+    })
 
-    # Group our data by 
     arrests_by_zip = (arrests_in_zips
-                    .groupby(['arrest_year', 'ZCTA5CE10', 'law_cat_cd'])
+                    .groupby(['arrest_year', 'zip', 'law_cat_cd'])
                     .size()
                     .reset_index(name='count')
                     )
 
-    arrests_by_zip = arrests_by_zip.rename(columns={'ZCTA5CE10': 'zip'})
+    return arrests_by_zip
+
 
-    # Spread our answer so we have one metric per zipcode
+def write_arrests_by_zip(
+        arrests_by_zip: pd.DataFrame,
+        output_loc: str
+) -> pd.DataFrame:
+    """
+    Spreads the counts so there is one metric per zipcode and writes them
+    """
     arrests_by_zip_pivot = arrests_by_zip.pivot_table(
         index=['arrest_year', 'zip'],
         columns='law_cat_cd',
@@ -53,11 +120,151 @@ def process_arrests(file_loc: str, output_loc: str, source: str=['url', 'api']):
     ).reset_index()
     arrests_by_zip_pivot.to_csv(output_loc, index=False)
 
+    return arrests_by_zip_pivot
+
+
+def process_arrests(file_loc: str, output_loc: str, source: str=['url', 'api']):
+    """
+    If downloaded - all columns are in all CAPS
+    If from API source - all columns are in lower case
+    (the local mirror, 'mirror:nyc_HIST_ARREST', is from the API)
+
+    Location:
+        data/processed/arrests_outside_buffer.csv
+    """
+
+    arrests = read_source(file_loc)
+    zip_tree, zip_labels = read_zip_tree()
+
+    if source == 'url':
+        arrests.columns = [h.lower() for h in arrests.columns]
+
+    # Shapely information is lost from ipynb to csv
+    # Points are rebuilt from the coordinates and matched to the
+    # zipcodes in one query against the spatial index
+    arrests_by_zip = count_arrests_by_zip(arrests, zip_tree, zip_labels)
+
+    write_arrests_by_zip(arrests_by_zip, output_loc)
+
     return arrests_by_zip
 
-# TO RUN
-process_arrests(
-    "data/processed/arrests_outside_buffer_2016.csv",
-    "data/processed/arrests_outside_buffer_by_zip_2016.csv",
-    source="api"
-)
\ No newline at end of file
+
+""" ---------------------------------------------------------------
+STREAMING INGEST
+-------------------------------------------------------------------"""
+
+# Spatial index of each worker process (built once per process)
+_worker_zip_tree = None
+_worker_zip_labels = None
+
+
+def _init_worker(zip_file: str):
+    global _worker_zip_tree, _worker_zip_labels
+    _worker_zip_tree, _worker_zip_labels = read_zip_tree(zip_file)
+
+
+def _count_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk.columns = [h.lower() for h in chunk.columns]
+    return count_arrests_by_zip(chunk, _worker_zip_tree, _worker_zip_labels)
+
+
+def _mirror_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    # Only the coordinates are converted: astype(str) would turn a missing
+    # date or category into 'None', the csv reader keeps them missing
+    for col in ['latitude', 'longitude']:
+        chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+    return chunk
+
+
+def read_arrests_chunks(
+        file_loc: str,
+        chunksize: int = 250_000
+):
+    """
+    Reads the arrests file (or local mirror, 'mirror:nyc_HIST_ARREST')
+    in chunks, keeping only the columns in ARREST_DTYPES with explicit types
+
+    Column names are matched ignoring case (downloads and the API use
+    different casing)
+    """
+    if file_loc.startswith(MIRROR_PREFIX):
+        return (
+            _mirror_chunk(chunk)
+            for chunk in iter_mirror_batches(
+                file_loc[len(MIRROR_PREFIX):],
+                columns=list(ARREST_DTYPES),
+                batch_size=chunksize
+            )
+        )
+
+    header = pd.read_csv(file_loc, nrows=0).columns
+    dtypes = {
+        h: ARREST_DTYPES[h.lower()]
+        for h in header
+        if h.lower() in ARREST_DTYPES
+    }
+
+    return pd.read_csv(
+        file_loc,
+        usecols=list(dtypes),
+        dtype=dtypes,
+        chunksize=chunksize
+    )
+
+
+def process_arrests_streaming(
+        file_loc: str,
+        output_loc: str,
+        chunksize: int = 250_000,
+        n_workers: int | None = None,
+        zip_file: str = ZIP_FILE
+) -> pd.DataFrame:
+    """
+    Same output as process_arrests, for files too large to read at once
+    (e.g. the full historic arrests extract)
+
+    Chunks are read in the main process and handed to a pool of worker
+    processes that assign zipcodes and count arrests per
+    (arrest_year, zip, law_cat_cd). Only a bounded number of chunks are in
+    flight at any time, so memory stays flat as the file grows, and the
+    partial counts are summed at the end.
+
+    inputs:
+      - chunksize: rows per chunk
+      - n_workers: worker processes (defaults to the number of cores)
+    """
+    n_workers = n_workers or os.cpu_count()
+    max_pending = 2 * n_workers
+
+    partial_counts = []
+    pending = set()
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=_init_worker,
+        initargs=(zip_file,)
+    ) as executor:
+        for chunk in read_arrests_chunks(file_loc, chunksize):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                partial_counts.extend(f.result() for f in done)
+            pending.add(executor.submit(_count_chunk, chunk))
+
+        partial_counts.extend(f.result() for f in wait(pending).done)
+
+    arrests_by_zip = (pd.concat(partial_counts, ignore_index=True)
+                    .groupby(['arrest_year', 'zip', 'law_cat_cd'])['count']
+                    .sum()
+                    .reset_index()
+                    )
+
+    write_arrests_by_zip(arrests_by_zip, output_loc)
+
+    return arrests_by_zip
+
+
+if __name__ == "__main__":
+    process_arrests(
+        "data/processed/arrests_outside_buffer_2016.csv",
+        "data/processed/arrests_outside_buffer_by_zip_2016.csv",
+        source="api"
+    )
@@ -1,5 +1,7 @@
 import pandas as pd
 
+from arrest_cube import normalize_arrest_counts
+
 """ ---------------------------------------------------------------
 DATA PREPROCESS
 -------------------------------------------------------------------"""
@@ -34,6 +36,7 @@ def process_arrests_by_zip(
 ) -> pd.DataFrame:
     """
     Reads in the post-processed arrest data
+    (either export schema - see arrest_cube.normalize_arrest_counts)
     inputs:
      - file_loc: Location of the file to read in
 
@@ -44,8 +47,19 @@ def process_arrests_by_zip(
     Feature: '*_arrest_count' columns
     """
 
-    df_arrests = pd.read_csv(file_loc)
-    df_arrests = df_arrests.rename(columns={'F': 'felony_arrest_count',
+    df_arrests = normalize_arrest_counts(pd.read_csv(file_loc))
+    df_arrests = df_arrests.pivot_table(
+        index=['year', 'zip'],
+        columns='law_cat_cd',
+        values='count',
+        aggfunc='sum',
+        fill_value=0
+    ).reindex(columns=['F', 'I', 'M', 'V'], fill_value=0).reset_index()
+    df_arrests.columns.name = None
+    df_arrests['zip'] = df_arrests['zip'].astype(int)
+
+    df_arrests = df_arrests.rename(columns={'year': 'arrest_year',
+                                        'F': 'felony_arrest_count',
                                         'I': 'other_arrest_count',
                                         'M': 'misdemeanor_arrest_count',
                                         'V': 'violation_arrest_count'}
@@ -54,10 +68,45 @@ def process_arrests_by_zip(
     return df_arrests
 
 
+def process_zips_with_clusters(
+        facility_clustered_loc: str,
+        property_values_loc: str,
+        exclude_zips: tuple = (11201,)
+) -> pd.DataFrame:
+    """
+    Builds the facility counts per zipcode with the average market value
+    and the cluster (see notebooks/Unsupervised.ipynb)
+
+    inputs:
+     - facility_clustered_loc: output of pca_facilities
+       (facility counts, zip and cluster)
+     - property_values_loc: property values with columns
+       zip and revised_market_value
+     - exclude_zips: zipcodes left out (outliers)
+
+    outputs:
+     - One row per zipcode: facility counts, zip, revised_market_value, Cluster
+    """
+    df_facility = process_facility_clusters(facility_clustered_loc)
+    df_facility = df_facility.rename(columns={'cluster': 'Cluster'})
+
+    df_values = pd.read_csv(property_values_loc, usecols=['zip', 'revised_market_value'])
+    df_values = df_values.dropna(subset=['zip'])
+    df_values['zip'] = df_values['zip'].astype(int)
+    df_values = df_values.groupby('zip', as_index=False)['revised_market_value'].mean()
+
+    df_zips = pd.merge(df_facility, df_values, how='inner', on='zip')
+    df_zips = df_zips.loc[~df_zips['zip'].isin(exclude_zips)]
+
+    columns = [c for c in df_zips.columns if c not in ['zip', 'revised_market_value', 'Cluster']]
+
+    return df_zips[columns + ['zip', 'revised_market_value', 'Cluster']].reset_index(drop=True)
+
+
 def read_zip_borough_key(
         zip_borough_loc: str
 ) -> dict:
-    zip_df = pd.read_csv('data/raw/zip_borough.csv')
+    zip_df = pd.read_csv(zip_borough_loc)
     zip_dict = zip_df.set_index('zip')['borough'].to_dict()
 
     return zip_dict
@@ -65,7 +114,8 @@ def read_zip_borough_key(
 
 def main(
         facility_file = 'data/processed/zips_with_clusters.csv',
-        arrest_file = 'data/processed/arrests_outside_buffer_by_zip_2016.csv'
+        arrest_file = 'data/processed/arrests_outside_buffer_by_zip_2016.csv',
+        zip_borough_file = 'data/raw/zip_borough.csv'
 ):
     """
     Pulls together our different functions and groups
@@ -81,7 +131,7 @@ def main(
     )
 
     zip_borough_key = read_zip_borough_key(
-        'data/raw/zip_borough.csv'
+        zip_borough_file
     )
 
     # MERGE
@@ -0,0 +1,146 @@
+import json
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry import mapping, shape
+
+
+def read_zip_geometry(
+        geo_json_zips: dict
+) -> tuple[list, np.ndarray]:
+    """
+    Splits the zipcode geojson into the zipcode keys and an array of
+    shapely geometries (same order)
+    """
+    zips = [f['properties']['ZCTA5CE10'] for f in geo_json_zips['features']]
+    geometry = np.array(
+        [shape(f['geometry']) for f in geo_json_zips['features']],
+        dtype=object
+    )
+
+    return zips, geometry
+
+
+def simplify_zip_geometry(
+        geometry: np.ndarray,
+        tolerance: float,
+        precision: int
+) -> np.ndarray:
+    """
+    Simplifies all zipcode polygons together as one coverage so that
+    neighbouring zipcodes keep sharing the exact same border (no gaps
+    or slivers between them), then rounds the coordinates
+
+    inputs:
+      - geometry: array of the zipcode polygons
+      - tolerance: simplification tolerance in degrees (0 keeps all vertices)
+      - precision: number of decimals kept on each coordinate
+    """
+    if tolerance > 0:
+        geometry = shapely.coverage_simplify(geometry, tolerance)
+
+    return shapely.transform(
+        geometry,
+        lambda coords: np.round(coords, precision)
+    )
+
+
+def process_borough_geometry(
+        geo_json_zips: dict,
+        borough_zips: dict,
+        tolerances: list,
+        precision: int
+) -> dict:
+    """
+    Builds a pre-filtered FeatureCollection per borough and per
+    simplification tolerance
+
+    inputs:
+      - geo_json_zips: geojson of all NYC zipcodes
+      - borough_zips: {borough: [zipcodes]} (see utils.get_borough_zips)
+      - tolerances: simplification tolerances to prepare
+      - precision: number of decimals kept on each coordinate
+
+    output:
+      - {borough: {tolerance: FeatureCollection}}
+    """
+    zips, geometry = read_zip_geometry(geo_json_zips)
+    properties = [f['properties'] for f in geo_json_zips['features']]
+    zip_position = {z: i for i, z in enumerate(zips)}
+
+    borough_geo = {borough: dict() for borough in borough_zips}
+    for tolerance in tolerances:
+        simplified = simplify_zip_geometry(geometry, tolerance, precision)
+        features = [
+            {
+                'type': 'Feature',
+                'properties': properties[i],
+                'geometry': mapping(simplified[i])
+            }
+            for i in range(len(zips))
+        ]
+
+        for borough, b_zips in borough_zips.items():
+            borough_geo[borough][tolerance] = {
+                'type': 'FeatureCollection',
+                'features': [
+                    features[zip_position[z]]
+                    for z in b_zips
+                    if z in zip_position
+                ]
+            }
+
+    return borough_geo
+
+
+def geo_file_name(borough: str, tolerance: float) -> str:
+    """
+    File name of a prepared borough geojson
+    """
+    return f"{borough.replace(' ', '_')}_{tolerance:g}.json"
+
+
+def main(
+        geo_file: str = "data/raw/ny_new_york_zip_codes_geo.min.json",
+        zip_borough_file: str = "data/raw/zip_borough.csv",
+        output_dir: str = "data/processed/geo",
+        tolerances: tuple = (0.0,),
+        precision: int = 5
+):
+    """
+    Writes one geojson per borough and tolerance to the output directory
+    """
+    # Reuse the app loaders so the borough keys match the app
+    from utils import get_borough_geo_zips, get_borough_zips
+
+    with open(geo_file, "rb") as file:
+        geo_json_zips = json.load(file)
+    borough_zips = get_borough_zips(
+        get_borough_geo_zips(geo_json_zips),
+        zip_borough_file
+    )
+
+    borough_geo = process_borough_geometry(
+        geo_json_zips,
+        borough_zips,
+        tolerances,
+        precision
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    for borough, geo_by_tolerance in borough_geo.items():
+        for tolerance, geo in geo_by_tolerance.items():
+            with open(os.path.join(output_dir, geo_file_name(borough, tolerance)), "w") as file:
+                json.dump(geo, file, separators=(',', ':'))
+
+    return borough_geo
+
+
+if __name__ == "__main__":
+    from config import config as cfg
+
+    main(
+        tolerances=cfg["geo_tolerances"],
+        precision=cfg["geo_precision"]
+    )
@@ -0,0 +1,227 @@
+"""
+Zip to zip adjacency graph as a sparse matrix
+
+The graph is computed once from the zipcode polygons with a spatial index
+and cached to disk. Neighbour aggregates of any column (mean, border-length
+weighted mean, k-hop mean) are then a sparse matrix-vector product.
+"""
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+ZIP_FILE = "data/raw/ny_new_york_zip_codes_geo.min.json"
+ADJACENCY_FILE = "data/processed/zip_adjacency.npz"
+
+
+class ZipAdjacency:
+    """
+    Adjacency of the zipcodes
+
+      - zips: zipcode of each row/column of the matrices
+      - adjacency: 1 where two zipcodes share a border or a corner
+      - border_length: length of the shared border (degrees), for weighting
+    """
+
+    def __init__(
+            self,
+            zips: np.ndarray,
+            border_length: sparse.csr_matrix
+    ):
+        self.zips = zips
+        self.zip_index = {z: i for i, z in enumerate(zips)}
+        self.border_length = border_length.tocsr()
+        self.adjacency = self.border_length.copy()
+        self.adjacency.data = np.ones_like(self.adjacency.data)
+
+    def save(self, file_loc: str = ADJACENCY_FILE):
+        np.savez(
+            file_loc,
+            zips=self.zips,
+            indptr=self.border_length.indptr,
+            indices=self.border_length.indices,
+            data=self.border_length.data,
+        )
+
+    @classmethod
+    def load(cls, file_loc: str = ADJACENCY_FILE) -> "ZipAdjacency":
+        with np.load(file_loc) as adjacency:
+            n = len(adjacency['zips'])
+            border_length = sparse.csr_matrix(
+                (adjacency['data'], adjacency['indices'], adjacency['indptr']),
+                shape=(n, n)
+            )
+            return cls(adjacency['zips'], border_length)
+
+    def positions(self, zips) -> np.ndarray:
+        """
+        Position of each zipcode in the graph (-1 when not in the graph)
+        Zipcodes can be given as strings or numbers (e.g. 10001.0)
+        """
+        zips = pd.Series(zips)
+        if zips.dtype != object:
+            zips = zips.astype('Int64').astype(str)
+
+        return np.array([self.zip_index.get(str(z), -1) for z in zips])
+
+    def align(self, zips, values) -> np.ndarray:
+        """
+        Places values given per zipcode in the order of the graph
+        (NaN for the zipcodes of the graph without a value)
+        """
+        aligned = np.full(len(self.zips), np.nan)
+        position = self.positions(zips)
+        known = position >= 0
+        aligned[position[known]] = np.asarray(values, dtype=float)[known]
+
+        return aligned
+
+    def _weighted_mean(
+            self,
+            weights: sparse.csr_matrix,
+            total: np.ndarray,
+            count: np.ndarray
+    ) -> np.ndarray:
+        """
+        Mean of the neighbours' values from the sum and number of values
+        of each zipcode (NaN when a zipcode has no neighbour with a value)
+        """
+        neighbor_total = weights @ total
+        neighbor_count = weights @ count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(neighbor_count > 0, neighbor_total / neighbor_count, np.nan)
+
+    def _weights(self, weighted: bool, k: int) -> sparse.csr_matrix:
+        if k > 1:
+            return self.k_hop(k)
+        return self.border_length if weighted else self.adjacency
+
+    def neighbor_mean(self, values: np.ndarray, weighted: bool = False) -> np.ndarray:
+        """
+        Mean over the adjacent zipcodes, optionally weighted by the length
+        of the shared border
+
+        values: one value per zipcode, in the order of `zips` (see align)
+        """
+        has_value = ~np.isnan(values)
+        return self._weighted_mean(
+            self._weights(weighted, 1),
+            np.where(has_value, values, 0.0),
+            has_value.astype(float)
+        )
+
+    def k_hop(self, k: int) -> sparse.csr_matrix:
+        """
+        Zipcodes reachable within k steps (excluding the zipcode itself)
+        """
+        identity = sparse.identity(len(self.zips), format='csr')
+        step = self.adjacency + identity
+        reach = identity
+        for _ in range(k):
+            reach = reach @ step
+            reach.data = np.ones_like(reach.data)
+
+        reach = (reach - identity).tocsr()
+        reach.eliminate_zeros()
+        return reach
+
+    def k_hop_mean(self, values: np.ndarray, k: int) -> np.ndarray:
+        """
+        Mean over the zipcodes within k steps
+        """
+        has_value = ~np.isnan(values)
+        return self._weighted_mean(
+            self.k_hop(k),
+            np.where(has_value, values, 0.0),
+            has_value.astype(float)
+        )
+
+    def spatial_lag(
+            self,
+            df: pd.DataFrame,
+            columns: list,
+            zip_col: str = 'zip',
+            weighted: bool = False,
+            k: int = 1,
+            suffix: str = '_neighbor_average'
+    ) -> pd.DataFrame:
+        """
+        Adds the neighbour average of each column to the dataframe
+        (one new column per input column, named <column><suffix>)
+
+        Like the row by row sjoin it replaces, the average is over the rows
+        of the neighbouring zipcodes, so a zipcode with several rows (years)
+        counts once per row. Zipcodes outside the graph get NaN
+        """
+        weights = self._weights(weighted, k)
+        position = self.positions(df[zip_col])
+        known = position >= 0
+
+        df = df.copy()
+        for col in columns:
+            values = df[col].to_numpy(dtype=float)
+            has_value = known & ~np.isnan(values)
+            total = np.bincount(position[has_value], values[has_value], len(self.zips))
+            count = np.bincount(position[has_value], minlength=len(self.zips)).astype(float)
+
+            lag = self._weighted_mean(weights, total, count)
+            df[col + suffix] = np.where(known, lag[np.maximum(position, 0)], np.nan)
+
+        return df
+
+
+def build_zip_adjacency(
+        geo_file: str = ZIP_FILE
+) -> ZipAdjacency:
+    """
+    Finds every pair of zipcodes that share a border (or a corner) with
+    one bulk query against a spatial index of the polygons
+    """
+    # A zipcode may be split over several features
+    zips_gdf = gpd.read_file(geo_file).dissolve('ZCTA5CE10').reset_index()
+    geometry = zips_gdf.geometry.values
+    zips = zips_gdf['ZCTA5CE10'].to_numpy(dtype=str)
+
+    left, right = shapely.STRtree(geometry).query(geometry, predicate='intersects')
+    pair = left != right
+    left, right = left[pair], right[pair]
+
+    # Corners only touching have a border length of 0 - keep them as
+    # neighbours with a tiny weight
+    length = shapely.length(shapely.intersection(
+        shapely.boundary(geometry[left]),
+        shapely.boundary(geometry[right])
+    ))
+    length = np.maximum(length, 1e-12)
+
+    border_length = sparse.csr_matrix(
+        (length, (left, right)),
+        shape=(len(zips), len(zips))
+    )
+
+    return ZipAdjacency(zips, border_length)
+
+
+def get_zip_adjacency(
+        geo_file: str = ZIP_FILE,
+        file_loc: str = ADJACENCY_FILE
+) -> ZipAdjacency:
+    """
+    Returns the cached adjacency graph, building and caching it if needed
+    """
+    if os.path.isfile(file_loc):
+        return ZipAdjacency.load(file_loc)
+
+    zip_adjacency = build_zip_adjacency(geo_file)
+    zip_adjacency.save(file_loc)
+
+    return zip_adjacency
+
+
+if __name__ == "__main__":
+    zip_adjacency = build_zip_adjacency()
+    zip_adjacency.save()
+    print(f"{len(zip_adjacency.zips)} zipcodes, {zip_adjacency.adjacency.nnz // 2} adjacent pairs")
@@ -0,0 +1,381 @@
+"""
+Arrest density heat map, rendered server-side as PNG map tiles
+
+The arrest locations (5.7M rows for the full history) are projected once
+to Web Mercator and sorted by the Morton (Z-order) code of their tile at
+a base zoom, so the points of any tile at or above the base zoom are one
+contiguous slice (a searchsorted), and the points of a deeper tile are
+within the slice of its base tile. A tile is the 2-D histogram of its
+points over 256 x 256 pixels (one bincount), colored on a log scale.
+
+Tiles are cached on disk per build of the points; the map requests them
+as a raster layer (figures_utils.get_raster_layer) from the Flask route.
+
+    python src/raster_tiles.py --build                       # project the points
+    python src/raster_tiles.py --zooms 9 14 [--workers 8]    # pre-render the NYC tiles
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from flask import Response
+
+from config import config as cfg
+from hexbin import read_points, source_files
+from metrics import TILE_SECONDS
+
+TILE_SIZE = 256
+NYC_BOUNDS = (-74.27, 40.48, -73.68, 40.93)  # west, south, east, north
+
+# Color of the log-scaled density (0 = transparent), RGBA
+COLOR_STOPS = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+COLORS = np.array([
+    [128, 0, 38, 0],
+    [189, 0, 38, 150],
+    [227, 26, 28, 190],
+    [253, 141, 60, 220],
+    [255, 255, 178, 240],
+])
+
+
+def mercator(longitude, latitude) -> tuple:
+    """
+    Web Mercator coordinates in [0, 1) (x east, y south)
+    """
+    lat = np.radians(np.clip(np.asarray(latitude, dtype=float), -85.05, 85.05))
+    x = (np.asarray(longitude, dtype=float) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    # 16 bit integers -> bits at even positions
+    v = v.astype(np.uint64) & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+
+def morton(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Z-order code of tile coordinates (zoom <= 16)
+    """
+    return _spread_bits(x) | (_spread_bits(y) << np.uint64(1))
+
+
+def tile_range(z: int) -> list:
+    """
+    Tiles (z, x, y) covering NYC at a zoom
+    """
+    west, north = mercator(NYC_BOUNDS[0], NYC_BOUNDS[3])
+    east, south = mercator(NYC_BOUNDS[2], NYC_BOUNDS[1])
+    n = 2 ** z
+    return [
+        (z, tx, ty)
+        for tx in range(int(west * n), int(east * n) + 1)
+        for ty in range(int(north * n), int(south * n) + 1)
+    ]
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """
+    PNG of an (height, width, 4) uint8 array
+    """
+    height, width, _ = rgba.shape
+    # Filter type 0 (none) at the start of every row
+    raw = np.concatenate(
+        [np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)],
+        axis=1
+    ).tobytes()
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(raw, 6))
+        + chunk(b'IEND', b'')
+    )
+
+
+EMPTY_TILE = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+""" ---------------------------------------------------------------
+POINTS
+-------------------------------------------------------------------"""
+
+def resolve_sources(sources: list = cfg['raster tiles']['sources']) -> dict:
+    """
+    {file: [size, modification time]} of the first source available: the
+    full history when downloaded, otherwise the processed arrests (the
+    same arrests, never both)
+    """
+    files = next((files for files in (source_files([s]) for s in sources) if files), [])
+    if not files:
+        raise FileNotFoundError(f"No arrest file for the raster tiles: {sources}")
+
+    return {f: [os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files}
+
+
+def _save(file_loc: str, write):
+    # Written next to the file and renamed, so a worker never maps half a file
+    tmp_loc = f"{file_loc}.{os.getpid()}.tmp"
+    with open(tmp_loc, 'wb') as file:
+        write(file)
+    os.replace(tmp_loc, file_loc)
+
+
+def build_points(
+        sources: list = cfg['raster tiles']['sources'],
+        points_dir: str = cfg['raster tiles']['points dir'],
+        base_zoom: int = cfg['raster tiles']['base zoom']
+) -> dict:
+    """
+    Projects the arrests and writes them sorted by base tile:
+      - xy.npy: Web Mercator x, y (float64, n x 2)
+      - code.npy: Morton code of the base tile of each point (uint64)
+      - meta.json: base zoom, density reference, build id and the source
+        files (size, modification time) the points were read from
+    """
+    source_state = resolve_sources(sources)
+    files = list(source_state)
+
+    df = pd.concat([read_points(f) for f in files], ignore_index=True)
+    df = df.dropna(subset=['latitude', 'longitude'])
+    x, y = mercator(df['longitude'].to_numpy(), df['latitude'].to_numpy())
+
+    n = 2 ** base_zoom
+    code = morton((x * n).astype(np.int64), (y * n).astype(np.int64))
+    order = np.argsort(code, kind='stable')
+    xy = np.column_stack([x, y])[order]
+    code = code[order]
+
+    # Density of a busy pixel at the base zoom - the color scale of the
+    # other zooms follows the pixel area (x4 per zoom level)
+    pixels = (y * n * TILE_SIZE).astype(np.int64) * (n * TILE_SIZE) + (x * n * TILE_SIZE).astype(np.int64)
+    _, pixel_counts = np.unique(pixels, return_counts=True)
+    reference = float(np.percentile(pixel_counts, 99)) if len(pixel_counts) else 1.0
+
+    meta = {
+        'base_zoom': base_zoom,
+        'reference': reference,
+        'n_points': int(len(xy)),
+        'sources': source_state,
+        'build': hashlib.sha1(
+            code.tobytes() + xy[:1000].tobytes() + json.dumps(source_state, sort_keys=True).encode()
+        ).hexdigest()[:12],
+    }
+    os.makedirs(points_dir, exist_ok=True)
+    _save(os.path.join(points_dir, 'xy.npy'), lambda file: np.save(file, xy))
+    _save(os.path.join(points_dir, 'code.npy'), lambda file: np.save(file, code))
+    # meta.json last: it marks the build as complete
+    _save(os.path.join(points_dir, 'meta.json'), lambda file: file.write(json.dumps(meta).encode()))
+
+    logging.info(f"{len(xy):,} arrest points projected from {files}")
+
+    return meta
+
+
+class TileRenderer:
+    """
+    Renders and caches the density tiles of the projected points
+
+    The point arrays are memory-mapped, so the processes of a pool (and
+    the app workers) share them
+    """
+
+    def __init__(
+            self,
+            points_dir: str = cfg['raster tiles']['points dir'],
+            tile_dir: str = cfg['raster tiles']['tile dir']
+    ):
+        with open(os.path.join(points_dir, 'meta.json')) as file:
+            self.meta = json.load(file)
+        self.xy = np.load(os.path.join(points_dir, 'xy.npy'), mmap_mode='r')
+        self.code = np.load(os.path.join(points_dir, 'code.npy'), mmap_mode='r')
+        self.base_zoom = self.meta['base_zoom']
+        # Tiles of another build of the points are never reused
+        self.tile_dir = os.path.join(tile_dir, self.meta['build'])
+
+    def points(self, z: int, x: int, y: int) -> np.ndarray:
+        """
+        Web Mercator x, y of the points in a tile
+        """
+        if z <= self.base_zoom:
+            shift = 2 * (self.base_zoom - z)
+            code = int(morton(np.array([x]), np.array([y]))[0])
+            first, last = np.searchsorted(self.code, [code << shift, (code + 1) << shift])
+            return self.xy[first:last]
+
+        # Deeper tiles: the points of the base tile, filtered
+        shift = z - self.base_zoom
+        code = int(morton(np.array([x >> shift]), np.array([y >> shift]))[0])
+        first, last = np.searchsorted(self.code, [code, code + 1])
+        xy = self.xy[first:last]
+        n = 2 ** z
+        inside = (
+            (xy[:, 0] >= x / n) & (xy[:, 0] < (x + 1) / n)
+            & (xy[:, 1] >= y / n) & (xy[:, 1] < (y + 1) / n)
+        )
+        return xy[inside]
+
+    def counts(self, z: int, x: int, y: int) -> np.ndarray:
+        """
+        Points per pixel of a tile (TILE_SIZE x TILE_SIZE, row = south)
+        """
+        xy = self.points(z, x, y)
+        n = 2 ** z
+        px = np.clip(((xy[:, 0] * n - x) * TILE_SIZE).astype(np.int64), 0, TILE_SIZE - 1)
+        py = np.clip(((xy[:, 1] * n - y) * TILE_SIZE).astype(np.int64), 0, TILE_SIZE - 1)
+
+        return np.bincount(py * TILE_SIZE + px, minlength=TILE_SIZE ** 2).reshape(TILE_SIZE, TILE_SIZE)
+
+    def render(self, z: int, x: int, y: int) -> bytes:
+        counts = self.counts(z, x, y)
+        if not counts.any():
+            return EMPTY_TILE
+
+        reference = max(self.meta['reference'] * 4.0 ** (self.base_zoom - z), 1.0)
+        level = np.clip(np.log1p(counts) / np.log1p(reference), 0, 1)
+        rgba = np.stack(
+            [np.interp(level, COLOR_STOPS, COLORS[:, i]) for i in range(4)],
+            axis=2
+        ).astype(np.uint8)
+        rgba[counts == 0] = 0
+
+        return encode_png(rgba)
+
+    def tile_file(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.tile_dir, str(z), str(x), f"{y}.png")
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        """
+        PNG of a tile, from the disk cache or rendered (and cached)
+        """
+        file_loc = self.tile_file(z, x, y)
+        start = time.perf_counter()
+        if os.path.isfile(file_loc):
+            with open(file_loc, 'rb') as file:
+                png = file.read()
+            TILE_SECONDS.observe(time.perf_counter() - start, cache='hit')
+            return png
+
+        png = self.render(z, x, y)
+        os.makedirs(os.path.dirname(file_loc), exist_ok=True)
+        tmp_loc = f"{file_loc}.{os.getpid()}.tmp"
+        with open(tmp_loc, 'wb') as file:
+            file.write(png)
+        os.replace(tmp_loc, file_loc)
+        TILE_SECONDS.observe(time.perf_counter() - start, cache='miss')
+
+        return png
+
+
+def get_tile_renderer(
+        sources: list = cfg['raster tiles']['sources'],
+        points_dir: str = cfg['raster tiles']['points dir']
+) -> TileRenderer:
+    """
+    Renderer of the projected points, projecting them again when they are
+    missing or the source files changed (e.g. the full history was
+    downloaded since) - the new build gets its own tile directory
+    """
+    meta_loc = os.path.join(points_dir, 'meta.json')
+    meta = dict()
+    if os.path.isfile(meta_loc):
+        with open(meta_loc) as file:
+            meta = json.load(file)
+
+    if meta.get('sources') != resolve_sources(sources):
+        build_points(sources, points_dir)
+
+    return TileRenderer(points_dir)
+
+
+""" ---------------------------------------------------------------
+PRE-RENDERING
+-------------------------------------------------------------------"""
+
+_renderer = None
+
+
+def _render_tiles(tiles: list) -> int:
+    # One renderer per pool process, the points are mapped once
+    global _renderer
+    if _renderer is None:
+        _renderer = TileRenderer()
+    for tile in tiles:
+        _renderer.tile(*tile)
+    return len(tiles)
+
+
+def render_tiles(
+        tiles: list,
+        max_workers: int | None = None,
+        batch_size: int = 64
+) -> int:
+    """
+    Renders (and caches) tiles in parallel processes
+    """
+    # Projects the points again first if the sources changed - the pool
+    # processes only map them
+    get_tile_renderer()
+    batches = [tiles[i:i + batch_size] for i in range(0, len(tiles), batch_size)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return sum(executor.map(_render_tiles, batches))
+
+
+def register_tile_route(
+        server,
+        get_renderer,
+        route: str = '/tiles/arrests/<int:z>/<int:x>/<int:y>.png',
+        zooms: list = cfg['raster tiles']['zooms']
+):
+    """
+    Adds the tile endpoint to the Flask server
+
+    get_renderer: returns the TileRenderer (called per request, so the
+    points can be mapped on first use)
+    """
+    def tile(z, x, y):
+        if not zooms[0] <= z <= zooms[1] or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return Response(status=404)
+        try:
+            png = get_renderer().tile(z, x, y)
+        except FileNotFoundError as e:
+            logging.warning(e)
+            return Response(status=404)
+
+        return Response(png, mimetype='image/png', headers={'Cache-Control': 'public, max-age=86400'})
+
+    server.add_url_rule(route, 'arrest_tile', tile, methods=['GET'])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--build", action="store_true", help="project the arrest points")
+    parser.add_argument("--zooms", type=int, nargs=2, help="pre-render the NYC tiles of these zooms")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    if args.build:
+        build_points()
+    if args.zooms:
+        tiles = [tile for z in range(args.zooms[0], args.zooms[1] + 1) for tile in tile_range(z)]
+        start = time.perf_counter()
+        n_tiles = render_tiles(tiles, args.workers)
+        logging.info(f"{n_tiles} tiles in {time.perf_counter() - start:.1f}s")
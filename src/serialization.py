@@ -0,0 +1,244 @@
+"""
+JSON encoding and compression of the callback responses
+
+The figures are mostly geojson coordinates and numpy arrays. Dash encodes
+callback outputs with plotly's encoder, which converts every array to a
+list and decodes / re-encodes the whole document to replace NaN with null.
+Here:
+  - the geojson of a borough is encoded once (JSONFragment) and copied
+    into every response as is
+  - numpy arrays are written directly (orjson when installed, otherwise
+    the json module with NaN replaced in the arrays only)
+  - anything else falls back to plotly's encoder
+
+Responses of the callback endpoint are then compressed (brotli when
+installed and accepted by the browser, otherwise gzip).
+"""
+import gzip
+import json
+import logging
+import pickle
+
+import numpy as np
+from flask import request
+
+from config import config as cfg
+from metrics import RESPONSE_ENCODE_SECONDS, timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class JSONFragment:
+    """
+    Value already encoded as JSON, written as is in the responses
+
+    The UTF-8 text is pickled out of band, so in the app snapshot it stays
+    a read-only view of the memory-mapped file, shared by the workers.
+    Plotly's encoder (and so pio.to_json) decodes it back through
+    `to_plotly_json`
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            self.data = value
+        elif isinstance(value, str):
+            self.data = value.encode()
+        else:
+            self.data = json.dumps(value, separators=(',', ':')).encode()
+
+    @property
+    def json(self) -> str:
+        return str(self.data, 'utf-8')
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return JSONFragment, (pickle.PickleBuffer(self.data),)
+        return JSONFragment, (bytes(self.data),)
+
+    def to_plotly_json(self):
+        return json.loads(self.json)
+
+
+def _array_to_list(array: np.ndarray) -> list:
+    # NaN / inf are not valid JSON, plotly writes them as null
+    if array.dtype.kind == 'f' and not np.isfinite(array).all():
+        array = np.where(np.isfinite(array), array.astype(object), None)
+    return array.tolist()
+
+
+def _orjson_default(value):
+    if isinstance(value, JSONFragment):
+        # orjson copies from bytes or str only
+        return orjson.Fragment(bytes(value.data))
+    if isinstance(value, np.ndarray):
+        # dtypes orjson does not write (object, strings)
+        return _array_to_list(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, 'to_plotly_json'):
+        return value.to_plotly_json()
+    raise TypeError
+
+
+class _Encoder(json.JSONEncoder):
+    """
+    json module encoder: fragments are written as placeholders and
+    replaced after encoding
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.fragments = []
+
+    def default(self, value):
+        if isinstance(value, JSONFragment):
+            self.fragments.append(value.json)
+            return f"\0{len(self.fragments) - 1}\0"
+        if isinstance(value, np.ndarray):
+            return _array_to_list(value)
+        if isinstance(value, np.generic):
+            return value.item()
+        if hasattr(value, 'to_plotly_json'):
+            return value.to_plotly_json()
+        return super().default(value)
+
+
+def to_json(value) -> str:
+    """
+    Encodes a callback response (same output as plotly's encoder)
+    """
+    try:
+        if orjson is not None:
+            return orjson.dumps(
+                value,
+                default=_orjson_default,
+                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            ).decode()
+
+        encoder = _Encoder(separators=(',', ':'), allow_nan=False)
+        encoded = encoder.encode(value)
+        for i, fragment in enumerate(encoder.fragments):
+            encoded = encoded.replace(f'"\\u0000{i}\\u0000"', fragment, 1)
+        return encoded
+
+    except (TypeError, ValueError):
+        # NaN outside arrays, dates, ...
+        from plotly.io.json import to_json_plotly
+        return to_json_plotly(value)
+
+
+_template_size = None
+
+
+def _encoded_template_size(template) -> int:
+    # Every figure of the app has the same layout template (a few kB, and
+    # most of the time of the walk): it is encoded once
+    global _template_size
+    if _template_size is None:
+        _template_size = len(to_json(template))
+    return _template_size
+
+
+def encoded_size(value) -> int:
+    """
+    Estimate of the length of to_json(value), without encoding it:
+    fragments count their exact length, arrays ~ their values written as
+    text, containers the sum of their items
+    """
+    if isinstance(value, JSONFragment):
+        return len(value.data)
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind in 'US':
+            return value.size * (value.dtype.itemsize // (4 if value.dtype.kind == 'U' else 1) + 3)
+        if value.dtype.kind == 'O':
+            return sum(encoded_size(v) + 1 for v in value.ravel())
+        return value.size * 20
+    if isinstance(value, dict):
+        return sum(
+            len(str(k)) + 4 + (_encoded_template_size(v) if k == 'template' else encoded_size(v))
+            for k, v in value.items()
+        ) + 2
+    if isinstance(value, (list, tuple)):
+        return sum(encoded_size(v) + 1 for v in value) + 2
+    if hasattr(value, 'to_plotly_json'):
+        return encoded_size(value.to_plotly_json())
+    return 8
+
+
+def use_for_callbacks() -> bool:
+    """
+    Makes Dash encode the callback responses with `to_json` (True when it does)
+
+    Dash has no setting for its encoder, the function it imported from
+    dash._utils is replaced in dash._callback (checked with dash 3.0.3,
+    the version pinned in requirements.txt). When another version no
+    longer has it, Dash's own encoder is kept and a warning is logged -
+    the responses are then not timed in dash_response_encode_seconds
+    """
+    import dash
+    import dash._callback
+
+    if not callable(getattr(dash._callback, 'to_json', None)):
+        logging.warning(
+            f"dash {dash.__version__} has no dash._callback.to_json: callback "
+            "responses are encoded (and not timed) by Dash's own encoder"
+        )
+        return False
+
+    dash._callback.to_json = timed(RESPONSE_ENCODE_SECONDS)(to_json)
+    logging.info(f"Callback responses encoded with {'orjson' if orjson else 'json'}")
+    return True
+
+
+""" ---------------------------------------------------------------
+COMPRESSION
+-------------------------------------------------------------------"""
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=cfg['brotli quality'])
+    return gzip.compress(data, compresslevel=cfg['gzip level'])
+
+
+def register_compression(
+        server,
+        paths: tuple = ('/_dash-update-component',),
+        min_size: int = cfg['compress min size']
+):
+    """
+    Compresses the responses of `paths` on the Flask server when the
+    browser accepts it
+    """
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    @server.after_request
+    def compress_response(response):
+        if (
+            request.path not in paths
+            or response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+        ):
+            return response
+
+        encoding = request.accept_encodings.best_match(encodings)
+        data = response.get_data()
+        if encoding is None or len(data) < min_size:
+            return response
+
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+
+        return response
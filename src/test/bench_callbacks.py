@@ -0,0 +1,295 @@
+"""
+Load test of the app's server callbacks
+
+Replays interaction traces - borough switches, graph type changes, click
+bursts, 50 zipcode lasso selections and what-if changes - from many
+simulated users at once. The callbacks (update_map_title,
+update_region_postcode, update_Choropleth) are called directly with a
+mocked callback context, in the order the browser would fire them.
+
+The zipcode dropdown (update_zipcode_dropdown) and the highlight run in
+the browser (assets/clientside.js): the traces apply the same selection
+rules to the user's state and the report counts these events, they cost
+no server call.
+
+Reports p50/p95/p99 latency and payload bytes per callback, the memory of
+the process and the callback cache counters, and saves them as json so
+runs can be compared across commits.
+
+Run from the project root:
+    python src/test/bench_callbacks.py [--users 20] [--events 200] [--out bench.json]
+    python src/test/bench_callbacks.py --traces traces.json   # replay recorded traces
+    python src/test/bench_callbacks.py --compare old.json     # p95 against a previous run
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+
+sys.path.append(os.getcwd())  # app.py is at the project root
+import app
+from config import config as cfg
+from serialization import to_json
+
+# Share of each interaction in the generated traces
+EVENT_WEIGHTS = {
+    "borough": 0.1,
+    "graph-type": 0.2,
+    "click-burst": 0.4,
+    "lasso": 0.2,
+    "what-if": 0.1,
+}
+
+
+""" ---------------------------------------------------------------
+TRACES
+-------------------------------------------------------------------"""
+
+def record_traces(n_users: int, n_events: int, seed: int = 0) -> list:
+    """
+    One list of events per user:
+      {"type": "borough" | "graph-type", "value": ...}
+      {"type": "click-burst", "zips": [...]}  (one click per zipcode)
+      {"type": "lasso", "zips": [...]}  (50 zipcodes of the borough)
+      {"type": "what-if", "feature": ..., "delta": ...}
+    """
+    rng = random.Random(seed)
+    features = app.app_data["what_if_features"]
+
+    traces = []
+    for _ in range(n_users):
+        borough = rng.choice(app.boroughs)
+        trace = [{"type": "borough", "value": borough}]
+        for event_type in rng.choices(list(EVENT_WEIGHTS), weights=list(EVENT_WEIGHTS.values()), k=n_events):
+            zips = sorted(app.zip_dict[borough])
+            if event_type == "borough":
+                borough = rng.choice(app.boroughs)
+                trace.append({"type": "borough", "value": borough})
+            elif event_type == "graph-type":
+                trace.append({"type": "graph-type", "value": rng.choice(app.graph_types)})
+            elif event_type == "click-burst":
+                trace.append({"type": "click-burst", "zips": rng.choices(zips, k=rng.randint(2, 8))})
+            elif event_type == "lasso":
+                trace.append({"type": "lasso", "zips": rng.sample(zips, min(50, len(zips)))})
+            else:
+                trace.append({
+                    "type": "what-if",
+                    "feature": rng.choice(features),
+                    "delta": rng.choice([-2, -1, 1, 2, 5]),
+                })
+        traces.append(trace)
+
+    return traces
+
+
+def select_zips(zips: list, event: dict, top_n: int = cfg["topN"]) -> list:
+    """
+    Zipcode dropdown after a click burst or a lasso (same rules as
+    update_zipcode_dropdown in assets/clientside.js)
+    """
+    if event["type"] == "lasso":
+        return event["zips"][:top_n]
+
+    zips = list(zips)
+    for z in event["zips"]:
+        if z in zips:
+            zips.remove(z)
+        elif len(zips) < top_n:
+            zips.append(z)
+    return zips
+
+
+""" ---------------------------------------------------------------
+REPLAY
+-------------------------------------------------------------------"""
+
+class Recorder:
+    """
+    Latency and payload size of every call, by callback (thread safe)
+    """
+
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.payload = defaultdict(list)
+        self.clientside = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def call(self, name: str, trigger: str, func, *args):
+        context_value.set(AttributeDict(triggered_inputs=[{"prop_id": trigger, "value": args[0]}]))
+        t0 = time.perf_counter()
+        output = func(*args)
+        latency = time.perf_counter() - t0
+        size = len(to_json(output))
+        with self._lock:
+            self.latency[name].append(latency)
+            self.payload[name].append(size)
+        return output
+
+    def count_clientside(self, name: str):
+        with self._lock:
+            self.clientside[name] += 1
+
+
+def replay(trace: list, recorder: Recorder):
+    """
+    Replays the events of one user, firing the callbacks each one triggers
+    """
+    borough, gtype = app.initial_borough, app.graph_types[0]
+    zips, feature, delta = [], None, None
+
+    for event in trace:
+        if event["type"] == "borough":
+            borough, zips = event["value"], []
+            recorder.call("update_map_title", "borough.value", app.update_map_title, borough, gtype)
+            recorder.call("update_region_postcode", "borough.value", app.update_region_postcode, borough)
+            recorder.call("update_Choropleth", "borough.value", app.update_Choropleth,
+                          borough, gtype, feature, delta, zips)
+            recorder.count_clientside("update_zipcode_dropdown")
+        elif event["type"] == "graph-type":
+            gtype = event["value"]
+            recorder.call("update_map_title", "graph-type.value", app.update_map_title, borough, gtype)
+            recorder.call("update_Choropleth", "graph-type.value", app.update_Choropleth,
+                          borough, gtype, feature, delta, zips)
+        elif event["type"] == "what-if":
+            # The scenario is only shown on the What-If graph type, which
+            # the user selects first
+            if gtype != "What-If":
+                gtype = "What-If"
+                recorder.call("update_map_title", "graph-type.value", app.update_map_title, borough, gtype)
+                recorder.call("update_Choropleth", "graph-type.value", app.update_Choropleth,
+                              borough, gtype, feature, delta, zips)
+            feature, delta = event["feature"], event["delta"]
+            recorder.call("update_Choropleth", "whatif-delta.value", app.update_Choropleth,
+                          borough, gtype, feature, delta, zips)
+        else:
+            zips = select_zips(zips, event)
+            recorder.count_clientside("update_zipcode_dropdown")
+            recorder.count_clientside("highlight")
+
+
+def max_rss_mb() -> float:
+    # kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb() -> float | None:
+    """
+    Current resident memory (Linux only)
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        return None
+
+
+def run(traces: list, n_workers: int) -> dict:
+    app.callback_cache.clear()
+    recorder = Recorder()
+    rss_start = rss_mb()
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for future in [executor.submit(replay, trace, recorder) for trace in traces]:
+            future.result()
+    elapsed = time.perf_counter() - t0
+
+    callbacks = dict()
+    for name, latency in recorder.latency.items():
+        latency_ms = np.array(latency) * 1e3
+        payload = np.array(recorder.payload[name])
+        callbacks[name] = {
+            "calls": len(latency),
+            "p50_ms": float(np.percentile(latency_ms, 50)),
+            "p95_ms": float(np.percentile(latency_ms, 95)),
+            "p99_ms": float(np.percentile(latency_ms, 99)),
+            "max_ms": float(latency_ms.max()),
+            "payload_mean_bytes": float(payload.mean()),
+            "payload_p95_bytes": float(np.percentile(payload, 95)),
+            "payload_total_bytes": int(payload.sum()),
+        }
+
+    n_calls = sum(c["calls"] for c in callbacks.values())
+
+    return {
+        "users": len(traces),
+        "events": sum(len(trace) for trace in traces),
+        "workers": n_workers,
+        "seconds": elapsed,
+        "calls_per_second": n_calls / elapsed,
+        "callbacks": callbacks,
+        "clientside_events": dict(recorder.clientside),
+        "memory": {"rss_start_mb": rss_start, "rss_end_mb": rss_mb(), "max_rss_mb": max_rss_mb()},
+        "callback_cache": app.callback_cache.stats(),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, previous: dict):
+    print(f"\np95 (ms) against {previous.get('commit')}:")
+    for name, stats in results["callbacks"].items():
+        before = previous["callbacks"].get(name)
+        if before is not None:
+            print(f"  {name:<24} {before['p95_ms']:8.2f} -> {stats['p95_ms']:8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--events", type=int, default=200, help="events per user")
+    parser.add_argument("--workers", type=int, help="concurrent users (default: all)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--traces", help="json file of recorded traces to replay")
+    parser.add_argument("--save-traces", help="json file to save the generated traces")
+    parser.add_argument("--out", default="bench_callbacks.json")
+    parser.add_argument("--compare", help="json results of a previous run")
+    args = parser.parse_args()
+
+    if args.traces:
+        with open(args.traces) as file:
+            traces = json.load(file)
+    else:
+        traces = record_traces(args.users, args.events, args.seed)
+        if args.save_traces:
+            with open(args.save_traces, "w") as file:
+                json.dump(traces, file)
+
+    results = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    results.update(run(traces, args.workers or len(traces)))
+
+    print(f"{results['users']} users, {results['events']} events, "
+          f"{results['calls_per_second']:,.0f} calls/s")
+    for name, stats in results["callbacks"].items():
+        print(f"  {name:<24} {stats['calls']:>6} calls  p50 {stats['p50_ms']:7.2f}ms  "
+              f"p95 {stats['p95_ms']:7.2f}ms  p99 {stats['p99_ms']:7.2f}ms  "
+              f"{stats['payload_mean_bytes'] / 1e3:8.1f} kB")
+    print(f"  clientside: {results['clientside_events']}")
+    print(f"  memory: {results['memory']}")
+    print(f"  callback cache: {results['callback_cache']}")
+
+    with open(args.out, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
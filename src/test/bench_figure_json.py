@@ -0,0 +1,80 @@
+"""
+Benchmark of the callback response encoding
+
+For every borough x graph type of the figure cache, reports the size of
+the encoded base figure (raw, gzip and brotli when installed) and the
+encode time with plotly's encoder and with serialization.to_json
+
+Run from the project root:
+    python src/test/bench_figure_json.py [--repeat 5] [--out bench.csv]
+"""
+import argparse
+import json
+import time
+
+import pandas as pd
+from plotly.io.json import to_json_plotly
+
+from app_data import load_app_data
+from serialization import JSONFragment, brotli, compress, orjson, to_json
+
+BOROUGHS = ["NYC", "Manhattan", "Brooklyn", "Queens", "Bronx", "Staten Island"]
+GRAPH_TYPES = ["Market Value", "Arrests outside 1000'", "Neighborhood Cluster", "Model Error", "What-If"]
+
+
+def expand_fragments(figure: dict) -> dict:
+    """
+    Figure with its geojson as objects - what plotly's encoder used to get
+    """
+    trace = dict(figure["data"][0])
+    if isinstance(trace.get("geojson"), JSONFragment):
+        trace["geojson"] = json.loads(trace["geojson"].json)
+    return {"data": [trace] + list(figure["data"][1:]), "layout": figure["layout"]}
+
+
+def best_time(func, value, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(value)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def bench(figure_cache: dict, repeat: int) -> pd.DataFrame:
+    rows = []
+    for (borough, gtype), figure in figure_cache.items():
+        # Same document as Dash sends for the base-figure store
+        response = {"multi": True, "response": {"base-figure": {"data": figure}}}
+        plotly_response = {"multi": True, "response": {"base-figure": {"data": expand_fragments(figure)}}}
+
+        encoded = to_json(response).encode()
+        assert json.loads(encoded) == json.loads(to_json_plotly(plotly_response))
+
+        rows.append({
+            "borough": borough,
+            "graph type": gtype,
+            "kB": len(encoded) / 1e3,
+            "gzip kB": len(compress(encoded, 'gzip')) / 1e3,
+            "br kB": len(compress(encoded, 'br')) / 1e3 if brotli is not None else None,
+            "plotly ms": best_time(to_json_plotly, plotly_response, repeat) * 1e3,
+            "to_json ms": best_time(to_json, response, repeat) * 1e3,
+        })
+
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="csv file for the results")
+    args = parser.parse_args()
+
+    app_data = load_app_data(BOROUGHS, GRAPH_TYPES, initial_year=2016)
+    results = bench(app_data["figure_cache"], args.repeat)
+
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}, "
+          f"brotli: {'yes' if brotli is not None else 'no'}")
+    print(results.round(2).to_string(index=False))
+    if args.out:
+        results.to_csv(args.out, index=False)
@@ -0,0 +1,93 @@
+"""
+Benchmark of the zipcode assignment in process_arrests
+
+Reports rows per second for building the points and matching them to the
+zipcode polygons at 100k, 1M and 6M arrests (the historic dataset is ~5.7M)
+
+Run from the project root:
+    python src/test/bench_process_arrests.py [--baseline]
+
+--baseline also times the previous row-wise apply + gpd.sjoin on 100k rows
+"""
+import argparse
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Point, box
+
+from process.process_arrests import assign_zips, read_zip_tree
+
+ZIP_FILE = "data/raw/ny_new_york_zip_codes_geo.min.json"
+NYC_BOUNDS = (-74.26, 40.49, -73.70, 40.92)  # lon/lat bounding box
+SIZES = [100_000, 1_000_000, 6_000_000]
+
+
+def synthetic_zip_tree(n_side: int = 16) -> tuple[shapely.STRtree, np.ndarray]:
+    """
+    Grid of polygons over NYC, used when the zipcode geojson is not available
+    """
+    lon = np.linspace(NYC_BOUNDS[0], NYC_BOUNDS[2], n_side + 1)
+    lat = np.linspace(NYC_BOUNDS[1], NYC_BOUNDS[3], n_side + 1)
+    cells = [
+        shapely.segmentize(box(lon[i], lat[j], lon[i+1], lat[j+1]), 0.0005)
+        for i in range(n_side)
+        for j in range(n_side)
+    ]
+    return shapely.STRtree(cells), np.array([str(10000 + i) for i in range(len(cells))])
+
+
+def random_points(n: int, seed: int = 42) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    longitude = rng.uniform(NYC_BOUNDS[0], NYC_BOUNDS[2], n)
+    latitude = rng.uniform(NYC_BOUNDS[1], NYC_BOUNDS[3], n)
+    return longitude, latitude
+
+
+def bench_vectorized(zip_tree, n: int) -> float:
+    longitude, latitude = random_points(n)
+    t0 = time.perf_counter()
+    assign_zips(longitude, latitude, zip_tree)
+    return time.perf_counter() - t0
+
+
+def bench_baseline(zip_tree, n: int) -> float:
+    """
+    Row-wise Point construction followed by gpd.sjoin (previous implementation)
+    """
+    longitude, latitude = random_points(n)
+    arrests = pd.DataFrame({'longitude': longitude, 'latitude': latitude})
+    zips = gpd.GeoDataFrame(geometry=list(zip_tree.geometries), crs="EPSG:4326")
+
+    t0 = time.perf_counter()
+    arrests['geometry'] = arrests.apply(
+        lambda x: Point(x['longitude'], x['latitude']), axis=1
+    )
+    arrests_gdf = gpd.GeoDataFrame(arrests, geometry='geometry', crs="EPSG:4326")
+    gpd.sjoin(arrests_gdf, zips, how='inner')
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", action="store_true")
+    args = parser.parse_args()
+
+    if os.path.isfile(ZIP_FILE):
+        zip_tree, _ = read_zip_tree(ZIP_FILE)
+        print(f"Zipcode polygons: {ZIP_FILE}")
+    else:
+        zip_tree, _ = synthetic_zip_tree()
+        print("Zipcode polygons: synthetic grid (geojson not found)")
+
+    if args.baseline:
+        n = SIZES[0]
+        elapsed = bench_baseline(zip_tree, n)
+        print(f"baseline   {n:>10,} rows {elapsed:8.2f}s {n / elapsed:>12,.0f} rows/s")
+
+    for n in SIZES:
+        elapsed = bench_vectorized(zip_tree, n)
+        print(f"vectorized {n:>10,} rows {elapsed:8.2f}s {n / elapsed:>12,.0f} rows/s")
@@ -0,0 +1,85 @@
+"""
+Memory cost of the app data per worker
+
+Starts N processes that each map the app snapshot (as gunicorn workers
+do), read every array and encode every base figure, then report how much
+their memory grew: private memory is what each worker adds, shared pages
+are the mapped snapshot (counted once however many workers map it).
+
+Run from the project root, after `python app.py --snapshot`:
+    python src/test/bench_worker_memory.py [--workers 4]
+"""
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+BOROUGHS = ["Bronx", "Staten Island", "Brooklyn", "Manhattan", "Queens", "NYC"]
+GRAPH_TYPES = ["Market Value", "Arrests outside 1000'", "Neighborhood Cluster", "Model Error", "What-If"]
+
+
+def memory_mb() -> dict:
+    """
+    Rss, Pss, shared and private memory of the process (Linux)
+    """
+    memory = dict()
+    with open("/proc/self/smaps_rollup") as file:
+        for line in file:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:", "Shared_Clean:", "Private_Clean:", "Private_Dirty:"):
+                memory[parts[0][:-1]] = int(parts[1]) / 1024
+    return memory
+
+
+def touch(data: dict):
+    """
+    Reads every array and encodes every figure, as the callbacks would
+    """
+    from serialization import to_json
+
+    for array in data["summary_market_value"].columns.values():
+        np.ascontiguousarray(array).view(np.uint8).sum()
+    for figure in data["figure_cache"].values():
+        to_json(figure)
+
+
+def worker(barrier, results):
+    from app_data import read_snapshot, snapshot_fingerprint
+    from config import config as cfg
+
+    before = memory_mb()
+    fingerprint = snapshot_fingerprint(boroughs=BOROUGHS, graph_types=GRAPH_TYPES, initial_year=2016)
+    data = read_snapshot(cfg["snapshot file"], fingerprint)
+    if data is None:
+        raise RuntimeError("No current snapshot, run `python app.py --snapshot` first")
+    touch(data)
+
+    # Every worker holds the data at the same time, so Pss splits the
+    # shared pages between them
+    barrier.wait()
+    after = memory_mb()
+    results.append({k: after[k] - before[k] for k in before})
+    barrier.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    with ctx.Manager() as manager:
+        barrier = manager.Barrier(args.workers)
+        results = manager.list()
+        processes = [ctx.Process(target=worker, args=(barrier, results)) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        results = pd.DataFrame(list(results))
+
+    print(f"Memory added by the app data, per worker (MB, {args.workers} workers):")
+    print(results.round(2).to_string())
+    print(f"\nprivate per worker: {(results['Private_Clean'] + results['Private_Dirty']).mean():.2f} MB")
@@ -0,0 +1,105 @@
+"""
+Runs the bulk SODA client against a local stand-in server
+
+The server mimics the SODA paging semantics used by nyc_api_bulk_read:
+  - /resource/<id>.json?$select=count(*) as count  -> [{"count": "<n>"}]
+  - /resource/<id>.csv?$limit=&$offset=&$order=   -> CSV page with header
+and fails a share of the requests with 503 to exercise the retries
+
+Run from the project root:
+    python src/test/socrata_test.py
+"""
+import csv
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pyarrow.parquet as pq
+
+from process.api_socrata import nyc_api_bulk_read
+
+N_ROWS = 12_345
+COLUMNS = [':id', 'arrest_key', 'law_cat_cd', 'latitude', 'longitude']
+FAILURE_RATE = 0.2
+
+rng = random.Random(7)
+ROWS = [
+    {
+        ':id': f"row-{i:06d}",
+        'arrest_key': str(100_000 + i),
+        'law_cat_cd': rng.choice(['F', 'M', 'V', '']),
+        'latitude': f"{40.5 + rng.random() / 2:.6f}",
+        'longitude': f"{-74.2 + rng.random() / 2:.6f}",
+    }
+    for i in range(N_ROWS)
+]
+rng.shuffle(ROWS)  # storage order differs from :id order
+
+
+class SodaHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: str, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_GET(self):
+        if rng.random() < FAILURE_RATE:
+            return self._send(503, 'unavailable', 'text/plain')
+
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path.endswith('.json') and query.get('$select', '').startswith('count(*)'):
+            return self._send(200, json.dumps([{'count': str(len(ROWS))}]), 'application/json')
+
+        if url.path.endswith('.csv'):
+            rows = ROWS
+            if '$order' in query:
+                rows = sorted(rows, key=lambda r: r[query['$order']])
+            offset = int(query.get('$offset', 0))
+            limit = int(query.get('$limit', 1000))
+
+            body = io.StringIO()
+            writer = csv.DictWriter(body, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows[offset:offset + limit])
+            return self._send(200, body.getvalue(), 'text/csv')
+
+        self._send(404, 'not found', 'text/plain')
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SodaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/resource/test-data.json"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_loc = os.path.join(tmp, 'test-data.parquet')
+        n_written = nyc_api_bulk_read(
+            url,
+            output_loc,
+            page_size=1000,
+            max_workers=4,
+            backoff=0.01
+        )
+        table = pq.read_table(output_loc)
+
+    server.shutdown()
+
+    expected = sorted(ROWS, key=lambda r: r[':id'])
+    assert n_written == N_ROWS, n_written
+    assert table.num_rows == N_ROWS, table.num_rows
+    assert table.column_names == COLUMNS, table.column_names
+    assert table.column(':id').to_pylist() == [r[':id'] for r in expected]
+    assert table.column('law_cat_cd').to_pylist() == [r['law_cat_cd'] or None for r in expected]
+    print(f"OK - {table.num_rows} rows in {table.num_rows // 1000 + 1} pages")
@@ -2,28 +2,175 @@ import pandas as pd
 import numpy as np
 import json
 import csv
+import glob
+import logging
+import os
+import threading
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 
+from arrest_cube import ArrestCube, build_arrest_cube
 from config import config as cfg
+from metrics import LOAD_SECONDS
+from process.process_geometry import geo_file_name, process_borough_geometry
+
+@contextmanager
+def log_time(component: str):
+    """
+    Logs how long a block takes, e.g. with log_time("geojson"): ...
+    (also exposed on /metrics as app_load_seconds)
+    """
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    LOAD_SECONDS.set(elapsed, component=component)
+    logging.info(f"{component} loaded in {elapsed:.3f}s")
+
+
+class LazyValue:
+    """
+    Value built on first use (thread safe), for data no callback needs
+    for the first render
+
+      lazy = LazyValue(loader, "component name")
+      lazy.get()  # runs loader() once
+    """
+
+    def __init__(self, loader, name: str):
+        self.loader = loader
+        self.name = name
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    with log_time(self.name):
+                        self._value = self.loader()
+                    self._loaded = True
+        return self._value
+
+
+class ModelInputStore:
+    """
+    In-memory store of the model input, indexed by (year, borough)
+
+    Every column is held as one contiguous numpy array. Rows are laid out
+    borough by borough and sorted by year, followed by a copy of all rows
+    sorted by year for the "NYC" view, so the rows of any borough (or NYC)
+    over any range of years are a single contiguous block. A lookup returns
+    slices (views) of the column arrays - nothing is filtered or copied.
+
+    Rows without a year are kept in `df` but are not part of any view.
+    `df` is left out when the store is pickled (app snapshot): the column
+    arrays are then views of the mapped file, shared by the workers
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+        df = df.loc[df['year'].notna()].copy()
+        df['year'] = df['year'].astype(int)
+
+        # Borough blocks first, then the NYC block
+        blocks = [
+            (borough, df_borough.sort_values('year', kind='stable'))
+            for borough, df_borough in df.groupby('borough', sort=True)
+        ]
+        blocks.append(('NYC', df.sort_values('year', kind='stable')))
+        layout = pd.concat([block for _, block in blocks], ignore_index=True)
+
+        self.columns = {
+            col: self._to_array(layout[col])
+            for col in layout.columns
+        }
+
+        # borough -> (years, row offsets) where the rows of years[i]
+        # are offsets[i]:offsets[i+1]
+        self._offsets = dict()
+        self._index = dict()
+        start = 0
+        for borough, block in blocks:
+            years, counts = np.unique(block['year'].to_numpy(), return_counts=True)
+            offsets = start + np.concatenate([[0], np.cumsum(counts)])
+            self._offsets[borough] = (years, offsets)
+            for i, year in enumerate(years):
+                self._index[(int(year), borough)] = slice(offsets[i], offsets[i+1])
+            start += len(block)
+
+        self.years = sorted({year for year, _ in self._index})
+        self.boroughs = list(self._offsets)
+
+    def __getstate__(self):
+        return {k: v for k, v in vars(self).items() if k != 'df'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.df = None
+
+    @staticmethod
+    def _to_array(col: pd.Series) -> np.ndarray:
+        """
+        Contiguous array of a column - text columns become fixed-width strings
+        """
+        if col.dtype == object:
+            return np.ascontiguousarray(col.fillna('').to_numpy(dtype=str))
+        return np.ascontiguousarray(col.to_numpy())
+
+    def _view(self, rows: slice) -> dict:
+        return {col: values[rows] for col, values in self.columns.items()}
+
+    def get(self, year: int, borough: str) -> dict:
+        """
+        Returns {column: array} for a single year and borough ("NYC" for all)
+        """
+        return self._view(self._index.get((year, borough), slice(0, 0)))
+
+    def get_range(self, start_year: int, end_year: int, borough: str) -> dict:
+        """
+        Returns {column: array} for all years start_year..end_year (inclusive)
+        and a borough ("NYC" for all)
+        """
+        if borough not in self._offsets:
+            return self._view(slice(0, 0))
+
+        years, offsets = self._offsets[borough]
+        first = np.searchsorted(years, start_year, side='left')
+        last = np.searchsorted(years, end_year, side='right')
+
+        return self._view(slice(offsets[first], offsets[last]))
+
 
 def get_model_input_df(
-        file_loc: str='data/model_inputs/model_input.csv'
-        ) -> pd.DataFrame:
+        file_loc: str='data/model_inputs/model_input.csv',
+        prediction_service=None
+        ) -> ModelInputStore:
     """
-    Returns a dataframe that is based on the input dataframe to our model
+    Returns a store based on the input dataframe to our model
 
     Expected location:
     -- data/model_inputs/model_input.csv
 
+    When a prediction service is given (see prediction.PredictionService),
+    the model's prediction and error are added for every row
+
     Returns:
-    -- Dataframe with our target, predicted target, and inputs
+    -- ModelInputStore with our target, predicted target, and inputs
+       indexed by (year, borough)
     """
 
     df = pd.read_csv(file_loc)
     df['zip'] = df['zip'].astype(int).astype(str)
     df['cluster_name'] = df['Cluster'].apply(lambda x: 'Cluster ' + str(x+1))
+    df['borough'] = df['borough'].map(lambda b: cfg['boroughs_lookup'].get(b, b))
+
+    if prediction_service is not None:
+        df = prediction_service.score_model_input(df)
 
-    return df
+    return ModelInputStore(df)
 
 def get_pca_with_clusters() -> pd.DataFrame:
     """
@@ -75,6 +222,41 @@ def get_borough_geo_zips(geo_json_zips):
     return borough_geo_zips
 
 
+def get_borough_geo_json(
+        geo_json_zips: dict,
+        borough_zips: dict,
+        geo_dir: str=cfg['geo_dir']) -> dict:
+    """
+    Returns the simplified and quantized geojson of each borough:
+      key: borough
+      value: {tolerance: FeatureCollection}
+
+    Reads the files written by src/process/process_geometry.py when they
+    are available, otherwise prepares them from the full geojson
+    """
+    tolerances = cfg['geo_tolerances']
+    files = {
+        (borough, tolerance): os.path.join(geo_dir, geo_file_name(borough, tolerance))
+        for borough in borough_zips
+        for tolerance in tolerances
+    }
+
+    if not all(os.path.isfile(f) for f in files.values()):
+        return process_borough_geometry(
+            geo_json_zips,
+            borough_zips,
+            tolerances,
+            cfg['geo_precision']
+        )
+
+    borough_geo = {borough: dict() for borough in borough_zips}
+    for (borough, tolerance), f in files.items():
+        with open(f, "rb") as file:
+            borough_geo[borough][tolerance] = json.load(file)
+
+    return borough_geo
+
+
 def get_borough_zips(
         nyc_zips_geojson: dict,
         file_loc: str='data/raw/zip_borough.csv') -> dict:
@@ -87,13 +269,13 @@ def get_borough_zips(
 
     # Initialize a defaultdict to hold boroughs and their associated zipcodes
     borough_zipcodes = defaultdict(list)
-    nyc_zips_with_geojson = list(nyc_zips_geojson.keys())
+    nyc_zips_with_geojson = set(nyc_zips_geojson)
 
     # Read the CSV file
     with open(file_loc, mode='r', encoding='utf-8-sig') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
-            borough = row['borough']
+            borough = cfg['boroughs_lookup'].get(row['borough'], row['borough'])
             zip = row['zip']
             if zip not in nyc_zips_with_geojson:
                continue
@@ -106,12 +288,17 @@ def get_borough_zips(
     return borough_zipcodes
 
 def get_arrests_outside_buffer(
-        file_loc: str='data/processed/arrests_outside_buffer_by_zip_2016.csv'
-        ) -> pd.DataFrame:
+        file_loc: str='data/processed/arrest_cube.npz',
+        export_locs: str='data/processed/arrests_outside_buffer_by_zip_*.csv'
+        ) -> ArrestCube:
         """
-        Returns a dataframe with the summarized arrests outside buffer
+        Returns the cube of arrests outside buffer, by year, month,
+        zipcode and law category (all years available)
+
+        Reads the cube written by src/arrest_cube.py when available,
+        otherwise builds it from the processed exports
         """
+        if os.path.isfile(file_loc):
+            return ArrestCube.load(file_loc)
 
-        df = pd.read_csv(file_loc)
-        df = df.set_index(df['zip'].astype(str)).drop(columns = ['arrest_year'])
-        return df
\ No newline at end of file
+        return build_arrest_cube(sorted(glob.glob(export_locs)))
@@ -0,0 +1,169 @@
+"""
+What-if scenarios on the facility counts of the zipcodes
+
+The supervised model is linear (StandardScaler + HuberRegressor), so
+
+    prediction = intercept + sum_j coef_j * (x_j - mean_j) / scale_j
+
+and changing feature j by dx changes the prediction by (coef_j / scale_j) * dx.
+The engine keeps those effective coefficients and the base prediction of
+every zipcode, so a scenario only touches the zipcodes and features it
+changes instead of re-running the pipeline.
+
+A scenario is {zip: {feature: change in count}}, e.g. {"11201": {"LIBRARIES": 2}}
+"""
+import numpy as np
+from flask import jsonify, request
+
+from config import config as cfg
+
+# Features that are not facility counts
+FIXED_FEATURES = ['Cluster', 'neighbor_average']
+
+
+class WhatIfEngine:
+    """
+    Applies facility count scenarios to the base predictions of one year
+
+    inputs:
+      - model: fitted Pipeline(StandardScaler, HuberRegressor)
+      - df: {column: array} of the zipcodes (see utils.ModelInputStore),
+        with the features and predicted_market_value
+    """
+
+    def __init__(self, model, df: dict):
+        scaler = model.steps[0][1]
+        regressor = model.steps[-1][1]
+
+        self.features = list(model.feature_names_in_)
+        self.editable_features = [f for f in self.features if f not in FIXED_FEATURES]
+        self.coefficients = dict(zip(self.features, regressor.coef_ / scaler.scale_))
+
+        self.zips = np.asarray(df['zip'])
+        self.zip_index = {z: i for i, z in enumerate(self.zips)}
+        self.base_prediction = np.asarray(df['predicted_market_value'], dtype=float)
+        self.base_counts = {f: np.asarray(df[f], dtype=float) for f in self.editable_features}
+
+    def _check(self, scenario: dict):
+        for z, changes in scenario.items():
+            if z not in self.zip_index:
+                raise KeyError(f"Unknown zipcode: {z}")
+            for feature in changes:
+                if feature not in self.coefficients or feature in FIXED_FEATURES:
+                    raise KeyError(f"Not a facility feature: {feature}")
+
+    def apply(self, scenario: dict) -> dict:
+        """
+        Predictions of the zipcodes changed by a scenario
+
+        Counts can not go below 0, so a change is capped at the current count
+
+        output:
+          - {zip: {"predicted": new prediction, "change": new - base prediction}}
+        """
+        self._check(scenario)
+
+        result = dict()
+        for z, changes in scenario.items():
+            i = self.zip_index[z]
+            change = 0.0
+            for feature, delta in changes.items():
+                count = self.base_counts[feature][i]
+                change += self.coefficients[feature] * (max(count + delta, 0) - count)
+            result[z] = {
+                "predicted": self.base_prediction[i] + change,
+                "change": change,
+            }
+
+        return result
+
+    def apply_batch(self, scenarios: list) -> list:
+        """
+        Applies independent scenarios (each one on top of the base)
+        """
+        return [self.apply(scenario) for scenario in scenarios]
+
+    def sweep(self, feature: str, deltas, zips: list | None = None) -> np.ndarray:
+        """
+        Predictions for a range of changes of one feature, for each zipcode
+
+        output:
+          - array of shape (len(deltas), len(zips)) - all zipcodes when None
+        """
+        if feature not in self.editable_features:
+            raise KeyError(f"Not a facility feature: {feature}")
+
+        rows = np.arange(len(self.zips)) if zips is None else np.array(
+            [self.zip_index[z] for z in zips]
+        )
+        count = self.base_counts[feature][rows]
+        new_count = np.maximum(count[None, :] + np.asarray(deltas, dtype=float)[:, None], 0)
+
+        return self.base_prediction[rows] + self.coefficients[feature] * (new_count - count)
+
+    def figure(self, base_figure: dict, scenario: dict) -> dict:
+        """
+        Copy of the "What-If" base figure with the scenario applied - only
+        the values of the changed zipcodes are replaced
+        """
+        trace = dict(base_figure["data"][0])
+        positions = {z: i for i, z in enumerate(trace["locations"])}
+        z_vec = np.array(trace["z"], dtype=float)
+        text_vec = list(trace["text"])
+
+        for z, prediction in self.apply(scenario).items():
+            if z in positions:
+                z_vec[positions[z]] = prediction["predicted"]
+                text_vec[positions[z]] = (
+                    f"{z}: {prediction['predicted']:,.0f} ({prediction['change']:+,.0f})"
+                )
+
+        trace["z"] = z_vec
+        trace["text"] = text_vec
+
+        return {
+            "data": [trace] + list(base_figure["data"][1:]),
+            "layout": base_figure["layout"],
+        }
+
+
+def register_what_if_route(
+        server,
+        get_engine,
+        route: str = '/api/what-if'
+):
+    """
+    Adds the batch scenario endpoint to the Flask server
+
+    POST {"scenarios": [{zip: {feature: change}}, ...]}
+    Response: {"results": [{zip: {"predicted": ..., "change": ...}}, ...]}
+    in the order of the scenarios
+
+    get_engine: returns the WhatIfEngine (called per request, so it can
+    be built on first use)
+    """
+    max_scenarios = cfg['what-if max scenarios']
+
+    def what_if():
+        payload = request.get_json(force=True, silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get('scenarios'), list):
+            return jsonify(error="Expected a json body {\"scenarios\": [...]}"), 400
+
+        scenarios = payload['scenarios']
+        if len(scenarios) > max_scenarios:
+            return jsonify(error=f"At most {max_scenarios} scenarios per request"), 413
+
+        try:
+            results = get_engine().apply_batch(scenarios)
+        except (KeyError, TypeError, AttributeError) as e:
+            return jsonify(error=str(e.args[0])), 400
+
+        return jsonify(results=[
+            {
+                z: {k: None if np.isnan(v) else v for k, v in prediction.items()}
+                for z, prediction in result.items()
+            }
+            for result in results
+        ])
+
+    server.add_url_rule(route, 'what_if', what_if, methods=['POST'])